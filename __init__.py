@@ -1,5 +1,11 @@
 import ast
 
+from .literal_cache import LiteralCache
+
+
+# Rendered conditions parsed by evaluate_expression, shared by every block
+literal_cache = LiteralCache()
+
 
 # TODO: this functionality is copied from mongo_base_block,
 # consider unifying
@@ -9,7 +15,8 @@ def evaluate_expression(expression, signal, force_dict=True):
     This method will allow the expression to evaluate to a dictionary or
     a string representing a dictionary. In either case, a dictionary will
     be returned. If both of those fail, the value of force_dict determines
-    whether or not the expression can be returned.
+    whether or not the expression can be returned. Parsed strings are
+    cached, each call gets its own copy of the result.
 
     Params:
         expression (expression): The ExpressionProperty reference
@@ -28,7 +35,10 @@ def evaluate_expression(expression, signal, force_dict=True):
         if not isinstance(exp_result, dict):
             try:
                 # Let's at least try to make it a dict first
-                exp_result = ast.literal_eval(exp_result)
+                if isinstance(exp_result, str):
+                    exp_result = literal_cache.parse(exp_result)
+                else:
+                    exp_result = ast.literal_eval(exp_result)
             except Exception as e:
                 # Didn't work, this may or may not be a problem, we'll find out
                 # in the next block of code
@@ -41,3 +51,29 @@ def evaluate_expression(expression, signal, force_dict=True):
                                 "{}".format(expression))
 
     return exp_result
+
+
+def static_value(value, evaluate=None):
+    """ Evaluates a property once, if it is the same for every signal.
+
+    Lets blocks precompute literal property values at configure time, so
+    only expressions are evaluated against each signal.
+
+    Params:
+        value (PropertyValue): The property, as accessed on the block
+        evaluate (callable): Evaluates the property without a signal,
+            calls it by default
+
+    Returns:
+        result: The value of the property, None if it is an expression or
+            can't be evaluated on its own
+    """
+    # The same check nio makes on the raw value of a property
+    raw = value.value
+    if isinstance(raw, str) and "{{" in raw and "}}" in raw:
+        return None
+    try:
+        return evaluate(value) if evaluate else value()
+    except Exception:
+        # Evaluated with each signal instead, where failures are reported
+        return None
@@ -0,0 +1,75 @@
+def flatten_aggregations(aggregations, parent=None):
+    """ Flatten a tree of aggregation results into one dict per leaf bucket
+
+    Each row holds the keys of the buckets it is nested in, named after
+    their aggregation, the doc_count of its leaf bucket and the values of
+    the metrics computed at every level.
+
+    For instance, a terms aggregation by_host holding an avg aggregation
+    cpu gives one row per host: {'by_host': 'a', 'doc_count': 3, 'cpu': 2}
+
+    Params:
+        aggregations (dict): The aggregations of a search response, or the
+            sub-aggregations of a bucket
+        parent (dict): The fields of the enclosing buckets
+
+    Returns:
+        rows (list): A dict per leaf bucket, none without aggregations
+    """
+    if not aggregations and parent is None:
+        # Nothing was aggregated, or a filter_path dropped the results
+        return []
+    row = dict(parent or {})
+    bucket_aggregations = []
+    single_buckets = []
+    for name, result in aggregations.items():
+        if not isinstance(result, dict):
+            # The key and doc_count of the enclosing bucket
+            continue
+        if 'buckets' in result:
+            bucket_aggregations.append((name, result['buckets']))
+        elif 'doc_count' in result:
+            # A single bucket aggregation, like filter or nested
+            single_buckets.append((name, result))
+        else:
+            row[name] = _metric_value(result)
+
+    for name, bucket in single_buckets:
+        if _sub_aggregations(bucket):
+            # Nested like any bucket, without a key of its own
+            bucket_aggregations.append((name, [bucket]))
+        else:
+            row[name] = bucket['doc_count']
+
+    if not bucket_aggregations:
+        return [row]
+    rows = []
+    for name, buckets in bucket_aggregations:
+        if isinstance(buckets, dict):
+            # Keyed buckets, i.e. filters or keyed ranges
+            buckets = [dict(bucket, key=key)
+                       for key, bucket in buckets.items()]
+        for bucket in buckets:
+            bucket_row = dict(row, doc_count=bucket['doc_count'])
+            if 'key' in bucket:
+                bucket_row[name] = bucket['key']
+            if 'key_as_string' in bucket:
+                bucket_row[name + '_as_string'] = bucket['key_as_string']
+            rows.extend(flatten_aggregations(
+                _sub_aggregations(bucket), bucket_row))
+    return rows
+
+
+def _sub_aggregations(bucket):
+    return {name: result for name, result in bucket.items()
+            if isinstance(result, dict)}
+
+
+def _metric_value(result):
+    if 'value' in result:
+        return result['value']
+    if 'values' in result:
+        # Percentiles
+        return result['values']
+    # Multi-value metrics, like stats
+    return {key: value for key, value in result.items() if key != 'meta'}
@@ -0,0 +1,221 @@
+import asyncio
+from enum import Enum
+
+from elasticsearch import Transport
+from elasticsearch.connection import Connection
+from elasticsearch.exceptions import TransportError, ConnectionError, \
+    ConnectionTimeout
+from nio.util.threading import spawn
+
+
+class Engine(Enum):
+    THREADS = "threads"
+    ASYNCIO = "asyncio"
+
+
+class AiohttpConnection(Connection):
+
+    """ An elasticsearch connection that performs requests with aiohttp
+
+    perform_request is a coroutine, so this connection can only be used by
+    an AsyncTransport. Every request goes through a single aiohttp session
+    whose connector keeps at most maxsize sockets open.
+    """
+
+    def __init__(self, host='localhost', port=9200, http_auth=None,
+                 use_ssl=False, maxsize=10, loop=None, compressor=None,
+                 accept_compressed=False, **kwargs):
+        super().__init__(host=host, port=port, use_ssl=use_ssl, **kwargs)
+        self.loop = loop
+        self.maxsize = maxsize
+        self.http_auth = http_auth
+        self.compressor = compressor
+        self.accept_compressed = accept_compressed
+        self.session = None
+
+    def _get_session(self):
+        # aiohttp sessions have to be created from within the event loop
+        if self.session is None:
+            import aiohttp
+            auth = None
+            if self.http_auth:
+                auth = aiohttp.BasicAuth(*self.http_auth.split(':', 1))
+            headers = {'content-type': 'application/json'}
+            if not self.accept_compressed:
+                headers['accept-encoding'] = 'identity'
+            self.session = aiohttp.ClientSession(
+                auth=auth,
+                connector=aiohttp.TCPConnector(limit=self.maxsize),
+                headers=headers)
+        return self.session
+
+    async def perform_request(self, method, url, params=None, body=None,
+                              timeout=None, ignore=()):
+        import aiohttp
+        url = self.url_prefix + url
+        full_url = self.host + url
+        start = self.loop.time()
+        data = body
+        headers = None
+        if body is not None and self.compressor:
+            data, compressed = self.compressor.compress(body)
+            if compressed:
+                headers = {'content-encoding': 'gzip'}
+        try:
+            async with self._get_session().request(
+                    method, full_url, params=params, data=data,
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(
+                        total=timeout or self.timeout)) as response:
+                raw_data = await response.text()
+        except asyncio.TimeoutError as e:
+            self.log_request_fail(method, full_url, url, body,
+                                  self.loop.time() - start, exception=e)
+            raise ConnectionTimeout('TIMEOUT', str(e), e)
+        except Exception as e:
+            self.log_request_fail(method, full_url, url, body,
+                                  self.loop.time() - start, exception=e)
+            raise ConnectionError('N/A', str(e), e)
+        duration = self.loop.time() - start
+
+        # raise errors based on http status codes
+        if not (200 <= response.status < 300) and \
+                response.status not in ignore:
+            self.log_request_fail(method, full_url, url, body, duration,
+                                  response.status, raw_data)
+            try:
+                self._raise_error(response.status, raw_data)
+            except TransportError as e:
+                e.retry_after = response.headers.get('Retry-After')
+                raise
+
+        self.log_request_success(method, full_url, url, body,
+                                 response.status, raw_data, duration)
+        return response.status, response.headers, raw_data
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncTransport(Transport):
+
+    """ A transport whose perform_request is a coroutine
+
+    Client methods return whatever the transport returns, so the methods
+    of an Elasticsearch client using this transport return coroutines.
+    Sniffing is not supported.
+    """
+
+    def __init__(self, hosts, loop, **kwargs):
+        kwargs['connection_class'] = AiohttpConnection
+        super().__init__(hosts, loop=loop, **kwargs)
+
+    async def perform_request(self, method, url, params=None, body=None):
+        if body is not None:
+            body = self.serializer.dumps(body).encode('utf-8')
+
+        ignore = ()
+        timeout = None
+        if params:
+            timeout = params.pop('request_timeout', None)
+            ignore = params.pop('ignore', ())
+            if isinstance(ignore, int):
+                ignore = (ignore, )
+
+        for attempt in range(self.max_retries + 1):
+            connection = self.get_connection()
+            try:
+                status, headers, data = await connection.perform_request(
+                    method, url, params, body, ignore=ignore, timeout=timeout)
+            except TransportError as e:
+                if method == 'HEAD' and e.status_code == 404:
+                    return False
+
+                retry = False
+                if isinstance(e, ConnectionTimeout):
+                    retry = self.retry_on_timeout
+                elif isinstance(e, ConnectionError):
+                    retry = True
+                elif e.status_code in self.retry_on_status:
+                    retry = True
+
+                if retry and attempt < self.max_retries:
+                    # only mark as dead if we are retrying
+                    self.mark_dead(connection)
+                else:
+                    raise
+            else:
+                if method == 'HEAD':
+                    return 200 <= status < 300
+
+                self.connection_pool.mark_live(connection)
+                if data:
+                    data = self.deserializer.loads(
+                        data, headers.get('content-type'))
+                return data
+
+    async def close(self):
+        for connection in self.connection_pool.connections:
+            await connection.close()
+
+
+class AsyncEngine(object):
+
+    """ Runs an asyncio event loop in a dedicated thread
+
+    Block threads hand coroutines to the loop with run, which waits for
+    their result. Clients created by the engine share the loop, so
+    thousands of requests can be in flight on a handful of sockets.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.loop = None
+        self._thread = None
+        self._clients = []
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = spawn(self._run_loop)
+
+    def stop(self):
+        if self.loop is None:
+            return
+        for client in self._clients:
+            try:
+                self.run(client.transport.close())
+            except:
+                self.logger.warning("Unable to close async client",
+                                    exc_info=True)
+        self._clients = []
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def create_client(self, client_kwargs):
+        """ Create an Elasticsearch client that performs requests on the
+        engine's event loop.
+
+        Params:
+            client_kwargs (dict): The kwargs of a regular client
+
+        Returns:
+            client (Elasticsearch): A client whose methods are coroutines
+        """
+        from elasticsearch import Elasticsearch
+        client = Elasticsearch(transport_class=AsyncTransport,
+                               loop=self.loop, **client_kwargs)
+        self._clients.append(client)
+        return client
+
+    def run(self, coroutine):
+        """ Run a coroutine on the engine's loop and wait for its result """
+        return asyncio.run_coroutine_threadsafe(
+            coroutine, self.loop).result()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
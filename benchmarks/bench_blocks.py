@@ -0,0 +1,213 @@
+""" Benchmarks of ESInsert and ESFind against a fake Elasticsearch node
+
+Each scenario drives a block with batches of synthetic signals through a
+real HTTP client, and reports the signals processed per second, the p99
+request latency recorded by the block and the peak RSS of the process.
+Each scenario runs in a process of its own, so its peak RSS isn't the
+peak of the scenarios that ran before it.
+
+Run it from the directory containing this block repository, e.g.:
+
+    python -m elastic_search.benchmarks.bench_blocks --signals 5000
+"""
+from argparse import ArgumentParser, SUPPRESS
+from time import monotonic, sleep
+import json
+import resource
+import subprocess
+import sys
+import unittest
+
+from nio.signal.base import Signal
+from nio.testing.block_test_case import NIOBlockTestCase
+
+from ..es_find_block import ESFind
+from ..es_insert_block import ESInsert
+from .fake_elasticsearch import FakeElasticsearch
+
+
+class BlockBenchmark(NIOBlockTestCase):
+
+    """ One benchmark per bench_ method, configured by the class options
+    """
+
+    options = {
+        'signals': 2000,
+        'batch_size': 100,
+        'latency': 0.0,
+        'reject_rate': 0.0,
+        'doc_size': 100,
+    }
+    results = []
+
+    def setUp(self):
+        super().setUp()
+        self.notified = 0
+        self.fake = FakeElasticsearch(
+            latency=self.options['latency'],
+            reject_rate=self.options['reject_rate'],
+            total_hits=self.options['signals'],
+            doc_size=self.options['doc_size'])
+        self.fake.start()
+
+    def tearDown(self):
+        self.fake.stop()
+        super().tearDown()
+
+    def signals_notified(self, block, signals, output_id):
+        # Only count, keeping every output signal would skew the RSS
+        self.notified += len(signals)
+
+    def bench_insert(self):
+        self._run_insert("insert", {})
+
+    def bench_insert_concurrent(self):
+        self._run_insert("insert, 8 workers",
+                         {"concurrency": {"workers": 8}})
+
+    def bench_insert_bulk(self):
+        self._run_insert("insert, bulk", {"bulk": {"enabled": True}})
+
+    def bench_insert_buffered(self):
+        self._run_insert("insert, buffered", {
+            "buffer": {"enabled": True, "flush_interval": {"seconds": 0.1}}})
+
+    def bench_find(self):
+        self._run_find("find", {"size": 10})
+
+    def bench_find_msearch(self):
+        self._run_find("find, msearch", {
+            "size": 10, "msearch": {"enabled": True}})
+
+    def bench_find_count(self):
+        self._run_find("find, count", {"mode": "count"})
+
+    def bench_find_scroll(self):
+        # A single signal streams every matching document
+        blk = ESFind()
+        self._run("find, scroll", blk, {
+            "stream": {"enabled": True, "page_size": 1000}},
+            [[Signal()]], self.options['signals'])
+
+    def _run_insert(self, name, config):
+        self._run(name, ESInsert(), config, self._batches(),
+                  self.options['signals'])
+
+    def _run_find(self, name, config):
+        self._run(name, ESFind(), config, self._batches(),
+                  self.options['signals'])
+
+    def _batches(self):
+        padding = 'x' * max(self.options['doc_size'] - 30, 0)
+        size = self.options['batch_size']
+        signals = self.options['signals']
+        return [[Signal({'value': i, 'padding': padding})
+                 for i in range(start, min(start + size, signals))]
+                for start in range(0, signals, size)]
+
+    def _run(self, name, blk, config, batches, signals):
+        config = dict(config, host=self.fake.host, port=self.fake.port,
+                      log_level="ERROR",
+                      retry_options={"multiplier": 0.01})
+        self.configure_block(blk, config)
+        blk.start()
+        start = monotonic()
+        for batch in batches:
+            blk.process_signals(batch)
+        # Let scheduled retries run, stopping would cancel them
+        while blk._queue_depths()['scheduled_retries'] and \
+                monotonic() - start < 60:
+            sleep(0.01)
+        # Stopping drains anything buffered
+        blk.stop()
+        elapsed = monotonic() - start
+        stats = blk.stats()['stats']['total']
+        self.results.append({
+            'name': name,
+            'signals_per_sec': signals / elapsed,
+            'p99_ms': stats['latency_ms'].get('p99', 0),
+            'requests': stats['requests'],
+            'retries': stats['retries'],
+            'notified': self.notified,
+            # Kilobytes on Linux, for this scenario's process only
+            'peak_rss_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+
+
+def print_results(results):
+    columns = ['name', 'signals_per_sec', 'p99_ms', 'requests', 'retries',
+               'notified', 'peak_rss_mb']
+    print(' | '.join('{:>18}'.format(column) for column in columns))
+    for result in results:
+        print(' | '.join(
+            '{:>18.1f}'.format(result[column])
+            if isinstance(result[column], float)
+            else '{:>18}'.format(result[column]) for column in columns))
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--signals', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the fake node waits per request')
+    parser.add_argument('--reject-rate', type=float, default=0.0,
+                        help='Share of requests rejected with a 429')
+    parser.add_argument('--doc-size', type=int, default=100,
+                        help='Approximate document size in bytes')
+    parser.add_argument('scenarios', nargs='*',
+                        help='Scenarios to run, i.e. insert_bulk, all '
+                             'of them by default')
+    # Runs a single scenario and prints its results as JSON
+    parser.add_argument('--scenario-process', action='store_true',
+                        help=SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.scenario_process:
+        return run_scenario(args)
+
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = 'bench'
+    scenarios = args.scenarios or [
+        name[len('bench_'):]
+        for name in loader.getTestCaseNames(BlockBenchmark)]
+    options = ['--signals', str(args.signals),
+               '--batch-size', str(args.batch_size),
+               '--latency', str(args.latency),
+               '--reject-rate', str(args.reject_rate),
+               '--doc-size', str(args.doc_size)]
+    results = []
+    failed = False
+    for scenario in scenarios:
+        process = subprocess.run(
+            [sys.executable, '-m', __spec__.name, '--scenario-process'] +
+            options + [scenario],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        lines = process.stdout.strip().splitlines()
+        if process.returncode or not lines:
+            failed = True
+            continue
+        results.extend(json.loads(lines[-1]))
+    print_results(results)
+    return 1 if failed else 0
+
+
+def run_scenario(args):
+    BlockBenchmark.options = {
+        'signals': args.signals,
+        'batch_size': args.batch_size,
+        'latency': args.latency,
+        'reject_rate': args.reject_rate,
+        'doc_size': args.doc_size,
+    }
+    suite = unittest.TestSuite(
+        BlockBenchmark('bench_{}'.format(scenario))
+        for scenario in args.scenarios)
+    outcome = unittest.TextTestRunner(stream=sys.stderr).run(suite)
+    # The last line of the output, whatever the block logged before it
+    print(json.dumps(BlockBenchmark.results))
+    return 0 if outcome.wasSuccessful() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
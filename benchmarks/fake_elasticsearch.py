@@ -0,0 +1,257 @@
+from gzip import compress, decompress
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import count
+from random import Random
+from socketserver import ThreadingMixIn
+from threading import Lock
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+import json
+
+from nio.util.threading import spawn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeElasticsearch(object):
+
+    """ An in-process HTTP stand-in for an Elasticsearch node.
+
+    It speaks enough of the document, _bulk, _search, _msearch, _count
+    and scroll APIs to drive ESInsert and ESFind. Nothing is stored: writes are
+    acknowledged and searches answer with generated documents.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, reject_rate=0,
+                 retry_after=None, total_hits=100, doc_size=100, seed=0):
+        """ Create a new fake node, call start to serve requests
+
+        Args:
+            host (str): The interface to listen on
+            port (int): The port to listen on, 0 picks a free port
+            latency (float): Seconds to wait before answering each request
+            reject_rate (float): Share of requests, and of bulk items, that
+                are rejected with a 429
+            retry_after (int): The Retry-After header sent with rejections
+            total_hits (int): Number of documents matching every search
+            doc_size (int): Approximate size in bytes of the documents
+                returned by searches
+            seed (int): Seed of the rejections, for repeatable runs
+        """
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.retry_after = retry_after
+        self.total_hits = total_hits
+        self.doc_size = doc_size
+        self.requests = {}
+        self.compressed_requests = 0
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._ids = count()
+        # Open scrolls, the offset of their next page and their page size
+        self._scrolls = {}
+        self._server = _ThreadingHTTPServer((host, port), self._handler())
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        spawn(self._server.serve_forever)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive like a real node
+            protocol_version = "HTTP/1.1"
+            # Send headers and body in one segment, without waiting for
+            # acks, or every response would pay the delayed ack timeout
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def do_HEAD(self):
+                fake._handle(self, head=True)
+
+            def do_GET(self):
+                fake._handle(self)
+
+            do_POST = do_PUT = do_DELETE = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _handle(self, request, head=False):
+        url = urlsplit(request.path)
+        params = {key: values[-1]
+                  for key, values in parse_qs(url.query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = decompress(body)
+            with self._lock:
+                self.compressed_requests += 1
+        body = body.decode('utf-8')
+        parts = [part for part in url.path.split('/') if part]
+        endpoint = next((part for part in parts if part.startswith('_')),
+                        'doc' if parts else 'root')
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency:
+            sleep(self.latency)
+        if endpoint != '_bulk' and self._rejected():
+            self._respond(request, 429, {
+                'error': {'type': 'es_rejected_execution_exception'},
+                'status': 429}, head)
+            return
+        handler = {
+            'root': self._info,
+            'doc': self._index,
+            '_bulk': self._bulk,
+            '_search': self._search,
+            '_msearch': self._msearch,
+            '_count': self._count,
+        }.get(endpoint)
+        if handler is None:
+            self._respond(request, 400, {
+                'error': 'unsupported endpoint {}'.format(url.path)}, head)
+            return
+        status, response = handler(request.command, parts, params, body)
+        self._respond(request, status, response, head, gzipped='gzip' in
+                      request.headers.get('Accept-Encoding', ''))
+
+    def _rejected(self):
+        if not self.reject_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.reject_rate
+
+    def _respond(self, request, status, response, head=False,
+                 gzipped=False):
+        data = json.dumps(response).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        if gzipped:
+            data = compress(data)
+            request.send_header('Content-Encoding', 'gzip')
+        request.send_header('Content-Length', str(len(data)))
+        if status == 429 and self.retry_after is not None:
+            request.send_header('Retry-After', str(self.retry_after))
+        request.end_headers()
+        if not head:
+            request.wfile.write(data)
+
+    def _info(self, method, parts, params, body):
+        return 200, {'name': 'fake', 'cluster_name': 'fake',
+                     'version': {'number': '5.6.0'}}
+
+    def _index(self, method, parts, params, body):
+        index, doc_type = parts[0], parts[1]
+        doc_id = parts[2] if len(parts) > 2 else str(next(self._ids))
+        return 201, {'_index': index, '_type': doc_type, '_id': doc_id,
+                     '_version': 1, 'result': 'created', 'created': True}
+
+    def _bulk(self, method, parts, params, body):
+        lines = [line for line in body.split('\n') if line]
+        items = []
+        i = 0
+        while i < len(lines):
+            action, metadata = next(iter(json.loads(lines[i]).items()))
+            # Every action but delete is followed by its source
+            i += 1 if action == 'delete' else 2
+            if self._rejected():
+                items.append({action: {
+                    'status': 429,
+                    'error': {'type': 'es_rejected_execution_exception'}}})
+                continue
+            items.append({action: {
+                '_index': metadata.get('_index', parts[0]),
+                '_type': metadata.get('_type', parts[1]),
+                '_id': metadata.get('_id', str(next(self._ids))),
+                'status': 201 if action in ('index', 'create') else 200}})
+        return 200, {'took': 1, 'errors': any(
+            'error' in next(iter(item.values())) for item in items),
+            'items': items}
+
+    def _search(self, method, parts, params, body):
+        if parts[-1] == 'scroll' or (len(parts) > 1 and
+                                     parts[-2] == 'scroll'):
+            return self._scroll(method, parts, params, body)
+        search = json.loads(body) if body else {}
+        size = int(params.get('size', search.get('size', 10)))
+        start = int(params.get('from', search.get('from', 0)))
+        if 'search_after' in search:
+            start = search['search_after'][0] + 1
+        response = self._page(start, size)
+        if 'scroll' in params:
+            scroll_id = 'scroll{}'.format(next(self._ids))
+            with self._lock:
+                self._scrolls[scroll_id] = (start + size, size)
+            response['_scroll_id'] = scroll_id
+        return 200, response
+
+    def _scroll(self, method, parts, params, body):
+        search = json.loads(body) if body.startswith('{') else {}
+        scroll_id = parts[-1] if parts[-1] != 'scroll' else \
+            params.get('scroll_id', search.get('scroll_id', body))
+        if method == 'DELETE':
+            # Several scrolls can be cleared at once
+            if not isinstance(scroll_id, list):
+                scroll_id = [scroll_id]
+            with self._lock:
+                for _id in scroll_id:
+                    self._scrolls.pop(_id, None)
+            return 200, {'succeeded': True}
+        with self._lock:
+            if scroll_id not in self._scrolls:
+                return 404, {'error': {'type': 'search_context_missing'}}
+            start, size = self._scrolls[scroll_id]
+            self._scrolls[scroll_id] = (start + size, size)
+        response = self._page(start, size)
+        response['_scroll_id'] = scroll_id
+        return 200, response
+
+    def _msearch(self, method, parts, params, body):
+        lines = [line for line in body.split('\n') if line]
+        responses = []
+        # Searches come as a header line followed by a body line
+        for search in lines[1::2]:
+            _, response = self._search('GET', ['_search'], {}, search)
+            responses.append(response)
+        return 200, {'responses': responses}
+
+    def _count(self, method, parts, params, body):
+        terminate_after = int(params.get('terminate_after', 0))
+        count = min(self.total_hits, terminate_after) \
+            if terminate_after else self.total_hits
+        response = {'count': count,
+                    '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+        if terminate_after:
+            response['terminated_early'] = count == terminate_after
+        return 200, response
+
+    def _page(self, start, size):
+        padding = 'x' * max(self.doc_size - 30, 0)
+        hits = [{
+            '_index': 'fake',
+            '_type': 'fake',
+            '_id': str(i),
+            '_score': 1.0,
+            '_source': {'value': i, 'padding': padding},
+            'sort': [i],
+        } for i in range(start, min(start + size, self.total_hits))]
+        return {'took': 1, 'timed_out': False,
+                'hits': {'total': self.total_hits, 'max_score': 1.0,
+                         'hits': hits}}
@@ -0,0 +1,181 @@
+from collections import deque
+from enum import Enum
+from threading import Condition
+from time import monotonic
+
+from nio.properties import PropertyHolder, BoolProperty, IntProperty, \
+    SelectProperty, TimeDeltaProperty
+from nio.util.logging import get_nio_logger
+from nio.util.threading import spawn
+
+
+class Backpressure(Enum):
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    REJECT = "reject"
+
+
+class BufferOptions(PropertyHolder):
+    enabled = BoolProperty(title="Buffer Signals?", default=False)
+    max_queue_size = IntProperty(title="Max Queued Documents",
+                                 default=10000)
+    flush_count = IntProperty(title="Flush After Documents", default=500)
+    flush_bytes = IntProperty(title="Flush After Bytes",
+                              default=5 * 1024 * 1024)
+    flush_interval = TimeDeltaProperty(title="Flush Interval",
+                                       default={"seconds": 1})
+    backpressure = SelectProperty(Backpressure,
+                                  title="When Queue is Full",
+                                  default=Backpressure.BLOCK)
+
+
+class BufferFullError(Exception):
+    pass
+
+
+class BufferedWriter(object):
+
+    """ A bounded in-memory queue drained by a background thread.
+
+    Items are handed to the flush callback in batches, as soon as either
+    flush_count items or flush_bytes bytes are queued, or when the oldest
+    queued item has waited flush_interval seconds, whichever comes first.
+
+    The flush callback runs on the writer thread, never on the thread
+    calling put.
+    """
+
+    def __init__(self, flush, max_queue_size, flush_count, flush_bytes,
+                 flush_interval, backpressure=Backpressure.BLOCK,
+                 logger=None, on_drop=None):
+        """ Create a new buffered writer
+
+        Args:
+            flush (callable): Called with a list of items to write
+            max_queue_size (int): Max number of items waiting to be flushed
+            flush_count (int): Flush once this many items are queued
+            flush_bytes (int): Flush once the queued items reach this size
+            flush_interval (float): Max seconds an item waits to be flushed
+            backpressure (Backpressure): What to do with new items when the
+                queue is full
+            logger (Logger): The logger to use
+            on_drop (callable): Called with each item dropped to make room
+                for a new one
+        """
+        self._flush = flush
+        self._max_queue_size = max(max_queue_size, 1)
+        self._flush_count = max(flush_count, 1)
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._backpressure = backpressure
+        self._on_drop = on_drop
+        self.logger = logger or get_nio_logger("BufferedWriter")
+        # Queued entries are (item, size, enqueued_at) tuples
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._cond = Condition()
+        self._stopping = False
+        self._thread = None
+        self.dropped = 0
+        self.rejected = 0
+
+    @property
+    def depth(self):
+        """ The number of items waiting to be flushed """
+        return len(self._queue)
+
+    def start(self):
+        self._stopping = False
+        self._thread = spawn(self._run)
+
+    def stop(self, timeout=None):
+        """ Stop accepting items and flush everything still queued """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def put(self, item, size=0):
+        """ Queue an item to be flushed
+
+        Args:
+            item: The item to pass to the flush callback
+            size (int): The size of the item in bytes
+
+        Raises:
+            BufferFullError: If the item can't be queued, either because the
+                writer is stopped or because the queue is full and the
+                backpressure behavior is to reject
+        """
+        dropped = []
+        with self._cond:
+            while not self._stopping and \
+                    len(self._queue) >= self._max_queue_size:
+                if self._backpressure is Backpressure.REJECT:
+                    self.rejected += 1
+                    raise BufferFullError(
+                        "Buffer is full ({} items)".format(len(self._queue)))
+                elif self._backpressure is Backpressure.DROP_OLDEST:
+                    dropped_item, dropped_size, _ = self._queue.popleft()
+                    self._queued_bytes -= dropped_size
+                    self.dropped += 1
+                    dropped.append(dropped_item)
+                else:
+                    self._cond.wait()
+            if self._stopping:
+                self.rejected += 1
+                raise BufferFullError("Buffered writer is stopped")
+            self._queue.append((item, size, monotonic()))
+            self._queued_bytes += size
+            # Wake the writer when a flush is due, or so it can start timing
+            # the flush interval of the first queued item
+            if len(self._queue) == 1 or self._flush_due():
+                self._cond.notify_all()
+        if self._on_drop:
+            # Outside of the lock, the callback may be slow
+            for dropped_item in dropped:
+                self._on_drop(dropped_item)
+
+    def _flush_due(self):
+        if not self._queue:
+            return False
+        return (self._stopping or
+                len(self._queue) >= self._flush_count or
+                self._queued_bytes >= self._flush_bytes or
+                monotonic() - self._queue[0][2] >= self._flush_interval)
+
+    def _next_batch(self):
+        """ Wait until a flush is due and pop the items to flush.
+
+        Returns None once the writer is stopped and fully drained.
+        """
+        with self._cond:
+            while not self._flush_due():
+                if self._stopping:
+                    return None
+                timeout = None
+                if self._queue:
+                    timeout = max(self._queue[0][2] + self._flush_interval -
+                                  monotonic(), 0)
+                self._cond.wait(timeout)
+            batch = []
+            while self._queue and len(batch) < self._flush_count:
+                item, size, _ = self._queue.popleft()
+                self._queued_bytes -= size
+                batch.append(item)
+            # Wake up anyone waiting on room in the queue
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                self._flush(batch)
+            except:
+                self.logger.exception(
+                    "Failed to flush {} buffered items".format(len(batch)))
@@ -0,0 +1,148 @@
+from collections import deque
+from datetime import datetime
+from enum import Enum
+from threading import Lock
+from time import monotonic
+
+from nio.properties import PropertyHolder, BoolProperty, IntProperty, \
+    FloatProperty, SelectProperty, TimeDeltaProperty
+from nio.util.logging import get_nio_logger
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class WhenOpen(Enum):
+    FAIL_FAST = "fail_fast"
+    DIVERT = "divert"
+
+
+class CircuitBreakerOptions(PropertyHolder):
+    enabled = BoolProperty(title="Enable Circuit Breaker?", default=False)
+    failure_rate = FloatProperty(title="Failure Rate to Open", default=0.5)
+    window = IntProperty(title="Requests in Failure Window", default=20)
+    min_requests = IntProperty(title="Min Requests to Open", default=10)
+    reset_timeout = TimeDeltaProperty(title="Time Before Probing",
+                                      default={"seconds": 30})
+    when_open = SelectProperty(WhenOpen, title="When Open",
+                               default=WhenOpen.FAIL_FAST)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+
+    """ Stops sending requests to a cluster that keeps failing.
+
+    The breaker is closed while the cluster is healthy. It opens once the
+    failure rate of the last requests reaches failure_rate, and requests
+    are then refused without being sent. After reset_timeout seconds the
+    breaker half-opens and a single caller runs the probe; the breaker
+    closes if the probe succeeds and opens again otherwise.
+    """
+
+    def __init__(self, probe, failure_rate=0.5, window=20, min_requests=10,
+                 reset_timeout=30, logger=None, max_transitions=20):
+        """ Create a new circuit breaker
+
+        Args:
+            probe (callable): Returns whether the cluster is healthy again
+            failure_rate (float): Share of failed requests, between 0 and 1,
+                that opens the breaker
+            window (int): Number of recent requests the rate is computed on
+            min_requests (int): Requests needed in the window before the
+                breaker can open
+            reset_timeout (float): Seconds to stay open before probing
+            logger (Logger): The logger to use
+            max_transitions (int): Number of transitions to keep for status
+        """
+        self._probe = probe
+        self._failure_rate = failure_rate
+        self._min_requests = max(min(min_requests, window), 1)
+        self._reset_timeout = reset_timeout
+        self.logger = logger or get_nio_logger("CircuitBreaker")
+        # Recent outcomes, True for a success
+        self._outcomes = deque(maxlen=max(window, 1))
+        self._transitions = deque(maxlen=max_transitions)
+        self._lock = Lock()
+        self._state = BreakerState.CLOSED
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """ Whether a request can be sent now, probing the cluster if due
+        """
+        with self._lock:
+            if self._state is BreakerState.CLOSED:
+                return True
+            if self._probing or \
+                    monotonic() - self._opened_at < self._reset_timeout:
+                return False
+            self._probing = True
+            self._transition(BreakerState.HALF_OPEN, "probing the cluster")
+        try:
+            healthy = bool(self._probe())
+        except Exception:
+            self.logger.exception("Circuit breaker probe failed")
+            healthy = False
+        with self._lock:
+            self._probing = False
+            if healthy:
+                self._outcomes.clear()
+                self._transition(BreakerState.CLOSED, "probe succeeded")
+            else:
+                self._open("probe failed")
+        return healthy
+
+    def record(self, success):
+        """ Record the outcome of a request sent while the breaker allowed it
+        """
+        with self._lock:
+            if self._state is not BreakerState.CLOSED:
+                return
+            self._outcomes.append(success)
+            if len(self._outcomes) < self._min_requests:
+                return
+            rate = self._current_failure_rate()
+            if rate >= self._failure_rate:
+                self._open("{:.0%} of the last {} requests failed".format(
+                    rate, len(self._outcomes)))
+
+    def status(self):
+        """ Describe the state of the breaker and its last transitions """
+        with self._lock:
+            return {
+                'state': self._state.value,
+                'failure_rate': self._current_failure_rate(),
+                'requests': len(self._outcomes),
+                'transitions': list(self._transitions),
+            }
+
+    def _current_failure_rate(self):
+        if not self._outcomes:
+            return 0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def _open(self, reason):
+        self._opened_at = monotonic()
+        self._transition(BreakerState.OPEN, reason)
+
+    def _transition(self, state, reason):
+        self.logger.warning("Circuit breaker {} -> {}: {}".format(
+            self._state.value, state.value, reason))
+        self._transitions.append({
+            'from': self._state.value,
+            'to': state.value,
+            'reason': reason,
+            'time': datetime.utcnow().isoformat(),
+        })
+        self._state = state
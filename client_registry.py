@@ -0,0 +1,94 @@
+import json
+from threading import Lock
+
+
+class ClientRegistry(object):
+
+    """ A process-wide registry of shared Elasticsearch clients
+
+    Clients are keyed on the arguments they are built with, blocks that
+    target the same cluster with the same arguments share one client and
+    therefore one connection pool. Clients are reference counted and
+    closed when the last block releases them.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def key(client_kwargs):
+        """ Build the registry key of a set of client kwargs
+
+        Params:
+            client_kwargs (dict): The kwargs the client is built with,
+                including its hosts
+
+        Returns:
+            key (str): The same key for any equivalent set of kwargs
+        """
+        return json.dumps(client_kwargs, sort_keys=True, default=repr)
+
+    def acquire(self, key, factory):
+        """ Get the client registered under key, creating it if needed
+
+        Every call to acquire must be followed by a call to release.
+
+        Params:
+            key (str): The key of the client
+            factory (callable): Builds the client if it doesn't exist yet
+
+        Returns:
+            client (Elasticsearch): The shared client
+        """
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = [factory(), 0]
+            entry = self._clients[key]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, key):
+        """ Release a reference to a client, closing it if it was the last
+        """
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._clients[key]
+        entry[0].transport.close()
+
+    def stats(self):
+        """ Describe the registered clients and their connection pools
+
+        Returns:
+            stats (list): A dict per client with the number of blocks using
+                it and, per node, the pool size, the connections opened and
+                the requests sent
+        """
+        with self._lock:
+            entries = list(self._clients.values())
+        return [{
+            'references': references,
+            'pools': [self._pool_stats(connection) for connection in
+                      client.transport.connection_pool.connections]
+        } for client, references in entries]
+
+    @staticmethod
+    def _pool_stats(connection):
+        stats = {'host': connection.host}
+        pool = getattr(connection, 'pool', None)
+        if pool is not None:
+            stats.update({
+                'maxsize': pool.pool.maxsize,
+                'opened': pool.num_connections,
+                'requests': pool.num_requests,
+            })
+        return stats
+
+
+# The registry shared by every block of the process
+registry = ClientRegistry()
@@ -0,0 +1,74 @@
+from gzip import compress
+from threading import Lock
+from time import monotonic
+
+from nio.properties import PropertyHolder, BoolProperty, IntProperty
+
+
+class CompressionOptions(PropertyHolder):
+    compress_requests = BoolProperty(title="Compress Requests?",
+                                     default=False)
+    level = IntProperty(title="Compression Level (1-9)", default=6)
+    min_size = IntProperty(title="Min Bytes to Compress", default=1024)
+    accept_compressed = BoolProperty(title="Accept Compressed Responses?",
+                                     default=False)
+
+
+class GzipCompressor(object):
+
+    """ Gzips request bodies, keeping track of what it saves and costs
+
+    Bodies smaller than min_size are sent as they are, compressing them
+    would cost more CPU than the bandwidth it saves.
+    """
+
+    def __init__(self, level=6, min_size=1024):
+        self.level = min(max(level, 1), 9)
+        self.min_size = min_size
+        self._lock = Lock()
+        self._requests = 0
+        self._compressed = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._seconds = 0
+
+    def __repr__(self):
+        # Clients with the same settings can be shared by the registry
+        return "{}(level={}, min_size={})".format(
+            type(self).__name__, self.level, self.min_size)
+
+    def compress(self, body):
+        """ Compress a request body if it's large enough
+
+        Returns:
+            (body, compressed): The body to send and whether it is gzipped
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if len(body) < self.min_size:
+            with self._lock:
+                self._requests += 1
+            return body, False
+        start = monotonic()
+        compressed = compress(body, self.level)
+        elapsed = monotonic() - start
+        with self._lock:
+            self._requests += 1
+            self._compressed += 1
+            self._bytes_in += len(body)
+            self._bytes_out += len(compressed)
+            self._seconds += elapsed
+        return compressed, True
+
+    def stats(self):
+        """ The bodies compressed, their ratio and the time it took """
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'compressed': self._compressed,
+                'bytes_in': self._bytes_in,
+                'bytes_out': self._bytes_out,
+                'ratio': self._bytes_in / self._bytes_out
+                if self._bytes_out else 0,
+                'compress_ms': self._seconds * 1000,
+            }
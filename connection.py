@@ -0,0 +1,46 @@
+from threading import local
+
+from elasticsearch.connection import Urllib3HttpConnection
+from elasticsearch.exceptions import TransportError
+
+
+class RetryAfterConnection(Urllib3HttpConnection):
+
+    """ A connection that keeps the Retry-After header of failed requests
+
+    The header is set as the retry_after attribute of the TransportError
+    raised for the response, so retries can honor it.
+
+    Request bodies are gzipped when a compressor is given, and compressed
+    responses are asked for when accept_compressed is set.
+    """
+
+    def __init__(self, *args, compressor=None, accept_compressed=False,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compressor = compressor
+        if accept_compressed:
+            # Responses are decompressed by urllib3
+            self.headers['accept-encoding'] = 'gzip,deflate'
+        self._last_response = local()
+        urlopen = self.pool.urlopen
+
+        def capture_urlopen(method, url, body=None, headers=None, **kwargs):
+            # Compressing here leaves the logged body readable
+            if body is not None and self.compressor:
+                body, compressed = self.compressor.compress(body)
+                if compressed:
+                    headers = dict(headers or {}, **{
+                        'content-encoding': 'gzip'})
+            response = urlopen(method, url, body, headers=headers, **kwargs)
+            self._last_response.retry_after = \
+                response.headers.get('Retry-After')
+            return response
+        self.pool.urlopen = capture_urlopen
+
+    def _raise_error(self, status_code, raw_data):
+        try:
+            super()._raise_error(status_code, raw_data)
+        except TransportError as e:
+            e.retry_after = getattr(self._last_response, 'retry_after', None)
+            raise
@@ -0,0 +1,59 @@
+from enum import Enum
+import hashlib
+import json
+
+from nio.properties import PropertyHolder, SelectProperty, Property, \
+    ListProperty
+from nio.types import StringType
+
+
+class IdSource(Enum):
+    AUTO = "auto"
+    EXPRESSION = "expression"
+    CONTENT_HASH = "content_hash"
+
+
+class OpType(Enum):
+    INDEX = "index"
+    CREATE = "create"
+
+
+class HashAlgorithm(Enum):
+    SHA1 = "sha1"
+    SHA256 = "sha256"
+    MD5 = "md5"
+
+
+class DocumentIdOptions(PropertyHolder):
+    source = SelectProperty(IdSource, title="Id Source",
+                            default=IdSource.AUTO)
+    expression = Property(title="Id Expression", default="",
+                          allow_none=True)
+    hash_fields = ListProperty(StringType,
+                               title="Hashed Fields (empty for all)",
+                               default=[])
+    hash_algorithm = SelectProperty(HashAlgorithm, title="Hash Algorithm",
+                                    default=HashAlgorithm.SHA1)
+    op_type = SelectProperty(OpType, title="Operation Type",
+                             default=OpType.INDEX)
+
+
+def content_hash(document, fields=None, algorithm=HashAlgorithm.SHA1):
+    """ A stable id for a document, derived from its content
+
+    Documents with the same values in the hashed fields get the same id,
+    whatever the order of their keys.
+
+    Params:
+        document (dict): The document to index
+        fields (list): The fields to hash, the whole document if empty
+        algorithm (HashAlgorithm): The hash function to use
+
+    Returns:
+        id (str): The hex digest of the hashed fields
+    """
+    if fields:
+        document = {field: document.get(field) for field in fields}
+    canonical = json.dumps(document, sort_keys=True, separators=(',', ':'),
+                           ensure_ascii=False, default=str)
+    return hashlib.new(algorithm.value, canonical.encode('utf-8')).hexdigest()
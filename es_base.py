@@ -1,29 +1,43 @@
-from time import sleep
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import BoundedSemaphore, Event, Lock
+from time import monotonic
+import asyncio
 import json
 import logging
 
 from nio.block.base import Block
+from nio.block.terminals import output
 from nio.properties import StringProperty, Property, \
-    IntProperty, BoolProperty, ObjectProperty, PropertyHolder
+    IntProperty, BoolProperty, ObjectProperty, PropertyHolder, \
+    SelectProperty, ListProperty
 from nio.command import command
 from nio.block.mixins.retry.retry import Retry
-from nio.block.mixins.retry.strategy import BackoffStrategy
 from nio.block.mixins.enrich.enrich_signals import EnrichSignals, \
     EnrichProperties
+from nio.modules.scheduler import Job
+from nio.signal.base import Signal
 from nio.util.discovery import not_discoverable
 
+from .async_engine import AsyncEngine, Engine
+from .circuit_breaker import CircuitBreaker, CircuitBreakerOptions, \
+    CircuitOpenError, BreakerState, WhenOpen
+from .client_registry import registry
+from .compression import CompressionOptions, GzipCompressor
+from .connection import RetryAfterConnection
+from .metrics import Metrics, MetricsOptions
+from .node_selection import NodeSelector, InFlightConnection, \
+    LeastInFlightSelector
+from .serializers import JSONLibrary, get_serializer
+from .retry_policy import RetryPolicy, ErrorAwareBackoff, \
+    RETRYABLE_STATUSES, is_retryable, retry_after
+from . import literal_cache, static_value
 
-class SleepBackoffStrategy(BackoffStrategy):
 
-    def next_retry(self):
-        if self.retry_num > 1:
-            self.logger.error("Aborty retries")
-            return False
-        self.logger.debug(
-            "Waiting {} seconds before retrying execute method".format(
-                self.retry_num))
-        sleep(self.retry_num)
-        return True
+# Client kwargs the transport of the asyncio engine doesn't support
+_SNIFF_KWARGS = ('sniff_on_start', 'sniff_on_connection_fail',
+                 'sniffer_timeout')
 
 
 class AuthData(PropertyHolder):
@@ -32,7 +46,265 @@ class AuthData(PropertyHolder):
     use_https = BoolProperty(title="Use HTTPS?", default=False)
 
 
+class HostData(PropertyHolder):
+    host = StringProperty(title="Host", default="127.0.0.1")
+    port = IntProperty(title="Port", default=9200)
+
+
+class ClusterOptions(PropertyHolder):
+    sniff_on_start = BoolProperty(title="Sniff Nodes on Start?",
+                                  default=False)
+    sniff_on_connection_fail = BoolProperty(
+        title="Sniff Nodes on Connection Failure?", default=False)
+    sniff_interval = IntProperty(title="Sniff Interval (seconds)", default=0)
+    selector = SelectProperty(NodeSelector, title="Node Selection",
+                              default=NodeSelector.ROUND_ROBIN)
+    dead_timeout = IntProperty(title="Dead Node Timeout (seconds)",
+                               default=60)
+
+
+class ConcurrencyOptions(PropertyHolder):
+    workers = IntProperty(title="Concurrent Queries", default=1)
+    max_in_flight = IntProperty(title="Max In-Flight Queries", default=100)
+
+
+# A signal's action, ready to be sent through the _bulk API
+BulkItem = namedtuple('BulkItem', ['signal', 'index', 'doc_type', 'action'])
+
+
+class BulkOptions(PropertyHolder):
+    enabled = BoolProperty(title="Use Bulk API?", default=False)
+    chunk_size = IntProperty(title="Max Documents per Request", default=500)
+    max_chunk_bytes = IntProperty(title="Max Bytes per Request",
+                                  default=10 * 1024 * 1024)
+
+
+class Bulkable():
+
+    """ A elasticsearch block mixin that sends actions through the _bulk API
+    """
+
+    bulk = ObjectProperty(BulkOptions, title='Bulk Options',
+                          default=BulkOptions(), advanced=True)
+
+    def execute_bulk(self, actions, index=None, doc_type=None, wait=True):
+        """ Send a list of bulk actions through the _bulk API.
+
+        Actions are sent in chunks no larger than the configured number of
+        documents and bytes. Actions rejected because the cluster is busy
+        (429 or 503) are resent on their own. A chunk that fails entirely
+        (after retrying) is reported as a failure of each one of its
+        actions, other chunks are not affected.
+
+        Params:
+            actions (list): Serialized actions, as built by bulk_action
+            index: The default index for actions that do not specify one
+            doc_type: The default type for actions that do not specify one
+            wait (bool): Retry failed requests and resend rejected actions
+                before returning, waiting out the backoff on the calling
+                thread. When False each chunk is sent once and rejected
+                actions are returned as they are, for the caller to
+                reschedule
+
+        Returns:
+            items (list): One result dict per action, in the same order as
+                the actions. Failed actions contain an 'error' key, a
+                'circuit_open' key if they were not sent because the
+                circuit breaker is open, and a 'retryable' key if their
+                request failed in a way that is worth retrying later
+        """
+        items = []
+        for chunk in self._chunk_bulk_actions(actions):
+            items.extend(
+                self._execute_bulk_chunk(chunk, index, doc_type, wait))
+        return items
+
+    def _execute_bulk_chunk(self, chunk, index, doc_type, wait=True):
+        """ Send a chunk of actions, resending only the rejected ones """
+        results = [None] * len(chunk)
+        pending = list(range(len(chunk)))
+        retry_num = 0
+        execute = self.execute_with_retry if wait else self.execute_once
+        while True:
+            body = ''.join(chunk[i] for i in pending)
+            self._metrics.record_bulk(index, doc_type, len(pending))
+            try:
+                response = execute(
+                    self.timed_request, (index, doc_type), self._es.bulk,
+                    body=body, index=index, doc_type=doc_type,
+                    sent_bytes=len(body.encode('utf-8')))
+            except CircuitOpenError as e:
+                for i in pending:
+                    results[i] = {'error': str(e), 'circuit_open': True}
+                break
+            except Exception as e:
+                self.logger.exception(
+                    "Bulk request of {} actions failed".format(len(pending)))
+                for i in pending:
+                    results[i] = {'error': str(e),
+                                  'retryable': is_retryable(e),
+                                  'retry_after': retry_after(e)}
+                break
+            rejected = []
+            for i, item in zip(pending, response['items']):
+                # Each item is keyed by its action name, i.e. {'index': {}}
+                results[i] = next(iter(item.values()))
+                if results[i].get('status') in RETRYABLE_STATUSES:
+                    rejected.append(i)
+            retry_num += 1
+            if rejected:
+                self._metrics.record_rejections(
+                    index, doc_type, len(rejected))
+            if not wait or not rejected or self._stop_retry.is_set() or \
+                    not self._retry_policy.can_retry(retry_num):
+                break
+            self.logger.warning("Resending {} rejected bulk actions".format(
+                len(rejected)))
+            self._metrics.record_retry(index, doc_type, len(rejected))
+            self._stop_retry.wait(self._retry_policy.delay(retry_num))
+            pending = rejected
+        return results
+
+    def send_bulk_items(self, items, wait=True, retry_num=0):
+        """ Send the actions of signals through the _bulk API.
+
+        Items are grouped by their (index, doc_type) so each group can be
+        sent with the index and type in the request path. Items diverted
+        by the circuit breaker and failed items are handed to
+        _bulk_items_diverted and _bulk_items_failed.
+
+        Params:
+            items (list): BulkItems, in the order they are to be sent
+            wait (bool): Retry on the calling thread, see execute_bulk.
+                When False, rejected items and items whose request failed
+                in a retryable way are resent later on the scheduler and
+                their output signals notified then
+            retry_num (int): The number of times the items were resent
+
+        Returns:
+            signals (list): One output signal for each written item
+        """
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault((item.index, item.doc_type), []).append(item)
+
+        output = []
+        diverted = []
+        failed = []
+        resent = []
+        for (index, doc_type), group in groups.items():
+            self.logger.debug("Bulk sending {} actions to: {}, type: {}"
+                              .format(len(group), index, doc_type))
+            results = self.execute_bulk([item.action for item in group],
+                                        index=index, doc_type=doc_type,
+                                        wait=wait)
+            for item, result in zip(group, results):
+                if result.get('circuit_open'):
+                    diverted.append(item)
+                elif 'error' in result and \
+                        not self._bulk_item_written(result):
+                    if not wait and (result.get('retryable') or result.get(
+                            'status') in RETRYABLE_STATUSES):
+                        resent.append((item, result))
+                    else:
+                        failed.append((item, result))
+                else:
+                    output.append(self.get_output_signal(
+                        self._bulk_item_result(result), item.signal))
+        if resent and not self._schedule_bulk_resend(resent, retry_num + 1):
+            failed.extend(resent)
+        if diverted:
+            self._bulk_items_diverted(diverted)
+        if failed:
+            self._bulk_items_failed(failed)
+        return output
+
+    def _schedule_bulk_resend(self, resent, retry_num):
+        """ Resend failed items later, like the query of a single signal
+
+        Returns:
+            scheduled (bool): False if the items are out of retries
+        """
+        if self._stop_retry.is_set() or \
+                not self._retry_policy.can_retry(retry_num):
+            return False
+        delay = max([self._retry_policy.delay(retry_num)] +
+                    [result.get('retry_after') or 0 for _, result in resent])
+        self.logger.warning(
+            "Resending {} bulk actions, retry number {} in {:.2f} seconds"
+            .format(len(resent), retry_num, delay))
+        for item, _ in resent:
+            self._metrics.record_retry(item.index, item.doc_type)
+        self._schedule_retry(delay, self._resend_bulk_items,
+                             [item for item, _ in resent], retry_num)
+        return True
+
+    def _resend_bulk_items(self, items, retry_num):
+        output = self.send_bulk_items(items, wait=False, retry_num=retry_num)
+        if output:
+            self.notify_signals(output)
+
+    def _bulk_item_result(self, result):
+        """ The output of a written item, from its bulk result """
+        return {'id': result['_id']}
+
+    def _bulk_item_written(self, result):
+        """ Whether a failed item counts as written anyway """
+        return False
+
+    def _bulk_items_diverted(self, items):
+        self._circuit_open([item.signal for item in items])
+
+    def _bulk_items_failed(self, failed):
+        for item, result in failed:
+            self.logger.error("Failed to write {} to: {}, type: {}: {}"
+                              .format(item.signal, item.index,
+                                      item.doc_type, result['error']))
+
+    def bulk_action(self, action, source=None, **metadata):
+        """ Serialize a single bulk action.
+
+        Params:
+            action (str): The bulk action, i.e. index, create or update
+            source (dict): The document (or update body) for the action
+            metadata: Action metadata such as _index, _type or _id
+
+        Returns:
+            action (str): The newline delimited action to send
+        """
+        serializer = self._es.transport.serializer
+        lines = [serializer.dumps({action: metadata})]
+        if source is not None:
+            lines.append(serializer.dumps(source))
+        return '\n'.join(lines) + '\n'
+
+    def _chunk_bulk_actions(self, actions):
+        chunk_size = self.bulk().chunk_size()
+        max_chunk_bytes = self.bulk().max_chunk_bytes()
+        chunk = []
+        chunk_bytes = 0
+        for action in actions:
+            action_bytes = len(action.encode('utf-8'))
+            if chunk and (len(chunk) >= chunk_size or
+                          chunk_bytes + action_bytes > max_chunk_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(action)
+            chunk_bytes += action_bytes
+        if chunk:
+            yield chunk
+
+
+# Declaring outputs drops the unnamed default terminal of 0.x blocks, the
+# reason ESFind and ESInsert went to 1.0.0
 @not_discoverable
+@output("metrics", label="Metrics")
+@output("circuit_open", label="Circuit Open")
+@output("results", default=True, label="Results")
+@command("stats")
+@command("circuit")
+@command("clients")
 @command("connected")
 class ESBase(Retry, EnrichSignals, Block):
 
@@ -45,11 +317,31 @@ class ESBase(Retry, EnrichSignals, Block):
     """
     host = StringProperty(title='ES Host', default="127.0.0.1")
     port = IntProperty(title='ES Port', default=9200)
+    seed_hosts = ListProperty(HostData, title='Additional Hosts', default=[],
+                              advanced=True)
+    cluster = ObjectProperty(ClusterOptions, title='Cluster Options',
+                             default=ClusterOptions(), advanced=True)
     index = Property(title='Index', default="nio")
     doc_type = Property(title='Type', default="{{($__class__.__name__)}}")
     auth = ObjectProperty(AuthData, title="Authentication", default=AuthData())
     elasticsearch_client_kwargs = Property(title='Client Argurments',
                                            default=None, allow_none=True)
+    share_client = BoolProperty(title='Share Client?', default=False,
+                                advanced=True)
+    concurrency = ObjectProperty(ConcurrencyOptions, title='Concurrency',
+                                 default=ConcurrencyOptions(), advanced=True)
+    engine = SelectProperty(Engine, title='Query Engine',
+                            default=Engine.THREADS, advanced=True)
+    circuit_breaker = ObjectProperty(CircuitBreakerOptions,
+                                     title='Circuit Breaker',
+                                     default=CircuitBreakerOptions(),
+                                     advanced=True)
+    metrics = ObjectProperty(MetricsOptions, title='Metrics',
+                             default=MetricsOptions(), advanced=True)
+    serializer = SelectProperty(JSONLibrary, title='JSON Serializer',
+                                default=JSONLibrary.AUTO, advanced=True)
+    compression = ObjectProperty(CompressionOptions, title='Compression',
+                                 default=CompressionOptions(), advanced=True)
     # TODO: remove this when nio framework is fixed
     enrich = ObjectProperty(EnrichProperties, title='Signal Enrichment',
                             default=EnrichProperties())
@@ -57,13 +349,103 @@ class ESBase(Retry, EnrichSignals, Block):
     def __init__(self):
         super().__init__()
         self._es = None
-        self._backoff_strategy = SleepBackoffStrategy(logger=self.logger)
+        self._retry_policy = RetryPolicy()
+        self._stop_retry = Event()
+        self._retry_jobs = {}
+        self._retry_jobs_lock = Lock()
+        self._executor = None
+        self._in_flight = None
+        self._engine = None
+        self._async_es = None
+        self._client_key = None
+        self._breaker = None
+        self._metrics = Metrics()
+        self._metrics_job = None
+        self._pending = 0
+        self._pending_lock = Lock()
+        self._index = None
+        self._doc_type = None
 
     def configure(self, context):
         super().configure(context)
-        self._es = self.create_elastic_search_instance()
+        self._release_client()
+        if self.share_client():
+            self._client_key = registry.key(
+                self._build_elasticsearch_client_kwargs(
+                    self.build_host_url()))
+            self._es = registry.acquire(
+                self._client_key, self.create_elastic_search_instance)
+        else:
+            self._es = self.create_elastic_search_instance()
+        self._breaker = None
+        if self.circuit_breaker().enabled():
+            self._breaker = CircuitBreaker(
+                lambda: self.connected()['connected'],
+                failure_rate=self.circuit_breaker().failure_rate(),
+                window=self.circuit_breaker().window(),
+                min_requests=self.circuit_breaker().min_requests(),
+                reset_timeout=self.circuit_breaker().reset_timeout()
+                .total_seconds(),
+                logger=self.logger)
+        # Literal values are the same for every signal
+        self._index = static_value(self.index)
+        self._doc_type = static_value(self.doc_type)
         logging.getLogger('elasticsearch').setLevel(self.logger.logger.level)
 
+    def setup_backoff_strategy(self):
+        """ Retry only the errors worth retrying, without sleeping on the
+        thread processing signals where possible
+        """
+        options = self.retry_options().get_options_dict()
+        self._retry_policy = RetryPolicy(**options)
+        self.use_backoff_strategy(
+            ErrorAwareBackoff, stop_event=self._stop_retry, **options)
+
+    def start(self):
+        super().start()
+        self._stop_retry.clear()
+        report_interval = self.metrics().report_interval()
+        if report_interval.total_seconds() > 0:
+            self._metrics_job = Job(
+                self._report_metrics, report_interval, True)
+        if self.engine() is Engine.ASYNCIO:
+            self._engine = AsyncEngine(self.logger)
+            self._engine.start()
+            self._async_es = self._engine.create_client(
+                self._build_async_client_kwargs())
+            return
+        workers = self.concurrency().workers()
+        if workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            # Bound the queries submitted but not done yet, across every
+            # list of signals being processed
+            self._in_flight = BoundedSemaphore(
+                max(self.concurrency().max_in_flight(), workers))
+
+    def stop(self):
+        if self._metrics_job:
+            self._metrics_job.cancel()
+            self._metrics_job = None
+        self._stop_retry.set()
+        with self._retry_jobs_lock:
+            for job in self._retry_jobs.values():
+                job.cancel()
+            self._retry_jobs.clear()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._engine:
+            self._engine.stop()
+            self._engine = None
+            self._async_es = None
+        self._release_client()
+        super().stop()
+
+    def _release_client(self):
+        if self._client_key:
+            registry.release(self._client_key)
+            self._client_key = None
+
     def create_elastic_search_instance(self):
         url = self.build_host_url()
         self.logger.debug(
@@ -72,19 +454,27 @@ class ESBase(Retry, EnrichSignals, Block):
         from elasticsearch.connection import RequestsHttpConnection
         return Elasticsearch(**self._build_elasticsearch_client_kwargs(url))
 
-    def build_host_url(self):
+    def build_host_url(self, host=None, port=None):
+        host = host or self.host()
+        port = port or self.port()
         if self.auth().username():
             return "{}://{}:{}@{}:{}/".format(
                 'https' if self.auth().use_https() else 'http',
                 self.auth().username(), self.auth().password(),
-                self.host(), self.port())
+                host, port)
         else:
             return "{}://{}:{}/".format(
                 'https' if self.auth().use_https() else 'http',
-                self.host(), self.port())
+                host, port)
 
     def _build_elasticsearch_client_kwargs(self, url):
-        kwargs = {'hosts': [url]}
+        kwargs = {'hosts': [url] + [
+            self.build_host_url(seed.host(), seed.port())
+            for seed in self.seed_hosts()]}
+        kwargs.update(self._build_cluster_kwargs())
+        # Encodes request bodies and decodes responses
+        kwargs['serializer'] = get_serializer(self.serializer())
+        kwargs.update(self._build_compression_kwargs())
         client_kwargs = self.elasticsearch_client_kwargs() or {}
         if client_kwargs is not None:
             try:
@@ -97,29 +487,348 @@ class ESBase(Retry, EnrichSignals, Block):
                         self.elasticsearch_client_kwargs()), exc_info=True)
         return kwargs
 
+    def _build_async_client_kwargs(self):
+        """ Client kwargs for the asyncio engine, which can't sniff
+
+        Only the nodes given are used, the threaded client of the block
+        still sniffs for its own requests.
+        """
+        kwargs = self._build_elasticsearch_client_kwargs(
+            self.build_host_url())
+        sniffing = [key for key in _SNIFF_KWARGS if kwargs.pop(key, None)]
+        if sniffing:
+            self.logger.warning(
+                "The asyncio engine doesn't sniff, ignoring {}".format(
+                    ", ".join(sniffing)))
+        return kwargs
+
+    def _build_cluster_kwargs(self):
+        """ Client kwargs for the cluster options that differ from the
+        client's defaults
+        """
+        cluster = self.cluster()
+        kwargs = {}
+        sniffing = False
+        if cluster.sniff_on_start():
+            kwargs['sniff_on_start'] = sniffing = True
+        if cluster.sniff_on_connection_fail():
+            kwargs['sniff_on_connection_fail'] = sniffing = True
+        if cluster.sniff_interval() > 0:
+            kwargs['sniffer_timeout'] = cluster.sniff_interval()
+            sniffing = True
+        if sniffing:
+            # Sniffed nodes don't inherit the settings of the seed urls
+            if self.auth().username():
+                kwargs['http_auth'] = (self.auth().username(),
+                                       self.auth().password())
+            if self.auth().use_https():
+                kwargs['use_ssl'] = True
+        # The default connection class is needed to honor Retry-After
+        kwargs['connection_class'] = RetryAfterConnection
+        # Round robin is the default selector of the client
+        if cluster.selector() is NodeSelector.LEAST_IN_FLIGHT:
+            kwargs['selector_class'] = LeastInFlightSelector
+            kwargs['connection_class'] = InFlightConnection
+        if cluster.dead_timeout() != 60:
+            kwargs['dead_timeout'] = cluster.dead_timeout()
+        return kwargs
+
+    def _build_compression_kwargs(self):
+        compression = self.compression()
+        kwargs = {}
+        if compression.compress_requests():
+            kwargs['compressor'] = GzipCompressor(
+                compression.level(), compression.min_size())
+        if compression.accept_compressed():
+            kwargs['accept_compressed'] = True
+        return kwargs
+
     def process_signals(self, signals, input_id='default'):
-        output = []
-        for s in signals:
-            doc_type = self._evaluate_doc_type(s)
-            self.logger.debug("doc_type evaluated to: {}".format(doc_type))
-            if doc_type:
-                try:
-                    result = self.execute_with_retry(
-                        self.execute_query, doc_type=doc_type, signal=s)
-                    # Expect execute_query to return a dictionary for a signal,
-                    # we will enrich according to configuration here
-                    if result and isinstance(result, list):
-                        output.extend([self.get_output_signal(res, s)
-                                       for res in result])
-                except:
-                    # If the execute call fails, we won't use this signal
-                    self.logger.exception("Query failed")
-                    continue
+        if self._engine:
+            results = self._engine.run(self._async_process_signals(signals))
+        elif self._executor:
+            results = self._process_concurrently(signals)
+        else:
+            results = [self._process_signal(s) for s in signals]
+        output = [out for result in results for out in result]
 
         # Check if we have anything to output
         if output:
             self.notify_signals(output)
 
+    def _process_signal(self, signal):
+        """ Run the query of a single signal.
+
+        A query failing with a retryable error is retried later on the
+        scheduler, so waiting never holds up the other signals.
+
+        Returns:
+            signals (list): The output signals for this signal
+        """
+        doc_type = self._evaluate_doc_type(signal)
+        self.logger.debug("doc_type evaluated to: {}".format(doc_type))
+        if not doc_type:
+            return []
+        return self._query_signal(signal, doc_type, 0)
+
+    def _query_signal(self, signal, doc_type, retry_num):
+        if not self._circuit_allows():
+            self._circuit_open([signal])
+            return []
+        try:
+            result = self.execute_query(doc_type=doc_type, signal=signal)
+        except Exception as exc:
+            self._record_request(exc)
+            retry_num += 1
+            if self._circuit_is_open():
+                self._circuit_open([signal])
+                return []
+            if self._stop_retry.is_set() or \
+                    not self._retry_policy.should_retry(retry_num, exc):
+                # If the execute call fails, we won't use this signal
+                self._query_failed(signal, doc_type, exc)
+                return []
+            delay = self._retry_policy.delay(retry_num, exc)
+            self.logger.warning(
+                "Query failed, retry number {} in {:.2f} seconds".format(
+                    retry_num, delay), exc_info=True)
+            self._metrics.record_retry(*self._request_target(exc, doc_type))
+            self._schedule_retry(delay, self._retry_query, signal, doc_type,
+                                 retry_num)
+            return []
+        self._record_request()
+        return self._output_signals(result, signal)
+
+    def _query_failed(self, signal, doc_type, exc):
+        """ Called, while handling exc, once a query failed for good """
+        self.logger.exception("Query failed")
+
+    def _output_signals(self, result, signal):
+        # Expect execute_query to return a dictionary for a signal,
+        # we will enrich according to configuration here
+        if result and isinstance(result, list):
+            return [self.get_output_signal(res, signal) for res in result]
+        return []
+
+    def _schedule_retry(self, delay, retry, *args):
+        """ Call retry with args in delay seconds, unless the block stops
+        first
+        """
+        key = object()
+        with self._retry_jobs_lock:
+            self._retry_jobs[key] = Job(
+                self._run_retry, timedelta(seconds=delay), False,
+                key, retry, args)
+
+    def _run_retry(self, key, retry, args):
+        with self._retry_jobs_lock:
+            if self._retry_jobs.pop(key, None) is None:
+                # The block stopped, the retry was cancelled
+                return
+        retry(*args)
+
+    def _retry_query(self, signal, doc_type, retry_num):
+        output = self._query_signal(signal, doc_type, retry_num)
+        if output:
+            self.notify_signals(output)
+
+    def _process_concurrently(self, signals):
+        """ Run the queries of a list of signals on the block's thread pool
+
+        Results are returned in the same order as the signals.
+        """
+        futures = []
+        for signal in signals:
+            self._in_flight.acquire()
+            self._update_pending(1)
+            future = self._executor.submit(self._process_signal, signal)
+            future.add_done_callback(self._query_done)
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _query_done(self, future):
+        self._update_pending(-1)
+        self._in_flight.release()
+
+    def _update_pending(self, change):
+        with self._pending_lock:
+            self._pending += change
+
+    async def _async_process_signals(self, signals):
+        """ Run the queries of a list of signals as coroutines
+
+        Results are returned in the same order as the signals.
+        """
+        in_flight = asyncio.Semaphore(self.concurrency().max_in_flight())
+
+        async def process_signal(signal):
+            self._update_pending(1)
+            try:
+                async with in_flight:
+                    return await self._async_process_signal(signal)
+            finally:
+                self._update_pending(-1)
+        return await asyncio.gather(*[process_signal(s) for s in signals])
+
+    async def _async_process_signal(self, signal):
+        doc_type = self._evaluate_doc_type(signal)
+        self.logger.debug("doc_type evaluated to: {}".format(doc_type))
+        if not doc_type:
+            return []
+        retry_num = 0
+        while True:
+            if self._breaker and \
+                    self._breaker.state is not BreakerState.CLOSED:
+                # Probing pings the cluster, keep it off the event loop
+                allowed = await asyncio.get_event_loop().run_in_executor(
+                    None, self._breaker.allow)
+                if not allowed:
+                    self._circuit_open([signal])
+                    return []
+            try:
+                result = await self.async_execute_query(doc_type, signal)
+                self._record_request()
+                break
+            except Exception as exc:
+                self._record_request(exc)
+                retry_num += 1
+                if self._circuit_is_open():
+                    self._circuit_open([signal])
+                    return []
+                if self._stop_retry.is_set() or \
+                        not self._retry_policy.should_retry(retry_num, exc):
+                    self._query_failed(signal, doc_type, exc)
+                    return []
+                delay = self._retry_policy.delay(retry_num, exc)
+                self.logger.warning(
+                    "Query failed, retry number {} in {:.2f} seconds".format(
+                        retry_num, delay), exc_info=True)
+                self._metrics.record_retry(
+                    *self._request_target(exc, doc_type))
+                # Only this coroutine waits, the loop keeps running others
+                await asyncio.sleep(delay)
+        return self._output_signals(result, signal)
+
+    def timed_request(self, target, execute_method, *args, sent_bytes=0,
+                      **kwargs):
+        """ Send a request, recording its metrics.
+
+        Params:
+            target (tuple): The (index, doc_type) to record the request under
+            execute_method (callable): The client method to call
+            sent_bytes (int): The size of the request body, if known
+
+        Returns:
+            response: The response of the request
+        """
+        start = monotonic()
+        try:
+            response = execute_method(*args, **kwargs)
+        except Exception as exc:
+            self._record_failed_request(target, start, sent_bytes, exc)
+            raise
+        self._record_response(target, start, sent_bytes, response)
+        return response
+
+    async def async_timed_request(self, target, execute_method, *args,
+                                  sent_bytes=0, **kwargs):
+        """ The coroutine version of timed_request """
+        start = monotonic()
+        try:
+            response = await execute_method(*args, **kwargs)
+        except Exception as exc:
+            self._record_failed_request(target, start, sent_bytes, exc)
+            raise
+        self._record_response(target, start, sent_bytes, response)
+        return response
+
+    def _record_failed_request(self, target, start, sent_bytes, exc):
+        self._metrics.record_request(
+            *target, latency=monotonic() - start, sent_bytes=sent_bytes,
+            error=exc)
+        # Lets retries be counted against the right index
+        exc.es_target = target
+
+    def _record_response(self, target, start, sent_bytes, response):
+        took = None
+        docs = 0
+        if isinstance(response, dict):
+            took = response.get('took')
+            if 'items' in response:
+                docs = len(response['items'])
+            elif 'hits' in response:
+                # A filter_path can keep the total but drop the hits
+                docs = len(response['hits'].get('hits', []))
+            elif '_id' in response:
+                docs = 1
+        self._metrics.record_request(
+            *target, latency=monotonic() - start, took=took, docs=docs,
+            sent_bytes=sent_bytes)
+
+    @staticmethod
+    def _request_target(exc, doc_type):
+        return getattr(exc, 'es_target', (None, doc_type))
+
+    def execute_with_retry(self, execute_method, *args, **kwargs):
+        """ Execute a request with retries, through the circuit breaker
+
+        Retries wait on the calling thread.
+
+        Raises:
+            CircuitOpenError: If the circuit breaker refuses the request
+        """
+        return self._execute_through_breaker(
+            super().execute_with_retry, execute_method, *args, **kwargs)
+
+    def execute_once(self, execute_method, *args, **kwargs):
+        """ Execute a request through the circuit breaker, without
+        retrying it
+
+        Raises:
+            CircuitOpenError: If the circuit breaker refuses the request
+        """
+        return self._execute_through_breaker(
+            lambda method, *args, **kwargs: method(*args, **kwargs),
+            execute_method, *args, **kwargs)
+
+    def _execute_through_breaker(self, execute, execute_method, *args,
+                                 **kwargs):
+        if not self._circuit_allows():
+            raise CircuitOpenError("Circuit breaker is open")
+        try:
+            result = execute(execute_method, *args, **kwargs)
+        except Exception as exc:
+            self._record_request(exc)
+            raise
+        self._record_request()
+        return result
+
+    def _circuit_allows(self):
+        return self._breaker is None or self._breaker.allow()
+
+    def _circuit_is_open(self):
+        return self._breaker is not None and \
+            self._breaker.state is BreakerState.OPEN
+
+    def _record_request(self, exc=None):
+        """ Report the outcome of a request to the circuit breaker
+
+        Only errors telling the cluster is unreachable or overloaded count
+        as failures, a bad request says nothing about the cluster's health.
+        """
+        if self._breaker:
+            self._breaker.record(exc is None or not is_retryable(exc))
+
+    def _circuit_open(self, signals):
+        """ Handle signals that were not sent because the circuit is open
+        """
+        if self.circuit_breaker().when_open() is WhenOpen.DIVERT:
+            self.notify_signals(signals, 'circuit_open')
+        else:
+            self.logger.warning(
+                "Circuit breaker is open, dropping {} signals".format(
+                    len(signals)))
+
     def query_args(self, signal=None):
         """ Query arguments to use in the ES query.
 
@@ -146,7 +855,36 @@ class ESBase(Retry, EnrichSignals, Block):
         """
         raise NotImplementedError()
 
+    async def async_execute_query(self, doc_type, signal):
+        """ The coroutine version of execute_query, used by the asyncio
+        engine.
+
+        This should be overriden in the child blocks and should perform
+        its requests through self._async_es, whose methods are coroutines.
+
+        Params:
+            doc_type: The type of the document
+            signal (Signal): The signal which triggered the query
+
+        Returns:
+            signals (list): Any signals to notify
+        """
+        raise NotImplementedError()
+
+    def _evaluate_index(self, signal):
+        try:
+            index = self._index if self._index is not None \
+                else self.index(signal)
+            if not index:
+                raise Exception("{} is an invalid index".format(index))
+            return index
+        except:
+            self.logger.exception(
+                "Unable to determine index for {}".format(signal))
+
     def _evaluate_doc_type(self, signal):
+        if self._doc_type is not None:
+            return self._doc_type
         try:
             return self.doc_type(signal)
         except:
@@ -154,3 +892,38 @@ class ESBase(Retry, EnrichSignals, Block):
 
     def connected(self):
         return {'connected': self._es.ping()}
+
+    def clients(self):
+        return {'clients': registry.stats()}
+
+    def stats(self):
+        return {'stats': self._stats()}
+
+    def _stats(self, reset=False):
+        stats = self._metrics.snapshot(reset=reset)
+        stats['queues'] = self._queue_depths()
+        # The compressor of a shared client is shared too
+        client = self._async_es or self._es
+        compressor = client.transport.kwargs.get('compressor')
+        if compressor:
+            stats['compression'] = compressor.stats()
+        # Shared by every block, like the client compressor
+        stats['condition_cache'] = literal_cache.stats()
+        return stats
+
+    def _queue_depths(self):
+        """ The number of signals waiting at each stage of the block """
+        with self._retry_jobs_lock:
+            retries = len(self._retry_jobs)
+        return {'pending_queries': self._pending,
+                'scheduled_retries': retries}
+
+    def _report_metrics(self):
+        self.notify_signals(
+            [Signal(self._stats(reset=self.metrics().reset_on_report()))],
+            'metrics')
+
+    def circuit(self):
+        if self._breaker is None:
+            return {'circuit': {'state': 'disabled'}}
+        return {'circuit': self._breaker.status()}
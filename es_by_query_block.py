@@ -0,0 +1,303 @@
+from collections import namedtuple
+from enum import Enum
+from threading import Lock
+from time import monotonic
+
+from elasticsearch.exceptions import NotFoundError
+from nio.block.terminals import output
+from nio.command import command
+from nio.modules.scheduler import Job
+from nio.properties import SelectProperty, Property, VersionProperty, \
+    IntProperty, FloatProperty, ObjectProperty, TimeDeltaProperty
+
+from .es_base import ESBase
+from .es_upsert_block import ScriptOptions
+from . import evaluate_expression, static_value
+
+
+# A by-query task launched for a signal, polled until it completes
+RunningTask = namedtuple('RunningTask',
+                         ['signal', 'index', 'doc_type', 'started'])
+
+# The counters of a task status, as reported by the tasks API
+_STATUS_FIELDS = ('total', 'updated', 'created', 'deleted', 'batches',
+                  'version_conflicts', 'noops')
+
+
+class ByQueryOperation(Enum):
+    DELETE = "delete"
+    UPDATE = "update"
+
+
+class Conflicts(Enum):
+    ABORT = "abort"
+    PROCEED = "proceed"
+
+
+@output("progress", label="Progress")
+@command("tasks")
+class ESByQuery(ESBase):
+
+    """ A block for deleting or updating every document matching a query.
+
+    The operation runs server-side as a task, launched without waiting for
+    its completion, so a long retention or backfill run never holds up the
+    block. Running tasks are polled through the tasks API, their progress
+    notified on the progress output and their final result on results.
+
+    Tasks keep running when the block stops, only the polling stops.
+
+    Properties:
+        operation (select): delete_by_query or update_by_query
+        condition (expression): the query matching the documents, required,
+            match_all has to be spelled out to touch every document
+        script (object): in update mode, the script run against each
+            document, when empty documents are rewritten as they are
+        conflicts (select): abort the task on a version conflict, or count
+            it and proceed
+        slices (int): the number of slices the task runs in, in parallel
+        requests_per_second (float): throttle each task to this many
+            documents per second, 0 or less for no throttle
+        poll_interval (timedelta): how often running tasks are polled
+
+    """
+    version = VersionProperty("0.1.0")
+    operation = SelectProperty(ByQueryOperation, title='Operation',
+                               default=ByQueryOperation.DELETE)
+    condition = Property(title='Condition', default="")
+    script = ObjectProperty(ScriptOptions, title='Update Script',
+                            default=ScriptOptions())
+    conflicts = SelectProperty(Conflicts, title='On Version Conflict',
+                               default=Conflicts.ABORT)
+    slices = IntProperty(title='Slices', default=1)
+    requests_per_second = FloatProperty(title='Documents per Second',
+                                        default=-1)
+    poll_interval = TimeDeltaProperty(title='Task Poll Interval',
+                                      default={"seconds": 5}, advanced=True)
+
+    def __init__(self):
+        super().__init__()
+        self._condition = None
+        self._params = None
+        self._tasks = {}
+        self._tasks_lock = Lock()
+        self._polling = Lock()
+        self._poll_job = None
+
+    def configure(self, context):
+        super().configure(context)
+        self._condition = static_value(
+            self.condition, lambda value: evaluate_expression(value, None))
+        self._params = static_value(
+            self.script().params,
+            lambda value: evaluate_expression(value, None))
+
+    def start(self):
+        super().start()
+        self._poll_job = Job(self._poll_tasks, self.poll_interval(), True)
+
+    def stop(self):
+        if self._poll_job:
+            self._poll_job.cancel()
+            self._poll_job = None
+        with self._tasks_lock:
+            if self._tasks:
+                self.logger.info(
+                    "{} tasks left running: {}".format(
+                        len(self._tasks), ", ".join(self._tasks)))
+            self._tasks.clear()
+        super().stop()
+
+    def execute_query(self, doc_type, signal):
+        request = self._build_request(doc_type, signal)
+        if not request:
+            return []
+        self.logger.debug("Launching {}_by_query with {}".format(
+            self.operation().value, request))
+
+        response = self.timed_request(
+            (request['index'], doc_type), self._by_query_method(self._es),
+            **request, **self._task_args())
+        return self._task_launched(response, request, signal)
+
+    async def async_execute_query(self, doc_type, signal):
+        request = self._build_request(doc_type, signal)
+        if not request:
+            return []
+        self.logger.debug("Launching {}_by_query with {}".format(
+            self.operation().value, request))
+
+        response = await self.async_timed_request(
+            (request['index'], doc_type),
+            self._by_query_method(self._async_es),
+            **request, **self._task_args())
+        return self._task_launched(response, request, signal)
+
+    def _by_query_method(self, client):
+        if self.operation() is ByQueryOperation.UPDATE:
+            return client.update_by_query
+        return client.delete_by_query
+
+    def _task_args(self):
+        args = {'wait_for_completion': False,
+                'conflicts': self.conflicts().value}
+        if self.slices() > 1:
+            # The client only knows the slices of delete_by_query, params
+            # are passed through as they are
+            args['params'] = {'slices': self.slices()}
+        if self.requests_per_second() > 0:
+            args['requests_per_second'] = self.requests_per_second()
+        return args
+
+    def _build_request(self, doc_type, signal):
+        """ Build the by-query request of a signal.
+
+        Returns:
+            request (dict): The index, doc_type and body of the request,
+                None if the condition is empty or the index can't be
+                determined
+        """
+        condition = self._condition
+        if condition is None:
+            condition = evaluate_expression(self.condition, signal)
+            self.logger.debug("Condition evaluated to: {}".format(condition))
+        if not condition:
+            self.logger.error(
+                "Refusing to {} by query for {}, no condition given".format(
+                    self.operation().value, signal))
+            return None
+
+        body = {'query': condition}
+        if self.operation() is ByQueryOperation.UPDATE and \
+                self.script().source():
+            params = self._params if self._params is not None \
+                else evaluate_expression(self.script().params, signal)
+            body['script'] = {'inline': self.script().source(),
+                              'lang': self.script().lang(),
+                              'params': params}
+
+        index = self._evaluate_index(signal)
+        if not index:
+            return None
+
+        return {
+            'index': index,
+            'doc_type': doc_type,
+            'body': body
+        }
+
+    def _task_launched(self, response, request, signal):
+        """ Remember the task of a signal, to be polled until completed
+
+        Nothing is notified yet, the task reports on the next poll.
+        """
+        task_id = (response or {}).get('task')
+        if not task_id:
+            self.logger.error(
+                "No task returned for {}: {}".format(signal, response))
+            return []
+        self.logger.info("Launched task {} on: {}, type: {}".format(
+            task_id, request['index'], request['doc_type']))
+        with self._tasks_lock:
+            self._tasks[task_id] = RunningTask(
+                signal, request['index'], request['doc_type'], monotonic())
+        return []
+
+    def _poll_tasks(self):
+        """ Poll every running task, notifying progress and completions """
+        if not self._polling.acquire(blocking=False):
+            # The previous poll is still waiting on the cluster
+            return
+        try:
+            with self._tasks_lock:
+                tasks = list(self._tasks.items())
+            progress = []
+            completed = []
+            for task_id, task in tasks:
+                response = self._get_task(task_id, task)
+                if response is None:
+                    continue
+                if response.get('completed'):
+                    with self._tasks_lock:
+                        self._tasks.pop(task_id, None)
+                    completed.append(self.get_output_signal(
+                        self._task_completion(task_id, task, response),
+                        task.signal))
+                else:
+                    progress.append(self.get_output_signal(
+                        self._task_progress(task_id, task, response),
+                        task.signal))
+            if progress:
+                self.notify_signals(progress, 'progress')
+            if completed:
+                self.notify_signals(completed)
+        finally:
+            self._polling.release()
+
+    def _get_task(self, task_id, task):
+        try:
+            return self.timed_request(
+                (task.index, task.doc_type), self._es.tasks.get,
+                task_id=task_id)
+        except NotFoundError:
+            self.logger.error(
+                "Task {} is unknown to the cluster, no longer polling it"
+                .format(task_id))
+            with self._tasks_lock:
+                self._tasks.pop(task_id, None)
+        except:
+            self.logger.warning("Unable to poll task {}".format(task_id),
+                                exc_info=True)
+
+    def _task_status(self, task_id, task, status):
+        result = {
+            'task': task_id,
+            'operation': self.operation().value,
+            'index': task.index,
+            'running_time': monotonic() - task.started,
+        }
+        for field in _STATUS_FIELDS:
+            result[field] = status.get(field, 0)
+        done = sum(result[field] for field in _STATUS_FIELDS
+                   if field not in ('total', 'batches'))
+        result['progress'] = \
+            min(done / result['total'], 1.0) if result['total'] else 0.0
+        return result
+
+    def _task_progress(self, task_id, task, response):
+        result = self._task_status(
+            task_id, task, response.get('task', {}).get('status', {}))
+        result['completed'] = False
+        return result
+
+    def _task_completion(self, task_id, task, response):
+        # The final counters are in the response, the status may be stale
+        final = response.get('response') or \
+            response.get('task', {}).get('status', {})
+        result = self._task_status(task_id, task, final)
+        result['completed'] = True
+        result['progress'] = 1.0
+        result['failures'] = final.get('failures', [])
+        if 'error' in response:
+            result['error'] = response['error']
+        if result['failures'] or 'error' in result:
+            self.logger.error("Task {} completed with errors: {}".format(
+                task_id, result.get('error') or result['failures']))
+        else:
+            self.logger.info("Task {} completed".format(task_id))
+        return result
+
+    def tasks(self):
+        with self._tasks_lock:
+            return {'tasks': [{
+                'task': task_id,
+                'index': task.index,
+                'doc_type': task.doc_type,
+                'running_time': monotonic() - task.started,
+            } for task_id, task in self._tasks.items()]}
+
+    def _queue_depths(self):
+        depths = super()._queue_depths()
+        with self._tasks_lock:
+            depths['running_tasks'] = len(self._tasks)
+        return depths
@@ -1,11 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from threading import Event, Lock
+from time import monotonic
 
+from elasticsearch.exceptions import TransportError
 from nio.properties import ListProperty, SelectProperty, \
     PropertyHolder, StringProperty, Property, BoolProperty, \
-    VersionProperty
+    VersionProperty, IntProperty, ObjectProperty
+from nio.types import StringType
 
+from .aggregations import flatten_aggregations
+from .circuit_breaker import CircuitOpenError
 from .es_base import ESBase
-from . import evaluate_expression
+from . import evaluate_expression, static_value
 
 
 class Limitable():
@@ -13,16 +20,28 @@ class Limitable():
     """ A elasticsearch block mixin that allows you to limit results
 
     A limit of zero is useful to know the amount of items that can be
-    retrieved, subsequent calls can include a specific limit and an offset
+    retrieved, subsequent calls can include a specific limit and an offset.
+    When only the amount is wanted, ESFind's count mode is cheaper
     """
 
     size = Property(title='Size', default="")
     offset = Property(title='Offset', default="")
 
+    def __init__(self):
+        super().__init__()
+        self._size = None
+        self._offset = None
+
+    def configure(self, context):
+        super().configure(context)
+        self._size = static_value(self.size)
+        self._offset = static_value(self.offset)
+
     def query_args(self, signal=None):
         existing_args = super().query_args(signal)
-        size = self.size(signal)
-        offset = self.offset(signal)
+        size = self._size if self._size is not None else self.size(signal)
+        offset = self._offset if self._offset is not None \
+            else self.offset(signal)
         # Don't send size or offset if they are empty strings
         if size:
             existing_args['size'] = int(size)
@@ -65,7 +84,103 @@ class Sortable():
         return existing_args
 
 
-class ESFind(Limitable, Sortable, ESBase):
+class FieldSelection(PropertyHolder):
+    fetch_source = BoolProperty(title="Fetch _source?", default=True)
+    source_includes = ListProperty(StringType, title="_source Includes",
+                                   default=[])
+    source_excludes = ListProperty(StringType, title="_source Excludes",
+                                   default=[])
+    stored_fields = ListProperty(StringType, title="Stored Fields",
+                                 default=[])
+    docvalue_fields = ListProperty(StringType, title="Docvalue Fields",
+                                   default=[])
+    filter_path = ListProperty(StringType, title="Response Filter Path",
+                               default=[])
+
+
+class Filterable():
+
+    """ A elasticsearch block mixin that limits what each hit contains
+
+    Only the selected fields are fetched, and the response can be trimmed
+    down further with a filter_path.
+    """
+
+    fields = ObjectProperty(FieldSelection, title='Fields',
+                            default=FieldSelection(), advanced=True)
+
+    def __init__(self):
+        super().__init__()
+        self._field_args = {}
+        self._filter_path = []
+
+    def configure(self, context):
+        super().configure(context)
+        fields = self.fields()
+        self._field_args = {}
+        if not fields.fetch_source():
+            self._field_args['_source'] = False
+        elif fields.source_includes() or fields.source_excludes():
+            source = {}
+            if fields.source_includes():
+                source['includes'] = list(fields.source_includes())
+            if fields.source_excludes():
+                source['excludes'] = list(fields.source_excludes())
+            self._field_args['_source'] = source
+        if fields.stored_fields():
+            self._field_args['stored_fields'] = list(fields.stored_fields())
+        if fields.docvalue_fields():
+            self._field_args['docvalue_fields'] = \
+                list(fields.docvalue_fields())
+        self._filter_path = list(fields.filter_path())
+
+    def query_args(self, signal=None):
+        existing_args = super().query_args(signal)
+        existing_args.update(self._field_args)
+        return existing_args
+
+    def filter_args(self, *required, prefix=''):
+        """ The filter_path argument of a request, if one is configured
+
+        Params:
+            required: Paths the block needs, kept whatever the filter_path
+            prefix (str): Prepended to every path, i.e. 'responses.'
+
+        Returns:
+            args (dict): The filter_path kwarg to pass to the client
+        """
+        if not self._filter_path:
+            return {}
+        return {'filter_path': ','.join(
+            prefix + path for path in self._filter_path + list(required))}
+
+
+class QueryMode(Enum):
+    SEARCH = "search"
+    AGGREGATIONS = "aggregations"
+    COUNT = "count"
+
+
+class MultiSearchOptions(PropertyHolder):
+    enabled = BoolProperty(title="Use Multi Search API?", default=False)
+    max_searches = IntProperty(title="Max Searches per Request", default=100)
+
+
+class PagingMethod(Enum):
+    SCROLL = "scroll"
+    SEARCH_AFTER = "search_after"
+
+
+class StreamOptions(PropertyHolder):
+    enabled = BoolProperty(title="Stream Results?", default=False)
+    method = SelectProperty(PagingMethod, title="Paging Method",
+                            default=PagingMethod.SCROLL)
+    page_size = IntProperty(title="Page Size", default=1000)
+    scroll = StringProperty(title="Scroll Keep Alive", default="1m")
+    slices = IntProperty(title="Scroll Slices", default=1)
+
+
+class ESFind(Limitable, Sortable, Filterable, ESBase):
 
     """ A block for running `search` against a elasticsearch.
 
@@ -73,41 +188,438 @@ class ESFind(Limitable, Sortable, ESBase):
         condition (expression): A dictionary form of a search expression.
         This is an expression property that can evaluate to a dictionary
         or be a parseable JSON string
+        msearch (object): send the searches of a list of signals through
+            the _msearch API instead of one request per signal
+        stream (object): page through every match with scroll or
+            search_after, notifying the results of each page as it arrives
+        fields (object): the _source fields, stored fields and docvalue
+            fields to fetch, and a filter_path for the responses
+        mode (select): search notifies a signal per hit, aggregations runs
+            the aggregations expression without fetching any hit and
+            notifies a signal per leaf bucket
+        aggregations (expression): the aggs of the search in aggregations
+            mode, a dictionary or a parseable JSON string
+        terminate_after (int): in count mode, stop counting on each shard
+            once this many documents matched, 0 counts every match
 
     """
-    version = VersionProperty("0.1.0")
+    version = VersionProperty("1.0.0")
     condition = Property(
         title='Condition', default="{'match_all': {}}")
     pretty_results = BoolProperty(title='Pretty Results', default=True)
+    mode = SelectProperty(QueryMode, title='Query Mode',
+                          default=QueryMode.SEARCH)
+    aggregations = Property(title='Aggregations', default="{}")
+    terminate_after = IntProperty(title='Count Threshold per Shard',
+                                  default=0, advanced=True)
+    msearch = ObjectProperty(MultiSearchOptions, title='Multi Search Options',
+                             default=MultiSearchOptions(), advanced=True)
+    stream = ObjectProperty(StreamOptions, title='Streaming Options',
+                            default=StreamOptions(), advanced=True)
+
+    def __init__(self):
+        super().__init__()
+        self._condition = None
+        self._aggregations = None
+        self._scroll_ids = set()
+        self._scroll_lock = Lock()
+        # Throughput of each slice of the last sliced scroll
+        self._slice_stats = {}
+        self._stop_event = Event()
+
+    def configure(self, context):
+        super().configure(context)
+        # Literal conditions and aggregations are parsed once, they are
+        # only read when building each search body
+        self._condition = static_value(
+            self.condition, lambda value: evaluate_expression(value, None))
+        self._aggregations = static_value(
+            self.aggregations,
+            lambda value: evaluate_expression(value, None))
+        if self.mode() is QueryMode.AGGREGATIONS and \
+                self._aggregations == {}:
+            raise ValueError("Aggregations mode needs aggregations")
+
+    def start(self):
+        super().start()
+        self._stop_event.clear()
+
+    def stop(self):
+        self._stop_event.set()
+        with self._scroll_lock:
+            scroll_ids = list(self._scroll_ids)
+        for scroll_id in scroll_ids:
+            self._clear_scroll(scroll_id)
+        super().stop()
+
+    def process_signals(self, signals, input_id='default'):
+        if self.stream().enabled() and self.mode() is QueryMode.SEARCH:
+            self._stream_signals(signals)
+            return
+        if not self.msearch().enabled():
+            super().process_signals(signals, input_id)
+            return
+
+        output = self._multi_search(signals)
+        if output:
+            self.notify_signals(output)
 
     def execute_query(self, doc_type, signal):
-        condition = evaluate_expression(self.condition, signal)
-        self.logger.debug("Condition evaluated to: {}".format(condition))
+        search_params = self._build_search(doc_type, signal)
+        if not search_params:
+            return []
+        if self.mode() is QueryMode.COUNT:
+            self.logger.debug(
+                "Counting with params: {}".format(search_params))
+            return [self._count_result(self.timed_request(
+                self._search_target(search_params), self._es.count,
+                **search_params, params=self._count_args()))]
+        self.logger.debug("Searching with params: {}".format(search_params))
 
-        query_body = {"query": condition}
-        query_body.update(self.query_args(signal))
+        search_results = self.timed_request(
+            self._search_target(search_params), self._es.search,
+            **search_params, **self.filter_args('took', *self._result_paths()))
+        return self._search_results(search_results)
 
-        try:
-            index = self.index(signal)
-            if not index:
-                raise Exception("{} is an invalid index".format(index))
-        except:
-            self.logger.exception(
-                "Unable to determine index for {}".format(signal))
+    async def async_execute_query(self, doc_type, signal):
+        search_params = self._build_search(doc_type, signal)
+        if not search_params:
             return []
+        if self.mode() is QueryMode.COUNT:
+            self.logger.debug(
+                "Counting with params: {}".format(search_params))
+            return [self._count_result(await self.async_timed_request(
+                self._search_target(search_params), self._async_es.count,
+                **search_params, params=self._count_args()))]
+        self.logger.debug("Searching with params: {}".format(search_params))
+
+        search_results = await self.async_timed_request(
+            self._search_target(search_params), self._async_es.search,
+            **search_params, **self.filter_args('took', *self._result_paths()))
+        return self._search_results(search_results)
 
-        search_params = {
+    def _build_search(self, doc_type, signal):
+        """ Build the search parameters for a signal.
+
+        Returns:
+            search_params (dict): The index, doc_type and body to search
+                with, None if the index can't be determined
+        """
+        condition = self._condition
+        if condition is None:
+            condition = evaluate_expression(self.condition, signal)
+            self.logger.debug("Condition evaluated to: {}".format(condition))
+
+        query_body = {"query": condition}
+        if self.mode() is QueryMode.AGGREGATIONS:
+            # Only the buckets are wanted, hits would be fetched for nothing
+            query_body['aggs'] = self._aggregations \
+                if self._aggregations is not None \
+                else evaluate_expression(self.aggregations, signal)
+            if not query_body['aggs']:
+                raise ValueError("Aggregations evaluated to {!r}".format(
+                    query_body['aggs']))
+            query_body['size'] = 0
+        elif self.mode() is QueryMode.SEARCH:
+            query_body.update(self.query_args(signal))
+
+        index = self._evaluate_index(signal)
+        if not index:
+            return None
+
+        return {
             'index': index,
             'doc_type': doc_type,
             'body': query_body
         }
-        self.logger.debug("Searching with params: {}".format(search_params))
-
-        search_results = self._es.search(**search_params)
 
+    def _search_results(self, search_results):
+        if self.mode() is QueryMode.COUNT:
+            return [self._count_result(search_results)]
+        if self.mode() is QueryMode.AGGREGATIONS:
+            return flatten_aggregations(
+                (search_results or {}).get('aggregations', {}))
         if search_results and "hits" in search_results:
             return [self._process_fields(hit)
-                    for hit in search_results['hits']['hits']]
+                    for hit in self._hits(search_results)]
+
+    def _result_paths(self):
+        """ Paths the results are read from, kept whatever the filter_path """
+        if self.mode() is QueryMode.AGGREGATIONS:
+            return ('aggregations',)
+        if self.mode() is QueryMode.COUNT:
+            return ('hits.total',)
+        return ()
+
+    def _count_args(self):
+        # Passed to count as params, its client doesn't take terminate_after
+        if self.terminate_after() > 0:
+            return {'terminate_after': self.terminate_after()}
+        return {}
+
+    @staticmethod
+    def _count_result(response):
+        """ The count of a _count response, or of a search without hits """
+        response = response or {}
+        result = {'count': response.get('count',
+                                        response.get('hits', {}).get('total'))}
+        if 'terminated_early' in response:
+            result['terminated_early'] = response['terminated_early']
+        return result
+
+    @staticmethod
+    def _hits(response):
+        # A filter_path drops the hits key when nothing matches
+        return response.get('hits', {}).get('hits', [])
+
+    def _multi_search(self, signals):
+        """ Run the searches of every signal through the _msearch API.
+
+        Each response is enriched onto the signal that produced its search.
+        A search that fails only affects its own signal.
+
+        Returns:
+            signals (list): The output signals of every successful search
+        """
+        searches = []
+        for signal in signals:
+            doc_type = self._evaluate_doc_type(signal)
+            if not doc_type:
+                continue
+            try:
+                search_params = self._build_search(doc_type, signal)
+            except:
+                self.logger.exception(
+                    "Unable to build search for {}".format(signal))
+                continue
+            if search_params:
+                searches.append((signal, search_params))
+
+        output = []
+        max_searches = max(self.msearch().max_searches(), 1)
+        for start in range(0, len(searches), max_searches):
+            chunk = searches[start:start + max_searches]
+            body = []
+            for _, search_params in chunk:
+                body.append({'index': search_params['index'],
+                             'type': search_params['doc_type']})
+                body.append(self._msearch_body(search_params['body']))
+            self.logger.debug(
+                "Multi searching with {} searches".format(len(chunk)))
+            began = monotonic()
+            try:
+                responses = self.execute_with_retry(
+                    self._es.msearch, body=body, **self.filter_args(
+                        'took', 'error', 'status', *self._result_paths(),
+                        prefix='responses.'))['responses']
+            except CircuitOpenError:
+                self._circuit_open([signal for signal, _ in chunk])
+                continue
+            except:
+                self.logger.exception(
+                    "Multi search of {} searches failed".format(len(chunk)))
+                continue
+            latency = monotonic() - began
+            for (signal, search_params), response in zip(chunk, responses):
+                self._record_search(search_params, latency, response)
+                if 'error' in response:
+                    self.logger.error("Search failed for {}: {}".format(
+                        signal, response['error']))
+                    continue
+                output.extend(self.get_output_signal(result, signal)
+                              for result in
+                              self._search_results(response) or [])
+        return output
+
+    def _msearch_body(self, body):
+        """ The body of a search sent through _msearch
+
+        There's no multi count API, counts are sent as searches that fetch
+        no hits and read the total.
+        """
+        if self.mode() is not QueryMode.COUNT:
+            return body
+        body = dict(body, size=0)
+        body.update(self._count_args())
+        return body
+
+    def _stream_signals(self, signals):
+        for signal in signals:
+            doc_type = self._evaluate_doc_type(signal)
+            if not doc_type:
+                continue
+            try:
+                search_params = self._build_search(doc_type, signal)
+                if search_params:
+                    self._stream_search(search_params, signal)
+            except CircuitOpenError:
+                self._circuit_open([signal])
+            except:
+                self.logger.exception("Query failed")
+
+    def _stream_search(self, search_params, signal):
+        """ Page through every match of a search.
+
+        The results of each page are notified as soon as the page arrives,
+        so only one page is held in memory at a time. The size and offset
+        of the search are ignored, pages are sized by the stream options.
+        Scrolls can be split in several slices, only search_after streams
+        can't be sliced.
+        """
+        body = dict(search_params['body'])
+        body.pop('from', None)
+        body['size'] = self.stream().page_size()
+        search_params = dict(search_params, body=body)
+        slices = self.stream().slices()
+        if self.stream().method() is PagingMethod.SEARCH_AFTER:
+            self._notify_pages(self._search_after_pages(search_params), signal)
+        elif slices > 1:
+            self._sliced_scroll(search_params, signal, slices)
+        else:
+            self._notify_pages(self._scroll_pages(search_params), signal)
+
+    def _notify_pages(self, pages, signal):
+        """ Notify the results of each page, returning how many there were
+        """
+        count = 0
+        for hits in pages:
+            self.notify_signals([
+                self.get_output_signal(self._process_fields(hit), signal)
+                for hit in hits])
+            count += len(hits)
+        return count
+
+    def _sliced_scroll(self, search_params, signal, slices):
+        """ Split a scroll in slices and drain them in parallel.
+
+        Pages are notified by each worker as they arrive, so pages of
+        different slices are interleaved in the output.
+        """
+        with self._scroll_lock:
+            self._slice_stats = {}
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            for slice_id in range(slices):
+                executor.submit(self._scroll_slice,
+                                search_params, signal, slice_id, slices)
+
+    def _scroll_slice(self, search_params, signal, slice_id, slices):
+        body = dict(search_params['body'],
+                    slice={'id': slice_id, 'max': slices})
+        stats = {'slice': slice_id, 'documents': 0, 'elapsed': 0.0,
+                 'docs_per_sec': 0.0, 'failed': False}
+        with self._scroll_lock:
+            self._slice_stats[slice_id] = stats
+        began = monotonic()
+        try:
+            for hits in self._scroll_pages(dict(search_params, body=body)):
+                stats['documents'] += self._notify_pages([hits], signal)
+        except:
+            stats['failed'] = True
+            self.logger.exception(
+                "Slice {} of {} failed".format(slice_id, slices))
+        finally:
+            stats['elapsed'] = monotonic() - began
+            if stats['elapsed']:
+                stats['docs_per_sec'] = \
+                    stats['documents'] / stats['elapsed']
+        if not stats['failed']:
+            self.logger.info(
+                "Slice {} of {} streamed {} documents in {:.2f}s "
+                "({:.1f} docs/sec)".format(
+                    slice_id, slices, stats['documents'], stats['elapsed'],
+                    stats['docs_per_sec']))
+
+    def _scroll_pages(self, search_params):
+        # Without a sort, _doc is the cheapest order to scroll in
+        search_params['body'].setdefault('sort', ['_doc'])
+        keep_alive = self.stream().scroll()
+        target = self._search_target(search_params)
+        filter_args = self.filter_args('took', '_scroll_id')
+        response = self.execute_with_retry(
+            self.timed_request, target, self._es.search,
+            scroll=keep_alive, **search_params, **filter_args)
+        scroll_id = self._track_scroll(None, response.get('_scroll_id'))
+        try:
+            while not self._stop_event.is_set():
+                hits = self._hits(response)
+                if not hits:
+                    break
+                yield hits
+                response = self.execute_with_retry(
+                    self.timed_request, target, self._es.scroll,
+                    scroll_id=scroll_id, scroll=keep_alive, **filter_args)
+                scroll_id = self._track_scroll(
+                    scroll_id, response.get('_scroll_id'))
+        finally:
+            self._clear_scroll(scroll_id)
+
+    def _search_after_pages(self, search_params):
+        body = search_params['body']
+        # A unique tiebreaker makes sure no hit is skipped between pages
+        body['sort'] = list(body.get('sort', [])) + [{'_uid': 'asc'}]
+        target = self._search_target(search_params)
+        filter_args = self.filter_args('took', 'hits.hits.sort')
+        while not self._stop_event.is_set():
+            response = self.execute_with_retry(
+                self.timed_request, target, self._es.search,
+                **search_params, **filter_args)
+            hits = self._hits(response)
+            if not hits:
+                break
+            yield hits
+            if len(hits) < body['size']:
+                break
+            body['search_after'] = hits[-1]['sort']
+
+    @staticmethod
+    def _search_target(search_params):
+        return search_params['index'], search_params['doc_type']
+
+    def _record_search(self, search_params, latency, response):
+        """ Record the metrics of a search answered as part of a _msearch
+        """
+        error = None
+        if 'error' in response:
+            error = TransportError(response.get('status', 'N/A'),
+                                   response['error'])
+        self._metrics.record_request(
+            *self._search_target(search_params), latency=latency,
+            took=response.get('took'),
+            docs=len(self._hits(response)), error=error)
+
+    def _stats(self, reset=False):
+        stats = super()._stats(reset)
+        with self._scroll_lock:
+            stats['scroll_slices'] = [
+                dict(self._slice_stats[slice_id])
+                for slice_id in sorted(self._slice_stats)]
+        return stats
+
+    def _queue_depths(self):
+        depths = super()._queue_depths()
+        with self._scroll_lock:
+            depths['open_scrolls'] = len(self._scroll_ids)
+        return depths
+
+    def _track_scroll(self, old_scroll_id, new_scroll_id):
+        if not new_scroll_id:
+            return old_scroll_id
+        with self._scroll_lock:
+            self._scroll_ids.discard(old_scroll_id)
+            self._scroll_ids.add(new_scroll_id)
+        return new_scroll_id
+
+    def _clear_scroll(self, scroll_id):
+        """ Release a scroll context, if it's still open """
+        with self._scroll_lock:
+            if scroll_id not in self._scroll_ids:
+                return
+            self._scroll_ids.discard(scroll_id)
+        try:
+            self._es.clear_scroll(scroll_id=scroll_id)
+        except:
+            self.logger.warning(
+                "Unable to clear scroll {}".format(scroll_id), exc_info=True)
 
     def _process_fields(self, result_dict):
         """ elasticsearch return fields starting with underscore,
@@ -123,12 +635,11 @@ class ESFind(Limitable, Sortable, ESBase):
         if self.pretty_results() and '_source' in result_dict:
             # If they want pretty results, just give them the source
             # which will likely represent a signal
-            result_dict = result_dict['_source']
-        else:
-            # No pretty results means give them everything, however, let's
-            # get rid of the leading underscores first
-            result_dict = {
-                key if not key.startswith('_') else key[1:]: value
-                for key, value in result_dict.items()}
+            return result_dict['_source']
 
+        # No pretty results means give them everything, however, let's
+        # get rid of the leading underscores first. Hits are decoded for
+        # us alone, so they are renamed in place rather than copied
+        for key in [key for key in result_dict if key.startswith('_')]:
+            result_dict[key[1:]] = result_dict.pop(key)
         return result_dict
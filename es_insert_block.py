@@ -1,41 +1,321 @@
-from nio.properties import BoolProperty, VersionProperty
+from elasticsearch.exceptions import ConflictError
+from nio.modules.scheduler import Job
+from nio.properties import BoolProperty, VersionProperty, ObjectProperty
 
-from .es_base import ESBase
+from .buffered_writer import BufferedWriter, BufferOptions, BufferFullError
+from .document_ids import DocumentIdOptions, IdSource, OpType, content_hash
+from .es_base import ESBase, Bulkable, BulkItem
+from .index_routing import IndexRouting, IndexRoutingOptions, \
+    TimeIndexResolver
+from .retry_policy import is_retryable
+from .spill_journal import Spillable
 
 
-class ESInsert(ESBase):
+class ESInsert(Spillable, Bulkable, ESBase):
 
     """ A block for recording signals or other such
     system-external store.
 
     Properties:
         with_type (str): include the signal type in the record?
+        bulk (object): send signals through the _bulk API, grouped by
+            their evaluated index and type
+        buffer (object): queue signals and write them in bulk from a
+            background thread, flushing on size or time
+        index_routing (object): write to time-partitioned indices named
+            after the signal time or the ingest time, or to a rollover
+            alias, instead of evaluating the index of every signal
+        document_id (object): give documents an id from an expression or
+            from a hash of their content, so a resent document replaces
+            (index) or is not written again (create) instead of being
+            duplicated
+        spill (object): append documents that can't be written while the
+            cluster is unavailable, or that overflow the buffer, to files
+            on disk and replay them once it's back
 
     """
-    version = VersionProperty("0.1.0")
+    version = VersionProperty("1.0.0")
     with_type = BoolProperty(
         title='Include the type of logged signals?',
         default=False,
         visible=False)
+    buffer = ObjectProperty(BufferOptions, title='Buffer Options',
+                            default=BufferOptions(), advanced=True)
+    index_routing = ObjectProperty(IndexRoutingOptions,
+                                   title='Index Routing',
+                                   default=IndexRoutingOptions(),
+                                   advanced=True)
+    document_id = ObjectProperty(DocumentIdOptions, title='Document Ids',
+                                 default=DocumentIdOptions(), advanced=True)
 
-    def execute_query(self, doc_type, signal):
-        if self.with_type():
-            with_type = "_type"
+    def __init__(self):
+        super().__init__()
+        self._writer = None
+        self._resolve_index = None
+        self._rollover_job = None
+
+    def configure(self, context):
+        super().configure(context)
+        routing = self.index_routing()
+        if routing.mode() is IndexRouting.TIME:
+            self._resolve_index = TimeIndexResolver(
+                routing.base_name(), routing.date_pattern(),
+                routing.time_field())
+        elif routing.mode() is IndexRouting.ROLLOVER_ALIAS:
+            alias = routing.base_name()
+            self._resolve_index = lambda signal: alias
         else:
-            with_type = None
-        body = signal.to_dict(with_type=with_type)
+            self._resolve_index = None
+
+    def start(self):
+        super().start()
+        routing = self.index_routing()
+        if routing.mode() is IndexRouting.ROLLOVER_ALIAS:
+            self._bootstrap_alias(routing.base_name())
+            interval = routing.rollover_interval()
+            if interval.total_seconds() > 0 and self._rollover_conditions():
+                self._rollover_job = Job(self._rollover, interval, True)
+        if self.buffer().enabled():
+            self._writer = BufferedWriter(
+                self._flush_buffer,
+                max_queue_size=self.buffer().max_queue_size(),
+                flush_count=self.buffer().flush_count(),
+                flush_bytes=self.buffer().flush_bytes(),
+                flush_interval=self.buffer().flush_interval().total_seconds(),
+                backpressure=self.buffer().backpressure(),
+                logger=self.logger,
+                on_drop=self._buffer_dropped if self._journal else None)
+            self._writer.start()
+
+    def stop(self):
+        if self._rollover_job:
+            self._rollover_job.cancel()
+            self._rollover_job = None
+        if self._writer:
+            # Anything still buffered gets written before we stop
+            self._writer.stop()
+            self._writer = None
+        super().stop()
+
+    def process_signals(self, signals, input_id='default'):
+        if self._writer:
+            self._buffer_signals(signals)
+            return
+        if not self.bulk().enabled():
+            super().process_signals(signals, input_id)
+            return
+
+        output = self.send_bulk_items(self._build_bulk_items(signals),
+                                      wait=False)
+        if output:
+            self.notify_signals(output)
+
+    def execute_query(self, doc_type, signal):
+        body = self._build_document(signal)
+        index = self._evaluate_index(signal)
+        if not index:
+            return []
+
+        doc_id = self._document_id(body, signal)
+
+        self.logger.debug(
+            "Inserting {} to: {}, type: {}".format(body, index, doc_type))
+
         try:
-            index = self.index(signal)
-            if not index:
-                raise Exception("{} is an invalid index".format(index))
-        except:
-            self.logger.exception(
-                "Unable to determine index for {}".format(signal))
+            result = self.timed_request(
+                (index, doc_type), self._es.index, index, doc_type, body,
+                **self._index_args(doc_id))
+        except ConflictError:
+            if not self._already_created(doc_id):
+                raise
+            return [{'id': doc_id}]
+        if result and "_id" in result:
+            return [{'id': result["_id"]}]
+
+    async def async_execute_query(self, doc_type, signal):
+        body = self._build_document(signal)
+        index = self._evaluate_index(signal)
+        if not index:
             return []
 
+        doc_id = self._document_id(body, signal)
+
         self.logger.debug(
             "Inserting {} to: {}, type: {}".format(body, index, doc_type))
 
-        result = self._es.index(index, doc_type, body)
+        try:
+            result = await self.async_timed_request(
+                (index, doc_type), self._async_es.index, index, doc_type,
+                body, **self._index_args(doc_id))
+        except ConflictError:
+            if not self._already_created(doc_id):
+                raise
+            return [{'id': doc_id}]
         if result and "_id" in result:
             return [{'id': result["_id"]}]
+
+    def _document_id(self, document, signal):
+        """ The id of a document, None to let Elasticsearch pick one """
+        ids = self.document_id()
+        if ids.source() is IdSource.EXPRESSION:
+            doc_id = ids.expression(signal)
+            if doc_id is None or doc_id == '':
+                raise ValueError(
+                    "Document id evaluated to {!r}".format(doc_id))
+            return str(doc_id)
+        if ids.source() is IdSource.CONTENT_HASH:
+            return content_hash(document, ids.hash_fields(),
+                                ids.hash_algorithm())
+
+    def _index_args(self, doc_id):
+        args = {}
+        if doc_id is not None:
+            args['id'] = doc_id
+        if self.document_id().op_type() is OpType.CREATE:
+            args['op_type'] = OpType.CREATE.value
+        return args
+
+    def _already_created(self, doc_id):
+        """ Whether a conflict means the document was written already
+
+        Creating a document with an id that exists fails with a conflict,
+        which is what happens when a request that succeeded is resent.
+        """
+        return doc_id is not None and \
+            self.document_id().op_type() is OpType.CREATE
+
+    def _query_failed(self, signal, doc_type, exc):
+        if self._journal and is_retryable(exc):
+            self.logger.warning("Query failed, spilling {}".format(signal),
+                                exc_info=True)
+            self._spill_items(self._build_bulk_items([signal]))
+            return
+        super()._query_failed(signal, doc_type, exc)
+
+    def _circuit_open(self, signals):
+        if self._journal:
+            self._spill_items(self._build_bulk_items(signals))
+            return
+        super()._circuit_open(signals)
+
+    def _bulk_item_written(self, result):
+        return result.get('status') == 409 and \
+            self._already_created(result.get('_id'))
+
+    def _bulk_items_diverted(self, items):
+        if not self._spill_items(items):
+            super()._bulk_items_diverted(items)
+
+    def _bulk_items_failed(self, failed):
+        if self._journal:
+            self._spill_items([item for item, result in failed
+                               if self.should_spill(result)])
+            failed = [(item, result) for item, result in failed
+                      if not self.should_spill(result)]
+        super()._bulk_items_failed(failed)
+
+    def _spill_items(self, items):
+        return self.spill_actions(
+            [(item.index, item.doc_type, item.action) for item in items])
+
+    def _evaluate_index(self, signal):
+        if self._resolve_index is None:
+            return super()._evaluate_index(signal)
+        try:
+            return self._resolve_index(signal)
+        except:
+            self.logger.exception(
+                "Unable to determine index for {}".format(signal))
+
+    def _bootstrap_alias(self, alias):
+        """ Create the first index behind a rollover alias if it's missing
+
+        Writing to a missing alias would create an index with its name,
+        which can't be rolled over.
+        """
+        try:
+            if not self._es.indices.exists_alias(name=alias):
+                self._es.indices.create(
+                    index="{}-000001".format(alias),
+                    body={'aliases': {alias: {}}})
+                self.logger.info("Created rollover alias {}".format(alias))
+        except:
+            self.logger.exception(
+                "Unable to bootstrap rollover alias {}".format(alias))
+
+    def _rollover_conditions(self):
+        routing = self.index_routing()
+        conditions = {}
+        if routing.rollover_max_age():
+            conditions['max_age'] = routing.rollover_max_age()
+        if routing.rollover_max_docs() > 0:
+            conditions['max_docs'] = routing.rollover_max_docs()
+        return conditions
+
+    def _rollover(self):
+        alias = self.index_routing().base_name()
+        try:
+            response = self._es.indices.rollover(
+                alias=alias, body={'conditions': self._rollover_conditions()})
+        except:
+            self.logger.exception("Unable to roll {} over".format(alias))
+            return
+        if response.get('rolled_over'):
+            self.logger.info("Rolled {} over from {} to {}".format(
+                alias, response.get('old_index'), response.get('new_index')))
+
+    def _queue_depths(self):
+        depths = super()._queue_depths()
+        if self._writer:
+            depths.update({
+                'buffered': self._writer.depth,
+                'buffer_dropped': self._writer.dropped,
+                'buffer_rejected': self._writer.rejected,
+            })
+        return depths
+
+    def _build_document(self, signal):
+        if self.with_type():
+            with_type = "_type"
+        else:
+            with_type = None
+        return signal.to_dict(with_type=with_type)
+
+    def _buffer_signals(self, signals):
+        for item in self._build_bulk_items(signals):
+            try:
+                self._writer.put(item, len(item.action.encode('utf-8')))
+            except BufferFullError:
+                if not self._spill_items([item]):
+                    self.logger.warning(
+                        "Buffer is full, rejecting {}".format(item.signal))
+
+    def _buffer_dropped(self, item):
+        self._spill_items([item])
+
+    def _flush_buffer(self, items):
+        output = self.send_bulk_items(items)
+        if output:
+            self.notify_signals(output)
+
+    def _build_bulk_items(self, signals):
+        items = []
+        for signal in signals:
+            doc_type = self._evaluate_doc_type(signal)
+            if not doc_type:
+                continue
+            index = self._evaluate_index(signal)
+            if not index:
+                continue
+            document = self._build_document(signal)
+            try:
+                doc_id = self._document_id(document, signal)
+            except:
+                self.logger.exception(
+                    "Unable to determine id for {}".format(signal))
+                continue
+            metadata = {'_id': doc_id} if doc_id is not None else {}
+            action = self.bulk_action(
+                self.document_id().op_type().value, document, **metadata)
+            items.append(BulkItem(signal, index, doc_type, action))
+        return items
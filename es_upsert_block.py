@@ -0,0 +1,162 @@
+from enum import Enum
+
+from nio.properties import SelectProperty, PropertyHolder, StringProperty, \
+    Property, BoolProperty, VersionProperty, IntProperty, ObjectProperty
+
+from .es_base import ESBase, Bulkable, BulkItem
+from . import evaluate_expression, static_value
+
+
+class UpdateType(Enum):
+    DOC = "doc"
+    SCRIPT = "script"
+
+
+class ScriptOptions(PropertyHolder):
+    source = StringProperty(title="Script", default="")
+    lang = StringProperty(title="Language", default="painless")
+    params = Property(title="Parameters", default="{}")
+
+
+class ESUpsert(Bulkable, ESBase):
+
+    """ A block for updating documents in place, creating them if missing.
+
+    Only the changes are sent, either as a partial document merged into
+    the stored one or as a script run against it, so keeping a document
+    current takes no read and no full rewrite.
+
+    Properties:
+        doc_id (expression): The id of the document to update
+        update_type (select): merge a partial doc, or run a script
+        doc (expression): The partial document, a dictionary or a
+            parseable JSON string, the whole signal when empty
+        script (object): The inline script and its parameters, an
+            expression evaluated against each signal
+        doc_as_upsert (bool): create the document from the doc when it's
+            missing, or from the doc in script mode
+        retry_on_conflict (int): how many times Elasticsearch retries an
+            update that raced with another one
+        bulk (object): send the updates through the _bulk API, grouped by
+            their evaluated index and type
+
+    """
+    version = VersionProperty("0.1.0")
+    doc_id = Property(title='Document Id', default="{{ $id }}")
+    update_type = SelectProperty(UpdateType, title='Update Type',
+                                 default=UpdateType.DOC)
+    doc = Property(title='Partial Document', default="")
+    script = ObjectProperty(ScriptOptions, title='Script',
+                            default=ScriptOptions())
+    doc_as_upsert = BoolProperty(title='Upsert Missing Documents?',
+                                 default=True)
+    retry_on_conflict = IntProperty(title='Retries on Conflict', default=3)
+
+    def __init__(self):
+        super().__init__()
+        self._params = None
+
+    def configure(self, context):
+        super().configure(context)
+        self._params = static_value(
+            self.script().params,
+            lambda value: evaluate_expression(value, None))
+
+    def process_signals(self, signals, input_id='default'):
+        if not self.bulk().enabled():
+            super().process_signals(signals, input_id)
+            return
+
+        output = self.send_bulk_items(self._build_update_items(signals),
+                                      wait=False)
+        if output:
+            self.notify_signals(output)
+
+    def execute_query(self, doc_type, signal):
+        index = self._evaluate_index(signal)
+        if not index:
+            return []
+        doc_id = self._evaluate_id(signal)
+        body = self._build_update(signal)
+
+        self.logger.debug("Updating {} in: {}, type: {} with {}".format(
+            doc_id, index, doc_type, body))
+
+        result = self.timed_request(
+            (index, doc_type), self._es.update, index, doc_type, doc_id,
+            body=body, **self._update_args())
+        if result and "_id" in result:
+            return [{'id': result["_id"], 'result': result.get('result')}]
+
+    async def async_execute_query(self, doc_type, signal):
+        index = self._evaluate_index(signal)
+        if not index:
+            return []
+        doc_id = self._evaluate_id(signal)
+        body = self._build_update(signal)
+
+        self.logger.debug("Updating {} in: {}, type: {} with {}".format(
+            doc_id, index, doc_type, body))
+
+        result = await self.async_timed_request(
+            (index, doc_type), self._async_es.update, index, doc_type,
+            doc_id, body=body, **self._update_args())
+        if result and "_id" in result:
+            return [{'id': result["_id"], 'result': result.get('result')}]
+
+    def _evaluate_id(self, signal):
+        doc_id = self.doc_id(signal)
+        if doc_id is None or doc_id == '':
+            raise ValueError("Document id evaluated to {!r}".format(doc_id))
+        return str(doc_id)
+
+    def _update_args(self):
+        if self.retry_on_conflict() > 0:
+            return {'retry_on_conflict': self.retry_on_conflict()}
+        return {}
+
+    def _build_doc(self, signal):
+        if not self.doc.value:
+            return signal.to_dict()
+        return evaluate_expression(self.doc, signal)
+
+    def _build_update(self, signal):
+        """ The body of the update of a signal's document """
+        if self.update_type() is UpdateType.SCRIPT:
+            params = self._params if self._params is not None \
+                else evaluate_expression(self.script().params, signal)
+            body = {'script': {'inline': self.script().source(),
+                               'lang': self.script().lang(),
+                               'params': params}}
+            if self.doc_as_upsert():
+                body['upsert'] = self._build_doc(signal)
+            return body
+        body = {'doc': self._build_doc(signal)}
+        if self.doc_as_upsert():
+            body['doc_as_upsert'] = True
+        return body
+
+    def _build_update_items(self, signals):
+        items = []
+        for signal in signals:
+            doc_type = self._evaluate_doc_type(signal)
+            if not doc_type:
+                continue
+            index = self._evaluate_index(signal)
+            if not index:
+                continue
+            try:
+                metadata = {'_id': self._evaluate_id(signal)}
+                body = self._build_update(signal)
+            except:
+                self.logger.exception(
+                    "Unable to build the update of {}".format(signal))
+                continue
+            if self.retry_on_conflict() > 0:
+                metadata['_retry_on_conflict'] = self.retry_on_conflict()
+            action = self.bulk_action('update', body, **metadata)
+            items.append(BulkItem(signal, index, doc_type, action))
+        return items
+
+    def _bulk_item_result(self, result):
+        return {'id': result['_id'], 'result': result.get('result')}
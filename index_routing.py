@@ -0,0 +1,111 @@
+from datetime import datetime, timezone
+from enum import Enum
+from time import time
+
+from nio.properties import PropertyHolder, SelectProperty, StringProperty, \
+    IntProperty, TimeDeltaProperty
+
+
+class IndexRouting(Enum):
+    EXPRESSION = "expression"
+    TIME = "time"
+    ROLLOVER_ALIAS = "rollover_alias"
+
+
+class IndexRoutingOptions(PropertyHolder):
+    mode = SelectProperty(IndexRouting, title="Routing",
+                          default=IndexRouting.EXPRESSION)
+    base_name = StringProperty(title="Base Name / Alias", default="nio-")
+    date_pattern = StringProperty(title="Date Pattern", default="%Y.%m.%d")
+    time_field = StringProperty(title="Time Field (empty for ingest time)",
+                                default="")
+    rollover_max_age = StringProperty(title="Rollover Max Age",
+                                      default="1d")
+    rollover_max_docs = IntProperty(title="Rollover Max Docs", default=0)
+    rollover_interval = TimeDeltaProperty(title="Rollover Check Interval",
+                                          default={"minutes": 5})
+
+
+# The smallest time unit each strftime directive depends on, in seconds
+_DIRECTIVE_SECONDS = {
+    'f': 1, 'S': 1, 's': 1, 'c': 1, 'X': 1, 'T': 1,
+    'M': 60, 'R': 60,
+    'H': 3600, 'I': 3600, 'p': 3600, 'k': 3600, 'l': 3600,
+}
+_DAY = 86400
+
+
+def bucket_seconds(date_pattern):
+    """ The length of the time buckets sharing a name with a date pattern
+
+    Names only depend on the day for anything coarser than an hour, weeks,
+    months and years are bucketed by day too.
+    """
+    seconds = _DAY
+    directives = date_pattern.split('%')[1:]
+    for directive in directives:
+        # Skip the - and # flags of some platforms
+        directive = directive.lstrip('-#')
+        if directive:
+            seconds = min(seconds, _DIRECTIVE_SECONDS.get(directive[0], _DAY))
+    return seconds
+
+
+def to_timestamp(value):
+    """ Seconds since the epoch of a datetime, a number or an ISO string
+
+    Numbers larger than what seconds could be are taken as milliseconds,
+    the way Elasticsearch stores dates. Naive datetimes are taken as UTC.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value / 1000 if value > 1e11 else value
+    raise ValueError("{!r} is not a time".format(value))
+
+
+class TimeIndexResolver(object):
+
+    """ Names the time-partitioned index a signal belongs to
+
+    The name is the base name followed by the UTC time of the signal,
+    formatted with a date pattern. Formatting is only done once per time
+    bucket, i.e. once a day for daily indices, names are cached after that.
+    """
+
+    def __init__(self, base_name, date_pattern, time_field=None,
+                 max_cached=1024):
+        """ Create a new resolver
+
+        Args:
+            base_name (str): Prefix of every index name, i.e. 'logs-'
+            date_pattern (str): strftime pattern of the time, i.e. '%Y.%m.%d'
+            time_field (str): Signal attribute holding the time, the
+                current time is used when empty
+            max_cached (int): Number of names to keep
+        """
+        self.base_name = base_name
+        self.date_pattern = date_pattern
+        self.time_field = time_field
+        self.max_cached = max_cached
+        self._step = bucket_seconds(date_pattern)
+        self._names = {}
+
+    def __call__(self, signal):
+        if self.time_field:
+            timestamp = to_timestamp(getattr(signal, self.time_field))
+        else:
+            timestamp = time()
+        bucket = int(timestamp // self._step)
+        name = self._names.get(bucket)
+        if name is None:
+            name = self.base_name + datetime.fromtimestamp(
+                bucket * self._step, timezone.utc).strftime(self.date_pattern)
+            if len(self._names) >= self.max_cached:
+                self._names.clear()
+            self._names[bucket] = name
+        return name
@@ -0,0 +1,84 @@
+from ast import literal_eval
+from collections import OrderedDict
+from threading import Lock
+
+
+class LiteralCache(object):
+
+    """ Parses Python literals, remembering the most recent results
+
+    Rendered conditions often repeat, so parsing each distinct string once
+    saves a full parse per signal. Strings that aren't literals are
+    remembered too, and raise the same way every time.
+
+    Parsed values are copied on the way out, callers can modify what they
+    get without altering the cache.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def parse(self, string):
+        """ The value of a literal, as ast.literal_eval would return it
+
+        Raises:
+            ValueError: If the string isn't a literal
+        """
+        with self._lock:
+            try:
+                value = self._values[string]
+                self._values.move_to_end(string)
+                self._hits += 1
+            except KeyError:
+                value = None
+                self._misses += 1
+        if value is None:
+            try:
+                value = (True, literal_eval(string))
+            except Exception as e:
+                value = (False, e)
+            with self._lock:
+                self._values[string] = value
+                if len(self._values) > self.max_size:
+                    self._values.popitem(last=False)
+        parsed, result = value
+        if not parsed:
+            raise ValueError(
+                "{!r} is not a literal: {}".format(string, result))
+        return _copy(result)
+
+    def stats(self):
+        """ The hits, misses and size of the cache """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0,
+                'size': len(self._values),
+                'max_size': self.max_size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._hits = 0
+            self._misses = 0
+
+
+def _copy(value):
+    # Literals are only made of these containers and immutable scalars,
+    # which is much cheaper to walk than a deepcopy
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    if isinstance(value, set):
+        return set(value)
+    if isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    return value
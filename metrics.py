@@ -0,0 +1,177 @@
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+from nio.properties import PropertyHolder, BoolProperty, TimeDeltaProperty
+
+from .retry_policy import RETRYABLE_STATUSES
+
+
+class MetricsOptions(PropertyHolder):
+    report_interval = TimeDeltaProperty(title="Report Interval",
+                                        default={"seconds": 0})
+    reset_on_report = BoolProperty(title="Reset After Each Report?",
+                                   default=True)
+
+
+class Histogram(object):
+
+    """ Percentiles of the most recent samples of a value
+
+    Only the last max_samples samples are kept, so percentiles describe
+    recent behavior and memory stays bounded.
+    """
+
+    def __init__(self, max_samples=1000):
+        self._samples = deque(maxlen=max_samples)
+
+    def add(self, value):
+        self._samples.append(value)
+
+    def extend(self, other):
+        self._samples.extend(other._samples)
+
+    def summary(self):
+        if not self._samples:
+            return {}
+        samples = sorted(self._samples)
+        return {
+            'p50': self._percentile(samples, 0.5),
+            'p95': self._percentile(samples, 0.95),
+            'p99': self._percentile(samples, 0.99),
+            'max': samples[-1],
+        }
+
+    @staticmethod
+    def _percentile(samples, fraction):
+        # Nearest rank percentile
+        return samples[max(int(round(fraction * len(samples))) - 1, 0)]
+
+
+class TargetMetrics(object):
+
+    """ The counters and histograms of a single (index, doc_type) """
+
+    def __init__(self, max_samples):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.rejections = 0
+        self.docs = 0
+        self.bytes = 0
+        self.latency = Histogram(max_samples)
+        self.took = Histogram(max_samples)
+        self.bulk_size = Histogram(max_samples)
+
+    def merge(self, other):
+        for counter in ('requests', 'errors', 'retries', 'rejections',
+                        'docs', 'bytes'):
+            setattr(self, counter, getattr(self, counter) +
+                    getattr(other, counter))
+        for histogram in ('latency', 'took', 'bulk_size'):
+            getattr(self, histogram).extend(getattr(other, histogram))
+
+    def summary(self, elapsed):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'rejections': self.rejections,
+            'docs': self.docs,
+            'bytes': self.bytes,
+            'docs_per_sec': self.docs / elapsed if elapsed else 0,
+            'bytes_per_sec': self.bytes / elapsed if elapsed else 0,
+            'latency_ms': self.latency.summary(),
+            'took_ms': self.took.summary(),
+            'bulk_size': self.bulk_size.summary(),
+        }
+
+
+class Metrics(object):
+
+    """ Runtime performance metrics of a block, per index and doc_type
+
+    Recording is thread safe. Rates are computed over the time since the
+    metrics were created or last reset.
+    """
+
+    def __init__(self, max_samples=1000):
+        self._max_samples = max_samples
+        self._lock = Lock()
+        self._targets = {}
+        self._since = monotonic()
+
+    def record_request(self, index, doc_type, latency, took=None, docs=0,
+                       sent_bytes=0, error=None):
+        """ Record a request sent to the cluster
+
+        Args:
+            index (str): The index of the request
+            doc_type (str): The type of the request
+            latency (float): Seconds the request took, as seen by the block
+            took (int): Milliseconds the request took, according to the
+                server
+            docs (int): Number of documents written or read
+            sent_bytes (int): Size of the request body
+            error (Exception): The error the request failed with, if any
+        """
+        with self._lock:
+            target = self._target(index, doc_type)
+            target.requests += 1
+            target.latency.add(latency * 1000)
+            if took is not None:
+                target.took.add(took)
+            target.docs += docs
+            target.bytes += sent_bytes
+            if error is not None:
+                target.errors += 1
+                if getattr(error, 'status_code', None) in RETRYABLE_STATUSES:
+                    target.rejections += 1
+
+    def record_bulk(self, index, doc_type, size):
+        """ Record the number of actions of a bulk request """
+        with self._lock:
+            self._target(index, doc_type).bulk_size.add(size)
+
+    def record_retry(self, index, doc_type, count=1):
+        with self._lock:
+            self._target(index, doc_type).retries += count
+
+    def record_rejections(self, index, doc_type, count):
+        """ Record documents rejected by a request that succeeded """
+        with self._lock:
+            self._target(index, doc_type).rejections += count
+
+    def snapshot(self, reset=False):
+        """ Summarize the metrics recorded so far
+
+        Args:
+            reset (bool): Start recording from scratch afterwards
+
+        Returns:
+            metrics (dict): The totals and a summary per index and doc_type
+        """
+        with self._lock:
+            elapsed = monotonic() - self._since
+            total = TargetMetrics(
+                self._max_samples * max(len(self._targets), 1))
+            for target in self._targets.values():
+                total.merge(target)
+            snapshot = {
+                'elapsed': elapsed,
+                'total': total.summary(elapsed),
+                'targets': [dict(target.summary(elapsed),
+                                 index=index, doc_type=doc_type)
+                            for (index, doc_type), target in
+                            self._targets.items()],
+            }
+            if reset:
+                self._targets = {}
+                self._since = monotonic()
+        return snapshot
+
+    def _target(self, index, doc_type):
+        key = (index, doc_type)
+        if key not in self._targets:
+            self._targets[key] = TargetMetrics(self._max_samples)
+        return self._targets[key]
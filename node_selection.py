@@ -0,0 +1,48 @@
+from enum import Enum
+from itertools import count
+from threading import Lock
+
+from elasticsearch.connection_pool import ConnectionSelector
+
+from .connection import RetryAfterConnection
+
+
+class InFlightConnection(RetryAfterConnection):
+
+    """ A connection that keeps track of its requests in flight """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self._in_flight_lock = Lock()
+
+    def perform_request(self, *args, **kwargs):
+        with self._in_flight_lock:
+            self.in_flight += 1
+        try:
+            return super().perform_request(*args, **kwargs)
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
+
+
+class LeastInFlightSelector(ConnectionSelector):
+
+    """ Select the live connection with the fewest requests in flight
+
+    Ties are broken round-robin so idle nodes share the load evenly.
+    """
+
+    def __init__(self, opts):
+        super().__init__(opts)
+        self._counter = count()
+
+    def select(self, connections):
+        start = next(self._counter) % len(connections)
+        rotated = connections[start:] + connections[:start]
+        return min(rotated, key=lambda c: getattr(c, 'in_flight', 0))
+
+
+class NodeSelector(Enum):
+    ROUND_ROBIN = "round_robin"
+    LEAST_IN_FLIGHT = "least_in_flight"
@@ -0,0 +1,101 @@
+from random import uniform
+from threading import Event
+
+from elasticsearch.exceptions import TransportError, ConnectionError, \
+    SSLError
+from nio.block.mixins.retry.strategy import BackoffStrategy
+
+
+# Statuses meaning the cluster is overloaded, not that the request is bad
+RETRYABLE_STATUSES = (429, 503)
+
+
+def is_retryable(exc):
+    """ Whether a failed request is worth retrying
+
+    Only transport failures and responses telling us the cluster is busy
+    are retried, any other error would just fail again.
+    """
+    if isinstance(exc, SSLError):
+        return False
+    if isinstance(exc, ConnectionError):
+        return True
+    return isinstance(exc, TransportError) and \
+        exc.status_code in RETRYABLE_STATUSES
+
+
+def retry_after(exc):
+    """ The delay requested by the server through Retry-After, if any """
+    try:
+        return max(float(getattr(exc, 'retry_after', None)), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+
+    """ Decides whether and when a failed request is retried
+
+    Retries use an exponential backoff with full jitter: retry n waits a
+    random time between 0 and multiplier * 2 ** (n - 1) seconds, unless the
+    server asked for a specific delay with Retry-After.
+    """
+
+    def __init__(self, max_retry=5, multiplier=1, indefinite=False):
+        self.max_retry = max_retry
+        self.multiplier = multiplier
+        self.indefinite = indefinite
+
+    def can_retry(self, retry_num):
+        """ Whether retry number retry_num is allowed, whatever the error """
+        if self.max_retry >= 0 and retry_num > self.max_retry:
+            return self.indefinite
+        return True
+
+    def should_retry(self, retry_num, exc):
+        """ Whether to attempt retry number retry_num after exc """
+        return is_retryable(exc) and self.can_retry(retry_num)
+
+    def delay(self, retry_num, exc=None):
+        """ Seconds to wait before attempting retry number retry_num """
+        requested = retry_after(exc)
+        if requested is not None:
+            return requested
+        if self.max_retry >= 0:
+            retry_num = min(retry_num, self.max_retry)
+        return uniform(0, self.multiplier * 2 ** (max(retry_num, 1) - 1))
+
+
+class ErrorAwareBackoff(BackoffStrategy):
+
+    """ A backoff strategy for the Retry mixin based on a RetryPolicy
+
+    Used by the requests that can't be rescheduled, which wait on their
+    thread between retries: multi searches, streamed scroll and
+    search_after pages, and the bulk requests of the buffer's writer and
+    of the spill replay. Waiting can be interrupted with the stop event.
+    """
+
+    def __init__(self, stop_event=None, **kwargs):
+        super().__init__(**kwargs)
+        self.policy = RetryPolicy(self.max_retry, self.multiplier,
+                                  self.indefinite)
+        self.stop_event = stop_event or Event()
+        self.exc = None
+
+    def request_failed(self, exc):
+        super().request_failed(exc)
+        self.exc = exc
+
+    def should_retry(self):
+        if self.stop_event.is_set():
+            return False
+        if not is_retryable(self.exc):
+            self.logger.warning(
+                "Not retrying, {} is not a retryable error".format(
+                    type(self.exc).__name__))
+            return False
+        return self.policy.can_retry(self.retry_num)
+
+    def wait_for_retry(self):
+        self.stop_event.wait(self.policy.delay(self.retry_num, self.exc))
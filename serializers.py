@@ -0,0 +1,102 @@
+from base64 import b64encode
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from importlib import import_module
+from uuid import UUID
+import json
+
+from elasticsearch.compat import string_types
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer as ESJSONSerializer
+
+
+class JSONLibrary(Enum):
+    AUTO = "auto"
+    ORJSON = "orjson"
+    STDLIB = "json"
+
+
+# The libraries AUTO picks from, fastest first
+_FAST_LIBRARIES = (JSONLibrary.ORJSON,)
+
+
+class JSONSerializer(ESJSONSerializer):
+
+    """ A client serializer that encodes and decodes with a given library
+
+    Values json can't encode natively are converted the same way whatever
+    the library: dates and times to ISO 8601 strings, Decimals to floats,
+    bytes to base64 strings (what binary fields expect) and UUIDs to
+    strings.
+    """
+
+    def __init__(self, library=JSONLibrary.STDLIB):
+        self.library = library
+        if library is JSONLibrary.ORJSON:
+            orjson = import_module('orjson')
+            self._dumps = lambda data: orjson.dumps(
+                data, default=self.default,
+                option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+            self._loads = orjson.loads
+        else:
+            self._dumps = lambda data: json.dumps(
+                data, default=self.default, ensure_ascii=False)
+            self._loads = json.loads
+
+    def __repr__(self):
+        # Clients with the same serializer can be shared by the registry
+        return "{}({})".format(type(self).__name__, self.library)
+
+    def default(self, data):
+        if isinstance(data, (date, datetime, time)):
+            return data.isoformat()
+        elif isinstance(data, Decimal):
+            return float(data)
+        elif isinstance(data, (bytes, bytearray)):
+            return b64encode(data).decode('ascii')
+        elif isinstance(data, UUID):
+            return str(data)
+        raise TypeError("Unable to serialize {!r} (type: {})".format(
+            data, type(data)))
+
+    def loads(self, s):
+        try:
+            return self._loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, string_types):
+            return data
+        try:
+            return self._dumps(data)
+        except (ValueError, TypeError, OverflowError) as e:
+            raise SerializationError(data, e)
+
+
+_serializers = {}
+
+
+def get_serializer(library=JSONLibrary.AUTO):
+    """ Get the serializer of a JSON library, falling back to the stdlib
+
+    Params:
+        library (JSONLibrary): The library to use, AUTO picks the fastest
+            one installed
+
+    Returns:
+        serializer (JSONSerializer): The serializer, shared by every client
+            using the same library
+    """
+    candidates = _FAST_LIBRARIES if library is JSONLibrary.AUTO \
+        else (library,)
+    for candidate in candidates + (JSONLibrary.STDLIB,):
+        if candidate not in _serializers:
+            try:
+                _serializers[candidate] = JSONSerializer(candidate)
+            except ImportError:
+                _serializers[candidate] = None
+        if _serializers[candidate] is not None:
+            return _serializers[candidate]
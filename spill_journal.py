@@ -0,0 +1,401 @@
+from collections import OrderedDict
+from threading import Event, Lock
+from time import monotonic
+import json
+import os
+
+from nio.properties import PropertyHolder, BoolProperty, IntProperty, \
+    StringProperty, TimeDeltaProperty, ObjectProperty
+from nio.util.logging import get_nio_logger
+from nio.util.threading import spawn
+
+from .retry_policy import RETRYABLE_STATUSES
+
+
+class SpillOptions(PropertyHolder):
+    enabled = BoolProperty(title="Spill to Disk?", default=False)
+    directory = StringProperty(title="Directory (empty for one per block)",
+                               default="")
+    segment_bytes = IntProperty(title="Max Segment Bytes",
+                                default=16 * 1024 * 1024)
+    max_bytes = IntProperty(title="Max Journal Bytes",
+                            default=1024 * 1024 * 1024)
+    replay_rate = IntProperty(title="Replayed Documents per Second",
+                              default=1000)
+    replay_interval = TimeDeltaProperty(title="Replay Check Interval",
+                                        default={"seconds": 10})
+
+
+_SUFFIX = '.spill'
+
+# The directories of the open journals of the process, each directory is
+# written by a single journal
+_open_directories = set()
+_open_directories_lock = Lock()
+
+
+class SpillDirectoryError(Exception):
+    pass
+
+
+class SpillJournal(object):
+
+    """ An append-only journal of documents, split in segment files
+
+    Records are appended to the newest segment, which is closed and a new
+    one started once it reaches segment_bytes. Segments are read back
+    oldest first and deleted once their records are acknowledged, so the
+    disk space used is bounded by max_bytes plus one segment.
+
+    Each record is a JSON line, segments left behind by a previous run are
+    picked up when the journal is opened. Only one open journal of the
+    process may use a directory.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, logger=None):
+        """ Create a new journal, call open before appending to it
+
+        Args:
+            directory (str): The directory holding the segment files
+            segment_bytes (int): The size a segment is closed at
+            max_bytes (int): Total size of the segments past which new
+                records are refused
+            logger (Logger): The logger to use
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.logger = logger or get_nio_logger("SpillJournal")
+        self._lock = Lock()
+        # Sizes of the segments, oldest first, the last one is appended to
+        self._segments = {}
+        self._bytes = 0
+        self._next_segment = 0
+        self._file = None
+        self._claimed = None
+        self.spilled = 0
+        self.dropped = 0
+
+    def open(self):
+        """ Open the journal, picking up the segments already there
+
+        Raises:
+            SpillDirectoryError: If another open journal uses the directory
+        """
+        self._claim_directory()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            segments = {}
+            for name in sorted(os.listdir(self.directory)):
+                if name.endswith(_SUFFIX):
+                    path = os.path.join(self.directory, name)
+                    segments[path] = os.path.getsize(path)
+        except:
+            self._release_directory()
+            raise
+        with self._lock:
+            self._segments = segments
+            self._bytes = sum(self._segments.values())
+            if self._segments:
+                self.logger.info("Found {} spilled bytes in {} segments"
+                                 .format(self.size, len(self._segments)))
+                last = os.path.basename(list(self._segments)[-1])
+                self._next_segment = int(last[:-len(_SUFFIX)]) + 1
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+        self._release_directory()
+
+    @property
+    def size(self):
+        """ The number of bytes in the journal """
+        return self._bytes
+
+    def append(self, records):
+        """ Append records at the end of the journal
+
+        Args:
+            records (list): JSON serializable records
+
+        Returns:
+            appended (int): The number of records written, those that would
+                take the journal past max_bytes are dropped
+        """
+        appended = 0
+        with self._lock:
+            for record in records:
+                line = (json.dumps(record, separators=(',', ':')) +
+                        '\n').encode('utf-8')
+                if self.size + len(line) > self.max_bytes:
+                    self.dropped += len(records) - appended
+                    break
+                if self._file is None or \
+                        self._segments[self._file.name] >= self.segment_bytes:
+                    self._open_segment()
+                self._file.write(line)
+                self._segments[self._file.name] += len(line)
+                self._bytes += len(line)
+                appended += 1
+            if self._file:
+                self._file.flush()
+            self.spilled += appended
+        return appended
+
+    def oldest_segment(self):
+        """ The oldest segment holding records, None if there are none
+
+        The segment being appended to is closed first, a segment returned
+        here is never written to again.
+        """
+        with self._lock:
+            for path, size in self._segments.items():
+                if self._file and path == self._file.name:
+                    if not size:
+                        return None
+                    self._close_segment()
+                return path
+
+    def read(self, path):
+        """ The records of a segment, in the order they were appended """
+        records = []
+        with open(path, 'rb') as segment:
+            for line in segment:
+                try:
+                    records.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    # A partial last line, if we were killed mid-write
+                    self.logger.warning(
+                        "Skipping a corrupt record in {}".format(path))
+        return records
+
+    def delete(self, path):
+        """ Delete a segment, once all of its records are acknowledged """
+        with self._lock:
+            self._bytes -= self._segments.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'segments': len(self._segments),
+                'bytes': self.size,
+                'spilled': self.spilled,
+                'dropped': self.dropped,
+            }
+
+    def _claim_directory(self):
+        if self._claimed:
+            return
+        directory = os.path.realpath(self.directory)
+        with _open_directories_lock:
+            if directory in _open_directories:
+                raise SpillDirectoryError(
+                    "Spill directory {} is already used by another block"
+                    .format(directory))
+            _open_directories.add(directory)
+        self._claimed = directory
+
+    def _release_directory(self):
+        if self._claimed:
+            with _open_directories_lock:
+                _open_directories.discard(self._claimed)
+            self._claimed = None
+
+    def _open_segment(self):
+        self._close_segment()
+        path = os.path.join(self.directory, "{:012d}{}".format(
+            self._next_segment, _SUFFIX))
+        self._next_segment += 1
+        self._file = open(path, 'ab')
+        self._segments[path] = 0
+
+    def _close_segment(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class Spillable():
+
+    """ A elasticsearch block mixin that spills bulk actions to disk
+
+    Actions that can't be written because the cluster is unavailable are
+    appended to a SpillJournal instead of being dropped. Once the cluster
+    answers again they are replayed through the _bulk API, oldest first and
+    at a limited rate, and each segment is deleted when all of its actions
+    are acknowledged.
+
+    Replay is at least once: actions of a segment that was partly replayed
+    when the block stopped are sent again, give documents ids to make that
+    harmless. Replayed documents are not notified.
+
+    Without a directory, each block spills to es_spill/<block name>.
+    """
+
+    spill = ObjectProperty(SpillOptions, title='Spill Journal',
+                           default=SpillOptions(), advanced=True)
+
+    def __init__(self):
+        super().__init__()
+        self._journal = None
+        self._replay_thread = None
+        self._replay_stop = Event()
+        # The segment being replayed and how many of its actions are done
+        self._replay_offset = (None, 0)
+        self._replayed = 0
+
+    def start(self):
+        super().start()
+        if self.spill().enabled():
+            journal = SpillJournal(
+                self._spill_directory(),
+                segment_bytes=self.spill().segment_bytes(),
+                max_bytes=self.spill().max_bytes(),
+                logger=self.logger)
+            try:
+                journal.open()
+            except:
+                # A block failing to start is never stopped, let go of
+                # the workers and client started for it
+                super().stop()
+                raise
+            self._journal = journal
+            self._replay_stop.clear()
+            self._replay_thread = spawn(self._replay_loop)
+
+    def stop(self):
+        self._replay_stop.set()
+        # A replay waiting to retry its bulk requests gives up now, rather
+        # than holding up stop for the whole backoff
+        self._stop_retry.set()
+        if self._replay_thread:
+            self._replay_thread.join()
+            self._replay_thread = None
+        super().stop()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def _spill_directory(self):
+        return self.spill().directory() or \
+            os.path.join("es_spill", self.name() or self.id())
+
+    def spill_actions(self, actions):
+        """ Append bulk actions to the journal, to be replayed later
+
+        Params:
+            actions (list): (index, doc_type, action) tuples, actions as
+                built by bulk_action
+
+        Returns:
+            spilled (bool): False if spilling is disabled, the caller is
+                left to deal with the actions
+        """
+        if not self._journal:
+            return False
+        if not actions:
+            return True
+        spilled = self._journal.append([list(action) for action in actions])
+        if spilled < len(actions):
+            self.logger.error(
+                "Spill journal is full, dropped {} documents".format(
+                    len(actions) - spilled))
+        self.logger.warning("Spilled {} documents to disk".format(spilled))
+        return True
+
+    @staticmethod
+    def should_spill(result):
+        """ Whether a failed bulk result is worth spilling """
+        return bool(result.get('circuit_open') or result.get('retryable') or
+                    result.get('status') in RETRYABLE_STATUSES)
+
+    def _stats(self, reset=False):
+        stats = super()._stats(reset)
+        if self._journal:
+            stats['spill'] = dict(self._journal.stats(),
+                                  replayed=self._replayed)
+        return stats
+
+    def _replay_loop(self):
+        interval = self.spill().replay_interval().total_seconds()
+        while not self._replay_stop.wait(interval):
+            try:
+                self._replay()
+            except:
+                self.logger.exception("Spill replay failed")
+
+    def _replay(self):
+        """ Replay every segment, until the cluster fails again """
+        if not self._journal.size or not self._circuit_allows() or \
+                not self.connected()['connected']:
+            return
+        while not self._replay_stop.is_set():
+            path = self._journal.oldest_segment()
+            if path is None or not self._replay_segment(path):
+                return
+
+    def _replay_segment(self, path):
+        actions = self._journal.read(path)
+        segment, offset = self._replay_offset
+        start = offset if segment == path else 0
+        rate = self.spill().replay_rate()
+        batch_size = max(self.bulk().chunk_size(), 1)
+        if rate > 0:
+            batch_size = min(batch_size, rate)
+        self.logger.info("Replaying {} spilled documents from {}".format(
+            len(actions) - start, path))
+        for offset in range(start, len(actions), batch_size):
+            if self._replay_stop.is_set():
+                return False
+            batch = actions[offset:offset + batch_size]
+            began = monotonic()
+            if not self._replay_batch(batch):
+                return False
+            self._replay_offset = (path, offset + len(batch))
+            if rate > 0:
+                self._replay_stop.wait(
+                    max(len(batch) / rate - (monotonic() - began), 0))
+        self._journal.delete(path)
+        self._replay_offset = (None, 0)
+        return True
+
+    def _replay_batch(self, batch):
+        """ Send a batch of spilled actions
+
+        Returns:
+            replayed (bool): False if the cluster failed before any action
+                was written, the batch is to be replayed again later
+        """
+        groups = OrderedDict()
+        for index, doc_type, action in batch:
+            groups.setdefault((index, doc_type), []).append(action)
+        written = False
+        respill = []
+        for (index, doc_type), actions in groups.items():
+            results = self.execute_bulk(actions, index=index,
+                                        doc_type=doc_type)
+            failed = [(action, result)
+                      for action, result in zip(actions, results)
+                      if 'error' in result and result.get('status') != 409]
+            if not written and len(failed) == len(actions) and \
+                    all(self.should_spill(result) for _, result in failed):
+                return False
+            written = True
+            for action, result in failed:
+                if self.should_spill(result):
+                    respill.append((index, doc_type, action))
+                else:
+                    self.logger.error(
+                        "Failed to replay a document to: {}, type: {}: {}"
+                        .format(index, doc_type, result['error']))
+            # A conflict means a document created already
+            self._replayed += len(actions) - len(failed)
+        if respill:
+            self.spill_actions(respill)
+        return True
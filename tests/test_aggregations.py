@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from ..aggregations import flatten_aggregations
+
+
+class TestAggregations(TestCase):
+
+    """ Tests flattening aggregation results """
+
+    def test_metrics_only(self):
+        """ Tests metrics without buckets give a single row """
+        self.assertEqual(flatten_aggregations({
+            "avg_cpu": {"value": 1.5},
+            "cpu_stats": {"count": 2, "min": 1, "max": 2, "meta": {}},
+            "cpu_percentiles": {"values": {"99.0": 2}},
+        }), [{
+            "avg_cpu": 1.5,
+            "cpu_stats": {"count": 2, "min": 1, "max": 2},
+            "cpu_percentiles": {"99.0": 2},
+        }])
+
+    def test_no_aggregations(self):
+        """ Tests no aggregation results give no rows """
+        self.assertEqual(flatten_aggregations({}), [])
+        # A leaf bucket without sub-aggregations is still a row
+        self.assertEqual(flatten_aggregations(
+            {"by_host": {"buckets": [{"key": "a", "doc_count": 1}]}}),
+            [{"by_host": "a", "doc_count": 1}])
+
+    def test_nested_buckets(self):
+        """ Tests a row per leaf bucket, holding its parent keys """
+        rows = flatten_aggregations({
+            "by_host": {"buckets": [{
+                "key": "a",
+                "doc_count": 3,
+                "by_day": {"buckets": [
+                    {"key": 1000, "key_as_string": "1970-01-01",
+                     "doc_count": 2, "avg_cpu": {"value": 1.0}},
+                    {"key": 2000, "key_as_string": "1970-01-02",
+                     "doc_count": 1, "avg_cpu": {"value": 3.0}},
+                ]},
+            }, {
+                "key": "b",
+                "doc_count": 0,
+                "by_day": {"buckets": []},
+            }]},
+        })
+        self.assertEqual(rows, [
+            {"by_host": "a", "by_day": 1000, "by_day_as_string": "1970-01-01",
+             "doc_count": 2, "avg_cpu": 1.0},
+            {"by_host": "a", "by_day": 2000, "by_day_as_string": "1970-01-02",
+             "doc_count": 1, "avg_cpu": 3.0},
+        ])
+
+    def test_keyed_and_single_buckets(self):
+        """ Tests keyed buckets and single bucket aggregations """
+        rows = flatten_aggregations({
+            "errors": {
+                "doc_count": 5,
+                "by_level": {"buckets": {
+                    "warn": {"doc_count": 4},
+                    "fatal": {"doc_count": 1},
+                }},
+            },
+            "missing_host": {"doc_count": 2},
+        })
+        self.assertEqual(rows, [
+            {"missing_host": 2, "by_level": "warn", "doc_count": 4},
+            {"missing_host": 2, "by_level": "fatal", "doc_count": 1},
+        ])
@@ -0,0 +1,159 @@
+import asyncio
+import json
+from threading import Thread
+from time import monotonic
+from unittest import skipUnless
+
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.signal.base import Signal
+from nio.testing.block_test_case import NIOBlockTestCase
+
+from ..es_find_block import ESFind
+from ..es_insert_block import ESInsert
+
+try:
+    import aiohttp  # noqa
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+
+class StubServer(object):
+
+    """ A tiny asyncio HTTP server answering like elasticsearch would """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = []
+        self.connections = 0
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, '127.0.0.1', 0))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, value = line.split(':', 1)
+                headers[key.lower()] = value.strip()
+            body = await reader.readexactly(
+                int(headers.get('content-length', 0)))
+            body = json.loads(body.decode()) if body else None
+            self.requests.append((method, path, body))
+            await asyncio.sleep(self.latency)
+            response = json.dumps(self._respond(path, body)).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: " + str(len(response)).encode() +
+                b"\r\n\r\n" + response)
+            await writer.drain()
+        writer.close()
+
+    def _respond(self, path, body):
+        if path.split('?')[0].endswith('/_search'):
+            return {"hits": {"hits": [{"_source": body["query"]}]}}
+        return {"_id": "id{}".format(len(self.requests))}
+
+
+# aiohttp is a test requirement, install requirements-test.txt
+@skipUnless(HAS_AIOHTTP, "aiohttp is required for the asyncio engine, "
+                         "install requirements-test.txt")
+class TestAsyncEngine(NIOBlockTestCase):
+
+    """ Tests running queries on the asyncio engine against a stub server """
+
+    def setUp(self):
+        super().setUp()
+        self.server = StubServer(latency=0.2)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    def test_async_find(self):
+        """ Tests that queries run concurrently on a few sockets """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "port": self.server.port,
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "condition": '{{ {"expr": $val} }}',
+            "engine": "asyncio",
+            "elasticsearch_client_kwargs": {"maxsize": 5}
+        })
+        blk.start()
+        start = monotonic()
+        blk.process_signals([Signal({"val": i}) for i in range(20)])
+        elapsed = monotonic() - start
+        # 20 sequential requests would take 4 seconds
+        self.assertLess(elapsed, 2)
+        self.assertLessEqual(self.server.connections, 5)
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertEqual(self.server.requests[0][:2],
+                         ("GET", "/index_name/doc_type_name/_search"))
+        # Output order follows the input order
+        self.assertEqual(
+            [s.expr for s in self.last_notified[DEFAULT_TERMINAL]],
+            list(range(20)))
+        blk.stop()
+
+    def test_async_sniffing(self):
+        """ Tests the asyncio client is created without sniffing """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "port": self.server.port,
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "engine": "asyncio",
+            "cluster": {"sniff_on_connection_fail": True,
+                        "sniff_interval": 30}
+        })
+        self.server.latency = 0
+        blk.start()
+        self.assertNotIn("sniff_on_connection_fail",
+                         blk._async_es.transport.kwargs)
+        self.assertIsNone(blk._async_es.transport.sniffer_timeout)
+        blk.process_signals([Signal()])
+        self.assertEqual(len(self.server.requests), 1)
+        blk.stop()
+
+    def test_async_insert(self):
+        """ Tests that documents can be inserted on the asyncio engine """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "port": self.server.port,
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "engine": "asyncio"
+        })
+        self.server.latency = 0
+        blk.start()
+        blk.process_signals([Signal({"field1": "1"})])
+        self.assertEqual(self.server.requests, [
+            ("POST", "/index_name/doc_type_name", {"field1": "1"})])
+        self.assertDictEqual(
+            {"id": "id1"}, self.last_notified[DEFAULT_TERMINAL][0].__dict__)
+        blk.stop()
@@ -0,0 +1,88 @@
+from threading import Event
+from unittest import TestCase
+
+from ..buffered_writer import BufferedWriter, Backpressure, BufferFullError
+
+
+class TestBufferedWriter(TestCase):
+
+    """ Tests the background writer used to buffer documents """
+
+    def setUp(self):
+        self.batches = []
+        self.flushed = Event()
+
+    def _flush(self, batch):
+        self.batches.append(batch)
+        self.flushed.set()
+
+    def _writer(self, **kwargs):
+        options = {
+            "max_queue_size": 10,
+            "flush_count": 3,
+            "flush_bytes": 1000,
+            "flush_interval": 60,
+        }
+        options.update(kwargs)
+        return BufferedWriter(self._flush, **options)
+
+    def test_flush_on_count(self):
+        """ Tests that a batch is flushed once flush_count is reached """
+        writer = self._writer()
+        writer.start()
+        for i in range(4):
+            writer.put(i)
+        self.assertTrue(self.flushed.wait(1))
+        self.assertEqual(self.batches, [[0, 1, 2]])
+        writer.stop()
+        # The remaining item is flushed when stopping
+        self.assertEqual(self.batches, [[0, 1, 2], [3]])
+
+    def test_flush_on_bytes(self):
+        """ Tests that a batch is flushed once flush_bytes is reached """
+        writer = self._writer(flush_bytes=100)
+        writer.start()
+        writer.put("big", 100)
+        self.assertTrue(self.flushed.wait(1))
+        self.assertEqual(self.batches, [["big"]])
+        writer.stop()
+
+    def test_flush_on_interval(self):
+        """ Tests that items don't wait longer than flush_interval """
+        writer = self._writer(flush_interval=0.05)
+        writer.start()
+        writer.put("item")
+        self.assertTrue(self.flushed.wait(1))
+        self.assertEqual(self.batches, [["item"]])
+        writer.stop()
+
+    def test_reject_when_full(self):
+        """ Tests the reject backpressure behavior """
+        writer = self._writer(max_queue_size=2,
+                              backpressure=Backpressure.REJECT)
+        # Not started, so nothing drains the queue
+        writer.put(1)
+        writer.put(2)
+        with self.assertRaises(BufferFullError):
+            writer.put(3)
+        self.assertEqual(writer.rejected, 1)
+        self.assertEqual(writer.depth, 2)
+
+    def test_drop_oldest_when_full(self):
+        """ Tests the drop oldest backpressure behavior """
+        writer = self._writer(max_queue_size=2,
+                              backpressure=Backpressure.DROP_OLDEST)
+        for i in range(4):
+            writer.put(i)
+        self.assertEqual(writer.dropped, 2)
+        writer.start()
+        writer.stop()
+        self.assertEqual(self.batches, [[2, 3]])
+
+    def test_put_after_stop(self):
+        """ Tests that a stopped writer doesn't accept items """
+        writer = self._writer()
+        writer.start()
+        writer.stop()
+        with self.assertRaises(BufferFullError):
+            writer.put(1)
@@ -0,0 +1,83 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from ..circuit_breaker import CircuitBreaker, BreakerState
+
+
+class TestCircuitBreaker(TestCase):
+
+    """ Tests opening, probing and closing the circuit breaker """
+
+    def _breaker(self, probe=None, **kwargs):
+        options = {"failure_rate": 0.5, "window": 4, "min_requests": 4,
+                   "reset_timeout": 30}
+        options.update(kwargs)
+        return CircuitBreaker(probe or MagicMock(return_value=True),
+                              **options)
+
+    def test_opens_on_failure_rate(self):
+        """ Tests the breaker opens once enough recent requests fail """
+        breaker = self._breaker()
+        for success in (True, False, True):
+            breaker.record(success)
+        # Not enough requests to judge yet
+        self.assertIs(breaker.state, BreakerState.CLOSED)
+        breaker.record(True)
+        self.assertIs(breaker.state, BreakerState.CLOSED)
+        breaker.record(False)
+        # 2 of the last 4 requests failed
+        self.assertIs(breaker.state, BreakerState.OPEN)
+        self.assertFalse(breaker.allow())
+
+    @patch(CircuitBreaker.__module__ + '.monotonic')
+    def test_probe_closes(self, monotonic):
+        """ Tests a successful probe closes the breaker """
+        monotonic.return_value = 100
+        probe = MagicMock(return_value=True)
+        breaker = self._breaker(probe)
+        for _ in range(4):
+            breaker.record(False)
+        self.assertIs(breaker.state, BreakerState.OPEN)
+        monotonic.return_value = 129
+        self.assertFalse(breaker.allow())
+        probe.assert_not_called()
+        monotonic.return_value = 130
+        self.assertTrue(breaker.allow())
+        probe.assert_called_once_with()
+        self.assertIs(breaker.state, BreakerState.CLOSED)
+        # The failures before opening are forgotten
+        breaker.record(False)
+        self.assertIs(breaker.state, BreakerState.CLOSED)
+        self.assertEqual(
+            [(t['from'], t['to']) for t in breaker.status()['transitions']],
+            [('closed', 'open'), ('open', 'half_open'),
+             ('half_open', 'closed')])
+
+    @patch(CircuitBreaker.__module__ + '.monotonic')
+    def test_probe_reopens(self, monotonic):
+        """ Tests a failed probe opens the breaker for another timeout """
+        monotonic.return_value = 100
+        probe = MagicMock(side_effect=[False, True])
+        breaker = self._breaker(probe)
+        for _ in range(4):
+            breaker.record(False)
+        monotonic.return_value = 130
+        self.assertFalse(breaker.allow())
+        self.assertIs(breaker.state, BreakerState.OPEN)
+        monotonic.return_value = 159
+        self.assertFalse(breaker.allow())
+        self.assertEqual(probe.call_count, 1)
+        monotonic.return_value = 160
+        self.assertTrue(breaker.allow())
+        self.assertEqual(probe.call_count, 2)
+
+    def test_status(self):
+        breaker = self._breaker()
+        breaker.record(True)
+        breaker.record(False)
+        self.assertEqual(breaker.status(), {
+            'state': 'closed',
+            'failure_rate': 0.5,
+            'requests': 2,
+            'transitions': [],
+        })
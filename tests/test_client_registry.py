@@ -0,0 +1,84 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from nio.testing.block_test_case import NIOBlockTestCase
+
+from ..client_registry import ClientRegistry, registry
+from ..es_base import ESBase
+
+
+class TestClientRegistry(TestCase):
+
+    """ Tests the reference counted registry of shared clients """
+
+    def test_key_normalized(self):
+        """ Tests that equivalent kwargs build the same key """
+        self.assertEqual(
+            ClientRegistry.key({"hosts": ["h"], "maxsize": 10, "a": 1}),
+            ClientRegistry.key({"a": 1, "maxsize": 10, "hosts": ["h"]}))
+        self.assertNotEqual(
+            ClientRegistry.key({"hosts": ["h"], "maxsize": 10}),
+            ClientRegistry.key({"hosts": ["h"], "maxsize": 15}))
+
+    def test_reference_counting(self):
+        """ Tests that clients are shared and closed by the last release """
+        clients = ClientRegistry()
+        factory = MagicMock()
+        first = clients.acquire("key", factory)
+        second = clients.acquire("key", factory)
+        self.assertIs(first, second)
+        self.assertEqual(factory.call_count, 1)
+        self.assertEqual(clients.stats()[0]["references"], 2)
+        clients.release("key")
+        self.assertFalse(first.transport.close.called)
+        clients.release("key")
+        first.transport.close.assert_called_once_with()
+        self.assertEqual(clients.stats(), [])
+
+    def test_pool_stats(self):
+        """ Tests that the connection pools of the clients are described """
+        from elasticsearch import Elasticsearch
+        clients = ClientRegistry()
+        clients.acquire("key", lambda: Elasticsearch(
+            hosts=["http://127.0.0.1:9200/"], maxsize=15))
+        self.assertEqual(clients.stats(), [{
+            "references": 1,
+            "pools": [{
+                "host": "http://127.0.0.1:9200",
+                "maxsize": 15,
+                "opened": 0,
+                "requests": 0,
+            }]
+        }])
+        clients.release("key")
+
+
+class TestSharedClient(NIOBlockTestCase):
+
+    """ Tests blocks sharing a client through the registry """
+
+    @patch('elasticsearch.Elasticsearch')
+    def test_blocks_share_client(self, es):
+        """ Tests that blocks with identical targets share a client """
+        es.side_effect = lambda **kwargs: MagicMock()
+        first = ESBase()
+        second = ESBase()
+        other = ESBase()
+        self.configure_block(first, {"share_client": True})
+        self.configure_block(second, {"share_client": True})
+        self.configure_block(other, {"share_client": True, "port": 9300})
+        self.assertEqual(es.call_count, 2)
+        self.assertIs(first._es, second._es)
+        self.assertIsNot(first._es, other._es)
+        self.assertEqual(len(first.clients()["clients"]), 2)
+
+        first.start()
+        first.stop()
+        # The client is still used by the second block
+        self.assertFalse(second._es.transport.close.called)
+        second.start()
+        second.stop()
+        second._es.transport.close.assert_called_once_with()
+        other.start()
+        other.stop()
+        self.assertEqual(registry.stats(), [])
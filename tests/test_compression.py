@@ -0,0 +1,33 @@
+from gzip import decompress
+from unittest import TestCase
+
+from ..compression import GzipCompressor
+
+
+class TestCompression(TestCase):
+
+    """ Tests compressing request bodies """
+
+    def test_min_size(self):
+        """ Tests small bodies are sent as they are """
+        compressor = GzipCompressor(min_size=100)
+        self.assertEqual(compressor.compress(b'{"a": 1}'),
+                         (b'{"a": 1}', False))
+        stats = compressor.stats()
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['compressed'], 0)
+        self.assertEqual(stats['ratio'], 0)
+
+    def test_compress(self):
+        compressor = GzipCompressor(level=12, min_size=100)
+        self.assertEqual(compressor.level, 9)
+        body = '{"field": "value"}\n' * 100
+        compressed, is_compressed = compressor.compress(body)
+        self.assertTrue(is_compressed)
+        self.assertEqual(decompress(compressed), body.encode('utf-8'))
+        stats = compressor.stats()
+        self.assertEqual(stats['compressed'], 1)
+        self.assertEqual(stats['bytes_in'], len(body))
+        self.assertEqual(stats['bytes_out'], len(compressed))
+        self.assertGreater(stats['ratio'], 10)
+        self.assertGreaterEqual(stats['compress_ms'], 0)
@@ -0,0 +1,29 @@
+from datetime import datetime
+from unittest import TestCase
+
+from ..document_ids import HashAlgorithm, content_hash
+
+
+class TestDocumentIds(TestCase):
+
+    """ Tests deriving document ids from their content """
+
+    def test_stable(self):
+        """ Tests the id doesn't depend on the order of the keys """
+        self.assertEqual(content_hash({"a": 1, "b": [1, 2]}),
+                         content_hash({"b": [1, 2], "a": 1}))
+        self.assertNotEqual(content_hash({"a": 1}), content_hash({"a": 2}))
+        self.assertEqual(len(content_hash({"a": 1})), 40)
+
+    def test_fields(self):
+        """ Tests only the selected fields are hashed """
+        self.assertEqual(
+            content_hash({"a": 1, "time": datetime.now()}, ["a"]),
+            content_hash({"a": 1, "time": datetime.now()}, ["a"]))
+        # A missing field is hashed as a null
+        self.assertEqual(content_hash({"a": 1}, ["a", "b"]),
+                         content_hash({"a": 1, "b": None}, ["a", "b"]))
+
+    def test_algorithm(self):
+        self.assertEqual(
+            len(content_hash({"a": 1}, algorithm=HashAlgorithm.SHA256)), 64)
@@ -0,0 +1,168 @@
+from unittest.mock import patch
+from elasticsearch.exceptions import NotFoundError
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.signal.base import Signal
+from nio.testing.block_test_case import NIOBlockTestCase
+from ..es_by_query_block import ESByQuery
+
+
+@patch('elasticsearch.client.tasks.TasksClient.get')
+@patch('elasticsearch.Elasticsearch.delete_by_query')
+class TestESByQuery(NIOBlockTestCase):
+
+    """ Tests elasticsearch block by-query functionality """
+
+    def test_delete_by_query(self, delete_method, get_method):
+        """ Tests a task is launched, then polled until completed """
+        blk = ESByQuery()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "condition": '{{ {"range": {"age": {"lt": $age} } } }}',
+            "slices": 4,
+            "requests_per_second": 500,
+            "conflicts": "proceed",
+            "enrich": {"exclude_existing": False}
+        })
+        delete_method.return_value = {"task": "node:1"}
+        blk.start()
+        blk.process_signals([Signal({"age": 30})])
+        delete_method.assert_called_once_with(
+            index="index_name", doc_type="doc_type_name",
+            body={"query": {"range": {"age": {"lt": 30}}}},
+            wait_for_completion=False, conflicts="proceed",
+            params={"slices": 4}, requests_per_second=500)
+        # The launch itself notifies nothing
+        self.assert_num_signals_notified(0)
+        self.assertEqual(blk.tasks()["tasks"][0]["task"], "node:1")
+
+        get_method.return_value = {"completed": False, "task": {
+            "status": {"total": 10, "deleted": 4, "batches": 1}}}
+        blk._poll_tasks()
+        get_method.assert_called_once_with(task_id="node:1")
+        progress = self.last_notified["progress"][0].to_dict()
+        self.assertEqual(progress["task"], "node:1")
+        self.assertEqual(progress["deleted"], 4)
+        self.assertEqual(progress["progress"], 0.4)
+        self.assertFalse(progress["completed"])
+        self.assertEqual(progress["age"], 30)
+
+        get_method.return_value = {
+            "completed": True,
+            "task": {"status": {"total": 10, "deleted": 8}},
+            "response": {"total": 10, "deleted": 9, "version_conflicts": 1,
+                         "failures": []}}
+        blk._poll_tasks()
+        completion = self.last_notified[DEFAULT_TERMINAL][0].to_dict()
+        self.assertTrue(completion["completed"])
+        self.assertEqual(completion["deleted"], 9)
+        self.assertEqual(completion["version_conflicts"], 1)
+        self.assertEqual(completion["progress"], 1.0)
+        self.assertEqual(completion["failures"], [])
+        self.assertEqual(blk.tasks(), {"tasks": []})
+
+        # Completed tasks are no longer polled
+        blk._poll_tasks()
+        self.assertEqual(get_method.call_count, 2)
+        blk.stop()
+
+    def test_unknown_task(self, delete_method, get_method):
+        """ Tests a task the cluster doesn't know is no longer polled """
+        blk = ESByQuery()
+        self.configure_block(blk, {"condition": "{'match_all': {}}"})
+        delete_method.return_value = {"task": "node:1"}
+        get_method.side_effect = NotFoundError(404, "resource_not_found")
+        blk.start()
+        blk.process_signals([Signal()])
+        self.assertEqual(blk._queue_depths()["running_tasks"], 1)
+        blk._poll_tasks()
+        self.assertEqual(blk._queue_depths()["running_tasks"], 0)
+        self.assert_num_signals_notified(0)
+        blk.stop()
+
+    def test_no_condition(self, delete_method, get_method):
+        """ Tests nothing is deleted without a condition """
+        blk = ESByQuery()
+        self.configure_block(blk, {
+            "condition": "{{ $query }}"
+        })
+        blk.start()
+        blk.process_signals([Signal(), Signal({"query": ""})])
+        self.assertEqual(delete_method.call_count, 0)
+        self.configure_block(blk, {})
+        blk.process_signals([Signal()])
+        self.assertEqual(delete_method.call_count, 0)
+        blk.stop()
+
+
+@patch('elasticsearch.Elasticsearch.update_by_query')
+class TestESUpdateByQuery(NIOBlockTestCase):
+
+    def test_update_by_query(self, update_method):
+        """ Tests the update script and its parameters are sent """
+        blk = ESByQuery()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "operation": "update",
+            "condition": "{'match_all': {}}",
+            "script": {
+                "source": "ctx._source.flag = params.flag",
+                "params": '{{ {"flag": $flag} }}'
+            }
+        })
+        update_method.return_value = {"task": "node:2"}
+        blk.start()
+        blk.process_signals([Signal({"flag": True})])
+        update_method.assert_called_once_with(
+            index="index_name", doc_type="doc_type_name",
+            body={"query": {"match_all": {}},
+                  "script": {"inline": "ctx._source.flag = params.flag",
+                             "lang": "painless",
+                             "params": {"flag": True}}},
+            wait_for_completion=False, conflicts="abort")
+        blk.stop()
+
+    def test_update_by_query_slices(self, update_method):
+        """ Tests the slices of an update are sent as a query parameter """
+        blk = ESByQuery()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "operation": "update",
+            "condition": "{'term': {'stale': True}}",
+            "slices": 2
+        })
+        update_method.return_value = {"task": "node:3"}
+        blk.start()
+        blk.process_signals([Signal()])
+        update_method.assert_called_once_with(
+            index="index_name", doc_type="doc_type_name",
+            body={"query": {"term": {"stale": True}}},
+            wait_for_completion=False, conflicts="abort",
+            params={"slices": 2})
+        self.assertEqual(blk.tasks()["tasks"][0]["task"], "node:3")
+        blk.stop()
+
+
+@patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+class TestESByQueryRequest(NIOBlockTestCase):
+
+    def test_update_slices_request(self, perform_method):
+        """ Tests the client sends the slices of an update """
+        perform_method.return_value = (200, {}, '{"task": "node:4"}')
+        blk = ESByQuery()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "operation": "update",
+            "condition": "{'match_all': {}}",
+            "slices": 2
+        })
+        blk.start()
+        blk.process_signals([Signal()])
+        method, url, params = perform_method.call_args[0][:3]
+        self.assertEqual(url, "/index_name/doc_type_name/_update_by_query")
+        self.assertEqual(params["slices"], 2)
+        self.assertEqual(blk.tasks()["tasks"][0]["task"], "node:4")
+        blk.stop()
@@ -2,6 +2,7 @@ from unittest.mock import patch
 from nio.block.terminals import DEFAULT_TERMINAL
 from nio.signal.base import Signal
 from nio.testing.block_test_case import NIOBlockTestCase
+from .. import literal_cache
 from ..es_find_block import ESFind
 
 # The search method is what searches an ES instance. It should be
@@ -194,3 +195,475 @@ class TestESFind(NIOBlockTestCase):
             "result_val_2"
         )
         blk.stop()
+
+    def test_field_selection(self, search_method):
+        """ Tests only the selected fields are fetched """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "fields": {
+                "source_includes": ["a", "b.*"],
+                "source_excludes": ["b.big"],
+                "docvalue_fields": ["c"],
+                "filter_path": ["hits.hits._source", "hits.hits.fields"]
+            }
+        })
+        blk.start()
+        search_method.return_value = {
+            "hits": {"hits": [{"_source": {"a": 1}, "fields": {"c": [2]}}]}}
+        blk.process_signals([Signal()])
+        search_method.assert_called_once_with(
+            index="index_name",
+            doc_type="doc_type_name",
+            body={
+                "query": {"match_all": {}},
+                "_source": {"includes": ["a", "b.*"],
+                            "excludes": ["b.big"]},
+                "docvalue_fields": ["c"]
+            },
+            filter_path="hits.hits._source,hits.hits.fields,took")
+        self.assertDictEqual(
+            {"a": 1}, self.last_notified[DEFAULT_TERMINAL][0].__dict__)
+        blk.stop()
+
+    def test_no_source(self, search_method):
+        """ Tests stored fields can be fetched without the _source """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "fields": {
+                "fetch_source": False,
+                "stored_fields": ["d"],
+                "filter_path": ["hits.hits.fields"]
+            }
+        })
+        blk.start()
+        # Nothing matched, the filter_path leaves an empty response
+        search_method.return_value = {"took": 1}
+        blk.process_signals([Signal()])
+        self.assertEqual(search_method.call_args[1]["body"], {
+            "query": {"match_all": {}},
+            "_source": False,
+            "stored_fields": ["d"]
+        })
+        self.assert_num_signals_notified(0)
+        blk.stop()
+
+    def test_aggregations(self, search_method):
+        """ Tests aggregations mode notifies a signal per leaf bucket """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "mode": "aggregations",
+            "aggregations":
+                '{{ {"by_host": {"terms": {"field": $field} } } }}',
+            "size": 10,
+            "sort": [{"key": "time"}],
+            "fields": {"filter_path": ["hits.total"]}
+        })
+        blk.start()
+        search_method.return_value = {
+            "hits": {"total": 3},
+            "aggregations": {"by_host": {"buckets": [
+                {"key": "a", "doc_count": 2},
+                {"key": "b", "doc_count": 1}]}}}
+        blk.process_signals([Signal({"field": "host"})])
+        # Hits are neither fetched nor sorted
+        search_method.assert_called_once_with(
+            index="index_name",
+            doc_type="doc_type_name",
+            body={
+                "query": {"match_all": {}},
+                "aggs": {"by_host": {"terms": {"field": "host"}}},
+                "size": 0
+            },
+            filter_path="hits.total,took,aggregations")
+        self.assert_num_signals_notified(2)
+        self.assertEqual(
+            [s.to_dict() for s in self.last_notified[DEFAULT_TERMINAL]],
+            [{"by_host": "a", "doc_count": 2},
+             {"by_host": "b", "doc_count": 1}])
+        blk.stop()
+
+    def test_empty_aggregations(self, search_method):
+        """ Tests aggregations mode needs aggregations, and results """
+        with self.assertRaises(ValueError):
+            self.configure_block(ESFind(), {"mode": "aggregations"})
+        blk = ESFind()
+        self.configure_block(blk, {
+            "mode": "aggregations",
+            "aggregations": "{{ $aggs }}"
+        })
+        blk.start()
+        search_method.return_value = {"hits": {"total": 3}}
+        blk.process_signals([Signal({"aggs": {}})])
+        self.assertEqual(search_method.call_count, 0)
+        # A response without aggregations gives no signals
+        blk.process_signals(
+            [Signal({"aggs": {"n": {"value_count": {"field": "a"}}}})])
+        self.assertEqual(search_method.call_count, 1)
+        self.assert_num_signals_notified(0)
+        blk.stop()
+
+    @patch('elasticsearch.Elasticsearch.count')
+    def test_count(self, count_method, search_method):
+        """ Tests count mode notifies a count per signal """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "condition": '{{ {"term": {"key": $key} } }}',
+            "mode": "count",
+            "size": 0,
+            "terminate_after": 1000,
+            "enrich": {"exclude_existing": False}
+        })
+        blk.start()
+        count_method.side_effect = [
+            {"count": 1000, "terminated_early": True},
+            {"count": 3, "terminated_early": False}]
+        blk.process_signals([Signal({"key": "a"}), Signal({"key": "b"})])
+        self.assertEqual(search_method.call_count, 0)
+        count_method.assert_any_call(
+            index="index_name",
+            doc_type="doc_type_name",
+            body={"query": {"term": {"key": "a"}}},
+            params={"terminate_after": 1000})
+        self.assertEqual(
+            [(s.key, s.count, s.terminated_early)
+             for s in self.last_notified[DEFAULT_TERMINAL]],
+            [("a", 1000, True), ("b", 3, False)])
+        blk.stop()
+
+    def test_condition_cache(self, search_method):
+        """ Tests rendered conditions are parsed once and copied """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "condition": '{"expr": "{{ $val }}"}'
+        })
+        literal_cache.clear()
+        blk.start()
+        blk.process_signals([Signal({'val': '1'}), Signal({'val': '1'})])
+        first, second = [call[1]["body"]["query"]
+                         for call in search_method.call_args_list]
+        self.assertEqual(first, {"expr": "1"})
+        self.assertIsNot(first, second)
+        stats = blk.stats()['stats']['condition_cache']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        blk.stop()
+
+    def test_static_properties(self, search_method):
+        """ Tests literal properties are evaluated once, on configure """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "size": 10,
+            "offset": "{{ $offset }}"
+        })
+        self.assertEqual(blk._index, "index_name")
+        self.assertEqual(blk._doc_type, "doc_type_name")
+        self.assertEqual(blk._condition, {"match_all": {}})
+        self.assertEqual(blk._size, 10)
+        self.assertIsNone(blk._offset)
+        blk.start()
+        blk.process_signals([Signal({"offset": 5})])
+        search_method.assert_called_once_with(
+            index="index_name",
+            doc_type="doc_type_name",
+            body={"query": {"match_all": {}}, "size": 10, "from": 5})
+        blk.stop()
+
+    def test_process_fields_in_place(self, search_method):
+        """ Tests hits are renamed without being copied """
+        blk = ESFind()
+        self.configure_block(blk, {"pretty_results": False})
+        hit = {"_index": "i", "_id": "1", "_source": {"a": 1}, "fields": {}}
+        result = blk._process_fields(hit)
+        self.assertIs(result, hit)
+        self.assertDictEqual(result, {"index": "i", "id": "1",
+                                      "source": {"a": 1}, "fields": {}})
+
+
+@patch('elasticsearch.Elasticsearch.msearch')
+class TestESFindMultiSearch(NIOBlockTestCase):
+
+    """ Tests elasticsearch block multi search functionality """
+
+    def _response(self, *values):
+        return {"hits": {"hits": [{"_source": {"result": value}}
+                                  for value in values]}}
+
+    def test_msearch_query(self, msearch_method):
+        """ Tests that every signal's search is sent in one request """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "condition": '{{ {"expr": $val} }}',
+            "msearch": {"enabled": True},
+            "enrich": {"exclude_existing": False}
+        })
+        msearch_method.return_value = {"responses": [
+            self._response("a1", "a2"),
+            self._response("b1")
+        ]}
+        blk.start()
+        blk.process_signals([Signal({'val': 'a'}), Signal({'val': 'b'})])
+        msearch_method.assert_called_once_with(body=[
+            {"index": "index_name", "type": "doc_type_name"},
+            {"query": {"expr": "a"}},
+            {"index": "index_name", "type": "doc_type_name"},
+            {"query": {"expr": "b"}},
+        ])
+        # Results are enriched onto the signal that produced them
+        self.assert_num_signals_notified(3)
+        self.assertEqual(
+            [(s.val, s.result) for s in self.last_notified[DEFAULT_TERMINAL]],
+            [("a", "a1"), ("a", "a2"), ("b", "b1")])
+        blk.stop()
+
+    def test_msearch_chunks(self, msearch_method):
+        """ Tests that searches are split across requests """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "msearch": {"enabled": True, "max_searches": 2}
+        })
+        msearch_method.side_effect = [
+            {"responses": [self._response("1"), self._response("2")]},
+            {"responses": [self._response("3")]}
+        ]
+        blk.start()
+        blk.process_signals([Signal() for _ in range(3)])
+        self.assertEqual(msearch_method.call_count, 2)
+        self.assert_num_signals_notified(3)
+        blk.stop()
+
+    def test_msearch_error_isolated(self, msearch_method):
+        """ Tests that a failed search only affects its own signal """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "condition": '{{ {"expr": $val} }}',
+            "msearch": {"enabled": True},
+            "enrich": {"exclude_existing": False}
+        })
+        msearch_method.return_value = {"responses": [
+            {"error": {"type": "parsing_exception"}},
+            self._response("b1")
+        ]}
+        blk.start()
+        blk.process_signals([Signal({'val': 'a'}), Signal({'val': 'b'})])
+        self.assert_num_signals_notified(1)
+        self.assertEqual(self.last_notified[DEFAULT_TERMINAL][0].val, "b")
+        blk.stop()
+
+    def test_msearch_stats(self, msearch_method):
+        """ Tests each search of a _msearch is recorded on its own """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "{{ $val }}",
+            "doc_type": "t",
+            "msearch": {"enabled": True}
+        })
+        msearch_method.return_value = {"responses": [
+            {"error": {"type": "parsing_exception"}, "status": 400},
+            dict(self._response("b1"), took=4)
+        ]}
+        blk.start()
+        blk.process_signals([Signal({'val': 'a'}), Signal({'val': 'b'})])
+        targets = {t['index']: t for t in blk.stats()['stats']['targets']}
+        self.assertEqual(targets['a']['errors'], 1)
+        self.assertEqual(targets['a']['docs'], 0)
+        self.assertEqual(targets['b']['errors'], 0)
+        self.assertEqual(targets['b']['docs'], 1)
+        self.assertEqual(targets['b']['took_ms']['p50'], 4)
+        blk.stop()
+
+    def test_msearch_count(self, msearch_method):
+        """ Tests counts are sent as searches without hits """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "mode": "count",
+            "terminate_after": 10,
+            "msearch": {"enabled": True}
+        })
+        msearch_method.return_value = {"responses": [
+            {"hits": {"total": 10}, "terminated_early": True},
+            {"hits": {"total": 2}}
+        ]}
+        blk.start()
+        blk.process_signals([Signal(), Signal()])
+        msearch_method.assert_called_once_with(body=[
+            {"index": "index_name", "type": "doc_type_name"},
+            {"query": {"match_all": {}}, "size": 0, "terminate_after": 10},
+            {"index": "index_name", "type": "doc_type_name"},
+            {"query": {"match_all": {}}, "size": 0, "terminate_after": 10},
+        ])
+        self.assertEqual(
+            [s.to_dict() for s in self.last_notified[DEFAULT_TERMINAL]],
+            [{"count": 10, "terminated_early": True}, {"count": 2}])
+        blk.stop()
+
+
+@patch('elasticsearch.Elasticsearch.clear_scroll')
+@patch('elasticsearch.Elasticsearch.scroll')
+@patch('elasticsearch.Elasticsearch.search')
+class TestESFindStream(NIOBlockTestCase):
+
+    """ Tests elasticsearch block streaming functionality """
+
+    def _page(self, *values, scroll_id=None):
+        page = {"hits": {"hits": [
+            {"_source": {"result": value}, "sort": [value]}
+            for value in values]}}
+        if scroll_id:
+            page["_scroll_id"] = scroll_id
+        return page
+
+    def test_scroll_pages(self, search_method, scroll_method, clear_method):
+        """ Tests that each scroll page is notified as it arrives """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "size": "5",
+            "stream": {"enabled": True, "page_size": 2}
+        })
+        search_method.return_value = self._page(1, 2, scroll_id="s1")
+        scroll_method.side_effect = [self._page(3, 4, scroll_id="s2"),
+                                     self._page(scroll_id="s3")]
+        blk.start()
+        blk.process_signals([Signal()])
+        search_method.assert_called_once_with(
+            index="index_name",
+            doc_type="doc_type_name",
+            scroll="1m",
+            body={
+                "query": {"match_all": {}},
+                "size": 2,
+                "sort": ["_doc"]
+            })
+        self.assertEqual(scroll_method.call_args_list[1][1],
+                         {"scroll_id": "s2", "scroll": "1m"})
+        # One notification per non-empty page
+        self.assertEqual(len(self.notified_signals[DEFAULT_TERMINAL]), 2)
+        self.assert_num_signals_notified(4)
+        # The scroll context is released when done
+        clear_method.assert_called_once_with(scroll_id="s3")
+        blk.stop()
+        self.assertEqual(clear_method.call_count, 1)
+
+    def test_scroll_filter_path(self, search_method, scroll_method,
+                                clear_method):
+        """ Tests a filter_path never drops what scrolling needs """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "stream": {"enabled": True, "page_size": 2},
+            "fields": {"filter_path": ["hits.hits._source"]}
+        })
+        search_method.return_value = self._page(1, 2, scroll_id="s1")
+        scroll_method.return_value = {"_scroll_id": "s2"}
+        blk.start()
+        blk.process_signals([Signal()])
+        filter_path = "hits.hits._source,took,_scroll_id"
+        self.assertEqual(search_method.call_args[1]["filter_path"],
+                         filter_path)
+        self.assertEqual(scroll_method.call_args[1], {
+            "scroll_id": "s1", "scroll": "1m", "filter_path": filter_path})
+        self.assert_num_signals_notified(2)
+        clear_method.assert_called_once_with(scroll_id="s2")
+        blk.stop()
+
+    def test_search_after_pages(self, search_method, scroll_method,
+                                clear_method):
+        """ Tests paging with search_after on the sort keys """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "sort": [{"key": "sort_key", "direction": "desc"}],
+            "stream": {
+                "enabled": True,
+                "page_size": 2,
+                "method": "search_after"
+            }
+        })
+        search_method.side_effect = [self._page(1, 2), self._page(3)]
+        blk.start()
+        blk.process_signals([Signal()])
+        self.assertEqual(search_method.call_count, 2)
+        body = search_method.call_args_list[1][1]["body"]
+        self.assertEqual(
+            body["sort"], [{"sort_key": "desc"}, {"_uid": "asc"}])
+        self.assertEqual(body["search_after"], [2])
+        self.assert_num_signals_notified(3)
+        self.assertFalse(scroll_method.called)
+        self.assertFalse(clear_method.called)
+        blk.stop()
+
+    def test_stop_clears_scroll(self, search_method, scroll_method,
+                                clear_method):
+        """ Tests that open scroll contexts are cleared on stop """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "stream": {"enabled": True}
+        })
+        blk.start()
+        blk._track_scroll(None, "open_scroll")
+        blk.stop()
+        clear_method.assert_called_once_with(scroll_id="open_scroll")
+
+    def test_sliced_scroll(self, search_method, scroll_method, clear_method):
+        """ Tests that a scroll can be split in parallel slices """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "stream": {"enabled": True, "slices": 3}
+        })
+
+        def search(body, **kwargs):
+            slice_id = body["slice"]["id"]
+            return self._page(slice_id, scroll_id="s{}".format(slice_id))
+        search_method.side_effect = search
+        scroll_method.return_value = self._page()
+        blk.start()
+        blk.process_signals([Signal()])
+        self.assertEqual(search_method.call_count, 3)
+        self.assertEqual(
+            sorted(call[1]["body"]["slice"]["id"]
+                   for call in search_method.call_args_list),
+            [0, 1, 2])
+        for call in search_method.call_args_list:
+            self.assertEqual(call[1]["body"]["slice"]["max"], 3)
+        self.assertEqual(
+            sorted(s.result for s in self.last_notified[DEFAULT_TERMINAL]),
+            [0, 1, 2])
+        blk.stop()
+
+    def test_sliced_scroll_stats(self, search_method, scroll_method,
+                                 clear_method):
+        """ Tests the throughput of each slice is in the block stats """
+        blk = ESFind()
+        self.configure_block(blk, {
+            "stream": {"enabled": True, "slices": 2}
+        })
+
+        def search(body, **kwargs):
+            if body["slice"]["id"]:
+                raise ValueError("slice failed")
+            return self._page(1, 2, scroll_id="s0")
+        search_method.side_effect = search
+        scroll_method.return_value = self._page()
+        blk.start()
+        blk.process_signals([Signal()])
+        stats = blk.stats()["stats"]["scroll_slices"]
+        self.assertEqual(
+            [(s["slice"], s["documents"], s["failed"]) for s in stats],
+            [(0, 2, False), (1, 0, True)])
+        for slice_stats in stats:
+            self.assertGreaterEqual(slice_stats["elapsed"], 0)
+        blk.stop()
@@ -1,8 +1,24 @@
 from unittest.mock import patch
+from tempfile import TemporaryDirectory
+from threading import Event
+from time import monotonic, sleep
+import os
+from elasticsearch.exceptions import ConflictError, ConnectionError
 from nio.block.terminals import DEFAULT_TERMINAL
 from nio.signal.base import Signal
 from nio.testing.block_test_case import NIOBlockTestCase
+from nio.testing.modules.scheduler.scheduler import JumpAheadScheduler
+from nio.util.threading import spawn
+from ..document_ids import content_hash
 from ..es_insert_block import ESInsert
+from ..spill_journal import SpillDirectoryError
+
+def wait_for(condition, timeout=5):
+    """ Wait for what a scheduled job does on its own thread """
+    deadline = monotonic() + timeout
+    while not condition() and monotonic() < deadline:
+        sleep(0.01)
+
 
 # The index method is what stores the signals. It should be called
 # with the following fields, in this order:
@@ -142,3 +158,416 @@ class TestESInsert(NIOBlockTestCase):
             {"field1": "1", "result": {"id": "inserted_id"}},
             self.last_notified[DEFAULT_TERMINAL][0].__dict__)
         blk.stop()
+
+    def test_id_expression(self, index_method):
+        """ Tests documents are indexed with the id they evaluate to """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "document_id": {"source": "expression",
+                            "expression": "{{ $key }}"}
+        })
+        blk.start()
+        blk.process_signals([Signal({"key": 1}), Signal({"no_key": 2})])
+        index_method.assert_called_once_with(
+            "index_name", "doc_type_name", {"key": 1}, id="1")
+        blk.stop()
+
+    def test_create_conflict(self, index_method):
+        """ Tests a document created already is not a failure """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "document_id": {"source": "content_hash",
+                            "hash_fields": ["key"],
+                            "op_type": "create"}
+        })
+        index_method.side_effect = ConflictError(
+            409, "version_conflict_engine_exception", {})
+        blk.start()
+        blk.process_signals([Signal({"key": 1, "other": 2})])
+        doc_id = content_hash({"key": 1}, ["key"])
+        index_method.assert_called_once_with(
+            "index_name", "doc_type_name", {"key": 1, "other": 2},
+            id=doc_id, op_type="create")
+        self.assert_num_signals_notified(1)
+        self.assertEqual(self.last_notified[DEFAULT_TERMINAL][0].id, doc_id)
+        blk.stop()
+
+
+@patch('elasticsearch.Elasticsearch.bulk')
+class TestESInsertBulk(NIOBlockTestCase):
+
+    """ Tests elasticsearch block bulk insert functionality """
+
+    def _bulk_response(self, *ids):
+        return {"items": [{"index": {"_id": _id, "status": 201}}
+                          for _id in ids]}
+
+    def test_bulk_grouped_by_index(self, bulk_method):
+        """ Tests that signals are sent in one request per index/type """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "index": "{{ $idx }}",
+            "doc_type": "doc_type_name",
+            "bulk": {"enabled": True},
+            "serializer": "json"
+        })
+        bulk_method.side_effect = [self._bulk_response("1", "3"),
+                                   self._bulk_response("2")]
+        blk.start()
+        blk.process_signals([Signal({"idx": "a"}),
+                             Signal({"idx": "b"}),
+                             Signal({"idx": "a"})])
+        self.assertEqual(bulk_method.call_count, 2)
+        self.assertEqual(bulk_method.call_args_list[0][1], {
+            "index": "a",
+            "doc_type": "doc_type_name",
+            "body": '{"index": {}}\n{"idx": "a"}\n'
+                    '{"index": {}}\n{"idx": "a"}\n'
+        })
+        self.assertEqual(bulk_method.call_args_list[1][1]["index"], "b")
+        self.assert_num_signals_notified(3)
+        self.assertEqual(
+            [s.id for s in self.last_notified[DEFAULT_TERMINAL]],
+            ["1", "3", "2"])
+        blk.stop()
+
+    def test_bulk_chunks(self, bulk_method):
+        """ Tests that requests are chunked by count and bytes """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "bulk": {"enabled": True, "chunk_size": 2}
+        })
+        bulk_method.side_effect = [self._bulk_response("1", "2"),
+                                   self._bulk_response("3")]
+        blk.start()
+        blk.process_signals([Signal({"field1": i}) for i in range(3)])
+        self.assertEqual(bulk_method.call_count, 2)
+        self.assert_num_signals_notified(3)
+        blk.stop()
+
+        bulk_method.reset_mock()
+        bulk_method.side_effect = None
+        bulk_method.return_value = self._bulk_response("1")
+        # Each action is 28 bytes, so only one fits in a request
+        self.configure_block(blk, {
+            "bulk": {"enabled": True, "max_chunk_bytes": 40}
+        })
+        blk.process_signals([Signal({"field1": i}) for i in range(3)])
+        self.assertEqual(bulk_method.call_count, 3)
+
+    def test_bulk_item_failure(self, bulk_method):
+        """ Tests that failed items don't discard the whole batch """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "bulk": {"enabled": True}
+        })
+        bulk_method.return_value = {"items": [
+            {"index": {"_id": "1", "status": 201}},
+            {"index": {"status": 400, "error": {"type": "mapper_parsing"}}},
+        ]}
+        blk.start()
+        blk.process_signals([Signal({"field1": 1}), Signal({"field1": 2})])
+        self.assert_num_signals_notified(1)
+        self.assertDictEqual(
+            {"id": "1"}, self.last_notified[DEFAULT_TERMINAL][0].__dict__)
+        blk.stop()
+
+    def test_bulk_request_failure(self, bulk_method):
+        """ Tests that a failed chunk doesn't affect the other chunks """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "bulk": {"enabled": True, "chunk_size": 1},
+            "retry_options": {"max_retry": 0}
+        })
+        bulk_method.__name__ = "bulk"
+        bulk_method.side_effect = [Exception("bad request"),
+                                   self._bulk_response("2")]
+        blk.start()
+        blk.process_signals([Signal({"field1": 1}), Signal({"field1": 2})])
+        self.assert_num_signals_notified(1)
+        self.assertEqual(self.last_notified[DEFAULT_TERMINAL][0].id, "2")
+        blk.stop()
+
+    def test_buffered_flush_on_stop(self, bulk_method):
+        """ Tests that buffered signals are written in bulk on stop """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "buffer": {"enabled": True, "flush_interval": {"seconds": 60}}
+        })
+        bulk_method.return_value = self._bulk_response("1", "2", "3")
+        blk.start()
+        blk.process_signals([Signal({"field1": 1})])
+        blk.process_signals([Signal({"field1": 2}), Signal({"field1": 3})])
+        # Nothing is written until the buffer flushes
+        self.assertEqual(bulk_method.call_count, 0)
+        blk.stop()
+        # All three signals share a single bulk request
+        self.assertEqual(bulk_method.call_count, 1)
+        self.assert_num_signals_notified(3)
+
+    def test_bulk_resends_rejected(self, bulk_method):
+        """ Tests that only rejected items are resent """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "bulk": {"enabled": True},
+            "serializer": "json",
+            "retry_options": {"multiplier": 0.01}
+        })
+        bulk_method.side_effect = [
+            {"items": [
+                {"index": {"_id": "1", "status": 201}},
+                {"index": {"status": 429, "error": "rejected"}},
+                {"index": {"status": 400, "error": "bad document"}},
+            ]},
+            self._bulk_response("2")
+        ]
+        blk.start()
+        blk.process_signals([Signal({"field1": i}) for i in range(3)])
+        # The rejected document is resent later, not waited for
+        self.assertEqual(bulk_method.call_count, 1)
+        self.assert_num_signals_notified(1)
+        JumpAheadScheduler.jump_ahead(1)
+        wait_for(lambda: len(self.last_notified[DEFAULT_TERMINAL]) == 2)
+        self.assertEqual(bulk_method.call_count, 2)
+        # Only the rejected document is sent again
+        self.assertEqual(bulk_method.call_args[1]["body"],
+                         '{"index": {}}\n{"field1": 1}\n')
+        self.assert_num_signals_notified(2)
+        self.assertEqual(
+            [s.id for s in self.last_notified[DEFAULT_TERMINAL]], ["1", "2"])
+        blk.stop()
+
+    def test_bulk_stats(self, bulk_method):
+        """ Tests bulk requests are reported by the stats command """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "index": "idx",
+            "doc_type": "t",
+            "bulk": {"enabled": True},
+            "serializer": "json",
+            "retry_options": {"multiplier": 0.01}
+        })
+        bulk_method.side_effect = [
+            {"took": 7, "items": [
+                {"index": {"_id": "1", "status": 201}},
+                {"index": {"status": 429, "error": "rejected"}},
+            ]},
+            dict(self._bulk_response("2"), took=3)
+        ]
+        blk.start()
+        blk.process_signals([Signal({"field1": i}) for i in range(2)])
+        self.assertEqual(blk.stats()['stats']['queues'],
+                         {'pending_queries': 0, 'scheduled_retries': 1})
+        JumpAheadScheduler.jump_ahead(1)
+        wait_for(lambda: len(self.last_notified[DEFAULT_TERMINAL]) == 2)
+        stats = blk.stats()['stats']
+        self.assertEqual(len(stats['targets']), 1)
+        target = stats['targets'][0]
+        self.assertEqual((target['index'], target['doc_type']), ("idx", "t"))
+        self.assertEqual(target['requests'], 2)
+        self.assertEqual(target['docs'], 3)
+        self.assertEqual(target['rejections'], 1)
+        self.assertEqual(target['retries'], 1)
+        self.assertEqual(target['bulk_size']['max'], 2)
+        self.assertEqual(target['took_ms']['max'], 7)
+        # Both documents are sent, then only the rejected one
+        self.assertEqual(target['bytes'], len(
+            '{"index": {}}\n{"field1": 0}\n{"index": {}}\n{"field1": 1}\n'
+            '{"index": {}}\n{"field1": 1}\n'))
+        self.assertEqual(stats['queues'],
+                         {'pending_queries': 0, 'scheduled_retries': 0})
+        blk.stop()
+
+    def test_bulk_create_ids(self, bulk_method):
+        """ Tests bulk creates carry their ids and tolerate conflicts """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "index": "idx",
+            "doc_type": "t",
+            "bulk": {"enabled": True},
+            "serializer": "json",
+            "document_id": {"source": "expression",
+                            "expression": "{{ $key }}",
+                            "op_type": "create"}
+        })
+        bulk_method.return_value = {"items": [
+            {"create": {"_id": "a", "status": 201}},
+            {"create": {"_id": "b", "status": 409,
+                        "error": {"type": "version_conflict"}}},
+            {"create": {"_id": "c", "status": 400,
+                        "error": {"type": "mapper_parsing_exception"}}},
+        ]}
+        blk.start()
+        blk.process_signals([Signal({"key": key}) for key in "abc"])
+        self.assertEqual(
+            bulk_method.call_args[1]["body"],
+            '{"create": {"_id": "a"}}\n{"key": "a"}\n'
+            '{"create": {"_id": "b"}}\n{"key": "b"}\n'
+            '{"create": {"_id": "c"}}\n{"key": "c"}\n')
+        self.assertEqual(
+            [s.id for s in self.last_notified[DEFAULT_TERMINAL]], ["a", "b"])
+        blk.stop()
+
+    @patch('elasticsearch.Elasticsearch.ping', return_value=True)
+    def test_spill_and_replay(self, ping_method, bulk_method):
+        """ Tests documents are spilled during an outage and replayed """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "index": "idx",
+            "doc_type": "t",
+            "bulk": {"enabled": True},
+            "serializer": "json",
+            "retry_options": {"max_retry": 0},
+            "spill": {"enabled": True, "directory": directory.name,
+                      "replay_rate": 0}
+        })
+        bulk_method.side_effect = ConnectionError("N/A", "refused", None)
+        blk.start()
+        blk.process_signals([Signal({"field1": i}) for i in range(2)])
+        self.assert_num_signals_notified(0)
+        self.assertEqual(blk.stats()['stats']['spill']['spilled'], 2)
+        bulk_method.side_effect = [self._bulk_response("1", "2")]
+        blk._replay()
+        self.assertEqual(bulk_method.call_args[1]["body"],
+                         '{"index": {}}\n{"field1": 0}\n'
+                         '{"index": {}}\n{"field1": 1}\n')
+        stats = blk.stats()['stats']['spill']
+        self.assertEqual((stats['replayed'], stats['segments']), (2, 0))
+        blk.stop()
+
+    @patch('elasticsearch.Elasticsearch.ping', return_value=True)
+    def test_spill_directories(self, ping_method, bulk_method):
+        """ Tests each block spills to its own directory """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        blocks = []
+        for name in ("first", "second"):
+            blk = ESInsert()
+            self.configure_block(blk, {"name": name,
+                                       "spill": {"enabled": True}})
+            blk.start()
+            blocks.append(blk)
+        self.assertEqual(
+            [blk._journal.directory for blk in blocks],
+            [os.path.join("es_spill", "first"),
+             os.path.join("es_spill", "second")])
+        blk = ESInsert()
+        self.configure_block(blk, {"name": "first",
+                                   "spill": {"enabled": True}})
+        with self.assertRaises(SpillDirectoryError):
+            blk.start()
+        for blk in blocks:
+            blk.stop()
+
+    @patch('elasticsearch.Elasticsearch.ping', return_value=True)
+    def test_spill_directory_in_use(self, ping_method, bulk_method):
+        """ Tests a block failing to claim its directory stops again """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = {"concurrency": {"workers": 2},
+                  "metrics": {"report_interval": {"seconds": 60}},
+                  "spill": {"enabled": True, "directory": directory.name}}
+        first = ESInsert()
+        self.configure_block(first, config)
+        first.start()
+        second = ESInsert()
+        self.configure_block(second, config)
+        with self.assertRaises(SpillDirectoryError):
+            second.start()
+        self.assertIsNone(second._executor)
+        self.assertIsNone(second._metrics_job)
+        self.assertIsNone(second._client_key)
+        self.assertIsNone(second._journal)
+        first.stop()
+
+    @patch('elasticsearch.Elasticsearch.ping', return_value=True)
+    def test_stop_during_replay(self, ping_method, bulk_method):
+        """ Tests stopping doesn't wait for the retries of a replay """
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "bulk": {"enabled": True},
+            "retry_options": {"max_retry": 10, "multiplier": 60},
+            "spill": {"enabled": True, "directory": directory.name}
+        })
+        sent = Event()
+
+        def refuse(*args, **kwargs):
+            sent.set()
+            raise ConnectionError("N/A", "refused", None)
+        bulk_method.side_effect = refuse
+        blk.start()
+        blk.spill_actions([("idx", "t", '{"index": {}}\n{}\n')])
+        blk._replay_thread = spawn(blk._replay)
+        self.assertTrue(sent.wait(1))
+        began = monotonic()
+        blk.stop()
+        self.assertLess(monotonic() - began, 5)
+
+    def test_bulk_time_routing(self, bulk_method):
+        """ Tests signals are grouped by the daily index of their time """
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "doc_type": "t",
+            "bulk": {"enabled": True},
+            "index_routing": {
+                "mode": "time",
+                "base_name": "logs-",
+                "time_field": "time"
+            }
+        })
+        bulk_method.side_effect = [self._bulk_response("1", "3"),
+                                   self._bulk_response("2")]
+        blk.start()
+        blk.process_signals([Signal({"time": "2024-01-01T23:59:59Z"}),
+                             Signal({"time": 1704153600000}),
+                             Signal({"time": "2024-01-01T00:00:00"}),
+                             Signal({"no_time": True})])
+        self.assertEqual(
+            [call[1]["index"] for call in bulk_method.call_args_list],
+            ["logs-2024.01.01", "logs-2024.01.02"])
+        self.assert_num_signals_notified(3)
+        blk.stop()
+
+
+class TestESInsertRollover(NIOBlockTestCase):
+
+    """ Tests writing through a rollover alias """
+
+    @patch('elasticsearch.client.IndicesClient.rollover')
+    @patch('elasticsearch.client.IndicesClient.create')
+    @patch('elasticsearch.client.IndicesClient.exists_alias')
+    @patch('elasticsearch.Elasticsearch.index')
+    def test_rollover_alias(self, index_method, exists_method, create_method,
+                            rollover_method):
+        blk = ESInsert()
+        self.configure_block(blk, {
+            "index": "{{ $not_evaluated }}",
+            "doc_type": "t",
+            "index_routing": {
+                "mode": "rollover_alias",
+                "base_name": "logs",
+                "rollover_max_docs": 1000
+            }
+        })
+        exists_method.return_value = False
+        rollover_method.return_value = {"rolled_over": True}
+        blk.start()
+        # The first index is created behind the alias
+        create_method.assert_called_once_with(
+            index="logs-000001", body={"aliases": {"logs": {}}})
+        blk.process_signals([Signal({"field1": 1})])
+        self.assertEqual(index_method.call_args[0][0], "logs")
+        blk._rollover()
+        rollover_method.assert_called_once_with(alias="logs", body={
+            "conditions": {"max_age": "1d", "max_docs": 1000}})
+        blk.stop()
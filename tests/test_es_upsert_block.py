@@ -0,0 +1,144 @@
+from time import monotonic, sleep
+from unittest.mock import patch
+from elasticsearch.exceptions import ConnectionError
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.signal.base import Signal
+from nio.testing.block_test_case import NIOBlockTestCase
+from nio.testing.modules.scheduler.scheduler import JumpAheadScheduler
+from ..es_upsert_block import ESUpsert
+from .. import literal_cache
+
+
+@patch('elasticsearch.Elasticsearch.update')
+class TestESUpsert(NIOBlockTestCase):
+
+    """ Tests elasticsearch block update functionality """
+
+    def test_partial_doc(self, update_method):
+        """ Tests the doc of each signal is merged into its document """
+        blk = ESUpsert()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "doc_id": "{{ $key }}",
+            "doc": '{{ {"count": $count} }}'
+        })
+        update_method.return_value = {"_id": "a", "result": "updated"}
+        blk.start()
+        blk.process_signals([Signal({"key": "a", "count": 2})])
+        update_method.assert_called_once_with(
+            "index_name", "doc_type_name", "a",
+            body={"doc": {"count": 2}, "doc_as_upsert": True},
+            retry_on_conflict=3)
+        self.assertDictEqual(
+            self.last_notified[DEFAULT_TERMINAL][0].to_dict(),
+            {"id": "a", "result": "updated"})
+        blk.stop()
+
+    def test_condition_cache_stats(self, update_method):
+        """ Tests rendered docs are counted in the condition cache """
+        blk = ESUpsert()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "doc_id": "{{ $key }}",
+            "doc": '{"count": {{ $count }}}'
+        })
+        update_method.return_value = {"_id": "a", "result": "updated"}
+        literal_cache.clear()
+        blk.start()
+        blk.process_signals([Signal({"key": "a", "count": 2}),
+                             Signal({"key": "b", "count": 2})])
+        stats = blk.stats()['stats']['condition_cache']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        blk.stop()
+
+    def test_script(self, update_method):
+        """ Tests a script is run with the parameters of each signal """
+        blk = ESUpsert()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "update_type": "script",
+            "script": {
+                "source": "ctx._source.count += params.count",
+                "params": '{{ {"count": $count} }}'
+            },
+            "doc_as_upsert": False,
+            "retry_on_conflict": 0
+        })
+        blk.start()
+        blk.process_signals([Signal({"id": 1, "count": 2}),
+                             Signal({"count": 3})])
+        # The signal without an id is not sent
+        update_method.assert_called_once_with(
+            "index_name", "doc_type_name", "1",
+            body={"script": {"inline": "ctx._source.count += params.count",
+                             "lang": "painless",
+                             "params": {"count": 2}}})
+        blk.stop()
+
+
+@patch('elasticsearch.Elasticsearch.bulk')
+class TestESUpsertBulk(NIOBlockTestCase):
+
+    """ Tests elasticsearch block bulk update functionality """
+
+    def test_bulk_update(self, bulk_method):
+        """ Tests updates are sent as bulk update actions """
+        blk = ESUpsert()
+        self.configure_block(blk, {
+            "index": "index_name",
+            "doc_type": "doc_type_name",
+            "bulk": {"enabled": True},
+            "serializer": "json",
+            "update_type": "script",
+            "script": {"source": "ctx._source.n += 1"}
+        })
+        bulk_method.return_value = {"items": [
+            {"update": {"_id": "a", "status": 201, "result": "created"}},
+            {"update": {"_id": "b", "status": 409,
+                        "error": {"type": "version_conflict"}}},
+        ]}
+        blk.start()
+        blk.process_signals([Signal({"id": "a", "n": 1}),
+                             Signal({"id": "b", "n": 1})])
+        self.assertEqual(
+            bulk_method.call_args[1]["body"],
+            '{"update": {"_id": "a", "_retry_on_conflict": 3}}\n'
+            '{"script": {"inline": "ctx._source.n += 1", '
+            '"lang": "painless", "params": {}}, '
+            '"upsert": {"id": "a", "n": 1}}\n'
+            '{"update": {"_id": "b", "_retry_on_conflict": 3}}\n'
+            '{"script": {"inline": "ctx._source.n += 1", '
+            '"lang": "painless", "params": {}}, '
+            '"upsert": {"id": "b", "n": 1}}\n')
+        self.assert_num_signals_notified(1)
+        self.assertDictEqual(
+            self.last_notified[DEFAULT_TERMINAL][0].to_dict(),
+            {"id": "a", "result": "created"})
+        blk.stop()
+
+    def test_bulk_request_failure(self, bulk_method):
+        """ Tests a failed bulk request is rescheduled, not waited for """
+        blk = ESUpsert()
+        self.configure_block(blk, {
+            "bulk": {"enabled": True},
+            "retry_options": {"multiplier": 0.01}
+        })
+        bulk_method.side_effect = [
+            ConnectionError("N/A", "refused", None),
+            {"items": [{"update": {"_id": "a", "status": 200,
+                                   "result": "updated"}}]}]
+        blk.start()
+        blk.process_signals([Signal({"id": "a"})])
+        self.assertEqual(bulk_method.call_count, 1)
+        self.assert_num_signals_notified(0)
+        JumpAheadScheduler.jump_ahead(1)
+        deadline = monotonic() + 5
+        while not self.last_notified[DEFAULT_TERMINAL] and \
+                monotonic() < deadline:
+            sleep(0.01)
+        blk.stop()
+        self.assert_num_signals_notified(1)
+        self.assertEqual(blk.stats()["stats"]["targets"][0]["retries"], 1)
@@ -0,0 +1,116 @@
+from time import monotonic, sleep
+
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.signal.base import Signal
+from nio.testing.block_test_case import NIOBlockTestCase
+from nio.testing.modules.scheduler.scheduler import JumpAheadScheduler
+
+from ..benchmarks.fake_elasticsearch import FakeElasticsearch
+from ..es_find_block import ESFind
+from ..es_insert_block import ESInsert
+
+
+class TestFakeElasticsearch(NIOBlockTestCase):
+
+    """ Tests the blocks against the fake node used by the benchmarks """
+
+    def setUp(self):
+        super().setUp()
+        self.fake = FakeElasticsearch(total_hits=25)
+        self.fake.start()
+        self.addCleanup(self.fake.stop)
+
+    def _configure(self, blk, config):
+        self.configure_block(blk, dict(
+            config, host=self.fake.host, port=self.fake.port))
+
+    def test_insert(self):
+        blk = ESInsert()
+        self._configure(blk, {})
+        blk.start()
+        self.assertEqual(blk.connected(), {'connected': True})
+        blk.process_signals([Signal({"val": 1})])
+        self.assert_num_signals_notified(1)
+        blk.stop()
+
+    def test_bulk_rejections(self):
+        """ Tests rejected bulk items are resent until accepted """
+        self.fake.reject_rate = 0.3
+        blk = ESInsert()
+        self._configure(blk, {
+            "bulk": {"enabled": True},
+            "retry_options": {"multiplier": 0.01, "max_retry": 20}
+        })
+        blk.start()
+        blk.process_signals([Signal({"val": i}) for i in range(20)])
+        # Rejected items are resent by scheduled retries
+        deadline = monotonic() + 10
+        while len(self.last_notified[DEFAULT_TERMINAL]) < 20 and \
+                monotonic() < deadline:
+            JumpAheadScheduler.jump_ahead(1)
+            sleep(0.05)
+        self.assert_num_signals_notified(20)
+        self.assertGreater(self.fake.requests['_bulk'], 1)
+        blk.stop()
+
+    def test_compression(self):
+        """ Tests requests and responses can be gzipped """
+        blk = ESInsert()
+        self._configure(blk, {
+            "bulk": {"enabled": True},
+            "compression": {
+                "compress_requests": True,
+                "min_size": 100,
+                "accept_compressed": True
+            }
+        })
+        blk.start()
+        # Too small to be compressed
+        blk.process_signals([Signal({"val": 1})])
+        self.assertEqual(self.fake.compressed_requests, 0)
+        blk.process_signals([Signal({"val": "x" * 50}) for _ in range(20)])
+        self.assert_num_signals_notified(21)
+        self.assertEqual(self.fake.compressed_requests, 1)
+        compression = blk.stats()['stats']['compression']
+        self.assertEqual(compression['requests'], 2)
+        self.assertEqual(compression['compressed'], 1)
+        self.assertGreater(compression['ratio'], 1)
+        blk.stop()
+
+    def test_scroll(self):
+        blk = ESFind()
+        self._configure(blk, {
+            "stream": {"enabled": True, "page_size": 10}
+        })
+        blk.start()
+        blk.process_signals([Signal()])
+        self.assertEqual(
+            [s.value for s in self.last_notified[DEFAULT_TERMINAL]],
+            list(range(25)))
+        # A search, 3 scrolls until an empty page and clearing the scroll
+        self.assertEqual(self.fake.requests['_search'], 5)
+        self.assertEqual(self.fake._scrolls, {})
+        blk.stop()
+
+    def test_msearch(self):
+        blk = ESFind()
+        self._configure(blk, {
+            "size": 5,
+            "msearch": {"enabled": True}
+        })
+        blk.start()
+        blk.process_signals([Signal(), Signal()])
+        self.assert_num_signals_notified(10)
+        self.assertEqual(self.fake.requests['_msearch'], 1)
+        blk.stop()
+
+    def test_count(self):
+        blk = ESFind()
+        self._configure(blk, {"mode": "count", "terminate_after": 10})
+        blk.start()
+        blk.process_signals([Signal()])
+        self.assertEqual(self.fake.requests['_count'], 1)
+        self.assertDictEqual(
+            self.last_notified[DEFAULT_TERMINAL][0].to_dict(),
+            {"count": 10, "terminated_early": True})
+        blk.stop()
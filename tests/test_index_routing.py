@@ -0,0 +1,50 @@
+from datetime import datetime, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from nio.signal.base import Signal
+
+from ..index_routing import TimeIndexResolver, bucket_seconds, to_timestamp
+
+
+class TestIndexRouting(TestCase):
+
+    """ Tests naming time-partitioned indices """
+
+    def test_bucket_seconds(self):
+        self.assertEqual(bucket_seconds("%Y.%m.%d"), 86400)
+        self.assertEqual(bucket_seconds("%Y.%m"), 86400)
+        self.assertEqual(bucket_seconds("%Y.%m.%d.%H"), 3600)
+        self.assertEqual(bucket_seconds("%Y%m%d-%H%M"), 60)
+        self.assertEqual(bucket_seconds("static"), 86400)
+
+    def test_to_timestamp(self):
+        expected = datetime(2024, 1, 2, tzinfo=timezone.utc).timestamp()
+        self.assertEqual(to_timestamp(expected), expected)
+        self.assertEqual(to_timestamp(expected * 1000), expected)
+        self.assertEqual(to_timestamp(datetime(2024, 1, 2)), expected)
+        self.assertEqual(to_timestamp("2024-01-02T00:00:00Z"), expected)
+        self.assertEqual(to_timestamp("2024-01-02T01:00:00+01:00"), expected)
+        with self.assertRaises(ValueError):
+            to_timestamp(None)
+
+    def test_resolve_signal_time(self):
+        resolver = TimeIndexResolver("logs-", "%Y.%m.%d.%H", "time")
+        self.assertEqual(
+            resolver(Signal({"time": "2024-01-02T03:04:05Z"})),
+            "logs-2024.01.02.03")
+        self.assertEqual(
+            resolver(Signal({"time": "2024-01-02T03:59:59Z"})),
+            "logs-2024.01.02.03")
+        # One name per hour is formatted
+        self.assertEqual(len(resolver._names), 1)
+
+    def test_resolve_ingest_time(self):
+        resolver = TimeIndexResolver("logs-", "%Y-%m", max_cached=1)
+        with patch(TimeIndexResolver.__module__ + '.time') as now:
+            now.return_value = datetime(
+                2024, 1, 31, 23, tzinfo=timezone.utc).timestamp()
+            self.assertEqual(resolver(Signal()), "logs-2024-01")
+            now.return_value += 3600
+            self.assertEqual(resolver(Signal()), "logs-2024-02")
+        self.assertEqual(len(resolver._names), 1)
@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+from ..literal_cache import LiteralCache
+
+
+class TestLiteralCache(TestCase):
+
+    """ Tests caching parsed literals """
+
+    def test_hits_and_misses(self):
+        cache = LiteralCache()
+        self.assertEqual(cache.parse("{'a': [1, 2]}"), {'a': [1, 2]})
+        self.assertEqual(cache.parse("{'a': [1, 2]}"), {'a': [1, 2]})
+        self.assertEqual(cache.parse("{'b': 1}"), {'b': 1})
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 2)
+
+    def test_copies(self):
+        """ Tests callers can't alter what is cached """
+        cache = LiteralCache()
+        value = cache.parse("{'a': [1, {'b': (2, [3])}]}")
+        value['a'][1]['b'][1].append(4)
+        value['a'].append(5)
+        self.assertEqual(cache.parse("{'a': [1, {'b': (2, [3])}]}"),
+                         {'a': [1, {'b': (2, [3])}]})
+
+    def test_not_literal(self):
+        """ Tests failures are cached and raised every time """
+        cache = LiteralCache()
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache.parse("not a literal")
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_least_recently_used(self):
+        cache = LiteralCache(max_size=2)
+        cache.parse("1")
+        cache.parse("2")
+        # 1 was used last, 2 goes first
+        cache.parse("1")
+        cache.parse("3")
+        cache.parse("1")
+        cache.parse("2")
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['size'], 2)
@@ -0,0 +1,61 @@
+from unittest import TestCase
+
+from elasticsearch.exceptions import TransportError
+
+from ..metrics import Histogram, Metrics
+
+
+class TestMetrics(TestCase):
+
+    """ Tests recording and summarizing runtime metrics """
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.summary(), {})
+        for value in range(1, 101):
+            histogram.add(value)
+        self.assertEqual(histogram.summary(),
+                         {'p50': 50, 'p95': 95, 'p99': 99, 'max': 100})
+
+    def test_histogram_keeps_recent_samples(self):
+        histogram = Histogram(max_samples=10)
+        for value in range(100):
+            histogram.add(value)
+        self.assertEqual(histogram.summary()['p50'], 94)
+
+    def test_per_target(self):
+        """ Tests that metrics are broken down by index and doc_type """
+        metrics = Metrics()
+        metrics.record_request("a", "t", latency=0.01, took=3, docs=2,
+                               sent_bytes=100)
+        metrics.record_request("a", "t", latency=0.03,
+                               error=TransportError(429, 'rejected'))
+        metrics.record_request("b", "t", latency=0.02, took=5, docs=1)
+        metrics.record_bulk("b", "t", 10)
+        metrics.record_retry("b", "t", 4)
+        metrics.record_rejections("b", "t", 4)
+        snapshot = metrics.snapshot()
+        targets = {(t['index'], t['doc_type']): t
+                   for t in snapshot['targets']}
+        self.assertEqual(targets[("a", "t")]['requests'], 2)
+        self.assertEqual(targets[("a", "t")]['errors'], 1)
+        self.assertEqual(targets[("a", "t")]['rejections'], 1)
+        self.assertEqual(targets[("a", "t")]['bytes'], 100)
+        self.assertEqual(targets[("a", "t")]['latency_ms']['max'], 30)
+        self.assertEqual(targets[("a", "t")]['took_ms']['p50'], 3)
+        self.assertEqual(targets[("b", "t")]['bulk_size']['p99'], 10)
+        self.assertEqual(targets[("b", "t")]['retries'], 4)
+        total = snapshot['total']
+        self.assertEqual(total['requests'], 3)
+        self.assertEqual(total['docs'], 3)
+        self.assertEqual(total['rejections'], 5)
+        self.assertEqual(total['took_ms']['max'], 5)
+        self.assertGreater(total['docs_per_sec'], 0)
+
+    def test_reset(self):
+        metrics = Metrics()
+        metrics.record_request("a", "t", latency=0.01)
+        self.assertEqual(metrics.snapshot(reset=True)['total']['requests'],
+                         1)
+        self.assertEqual(metrics.snapshot()['total']['requests'], 0)
+        self.assertEqual(metrics.snapshot()['targets'], [])
@@ -0,0 +1,46 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from ..node_selection import LeastInFlightSelector, InFlightConnection
+
+
+class TestNodeSelection(TestCase):
+
+    """ Tests selecting the node with the fewest requests in flight """
+
+    def _connection(self, in_flight):
+        connection = MagicMock()
+        connection.in_flight = in_flight
+        return connection
+
+    def test_least_in_flight(self):
+        """ Tests that the least busy node is selected """
+        selector = LeastInFlightSelector({})
+        busy, idle, busier = [self._connection(n) for n in (2, 0, 5)]
+        for _ in range(3):
+            self.assertIs(selector.select([busy, idle, busier]), idle)
+
+    def test_ties_round_robin(self):
+        """ Tests that idle nodes are selected in turn """
+        selector = LeastInFlightSelector({})
+        connections = [self._connection(0) for _ in range(3)]
+        self.assertEqual(
+            [selector.select(connections) for _ in range(6)],
+            connections * 2)
+
+    @patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+    def test_in_flight_count(self, perform_request):
+        """ Tests that connections count their requests in flight """
+        connection = InFlightConnection()
+
+        def request(*args, **kwargs):
+            self.assertEqual(connection.in_flight, 1)
+            return 200, {}, ""
+        perform_request.side_effect = request
+        connection.perform_request("GET", "/")
+        self.assertEqual(connection.in_flight, 0)
+
+        perform_request.side_effect = Exception("failed")
+        with self.assertRaises(Exception):
+            connection.perform_request("GET", "/")
+        self.assertEqual(connection.in_flight, 0)
@@ -0,0 +1,71 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from elasticsearch.exceptions import TransportError, ConnectionError, \
+    ConnectionTimeout, SSLError
+
+from ..connection import RetryAfterConnection
+from ..retry_policy import RetryPolicy, is_retryable
+
+
+class TestRetryPolicy(TestCase):
+
+    """ Tests deciding whether and when requests are retried """
+
+    def test_retryable_errors(self):
+        """ Tests that only transport errors, 429 and 503 are retried """
+        self.assertTrue(is_retryable(ConnectionError('N/A', 'refused')))
+        self.assertTrue(is_retryable(ConnectionTimeout('TIMEOUT', '')))
+        self.assertTrue(is_retryable(TransportError(429, 'rejected')))
+        self.assertTrue(is_retryable(TransportError(503, 'unavailable')))
+        self.assertFalse(is_retryable(SSLError('N/A', 'bad cert')))
+        self.assertFalse(is_retryable(TransportError(400, 'parsing')))
+        self.assertFalse(is_retryable(TransportError(404, 'not found')))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_max_retry(self):
+        """ Tests that retries stop after max_retry unless indefinite """
+        error = TransportError(429, 'rejected')
+        policy = RetryPolicy(max_retry=2)
+        self.assertTrue(policy.should_retry(2, error))
+        self.assertFalse(policy.should_retry(3, error))
+        policy = RetryPolicy(max_retry=2, indefinite=True)
+        self.assertTrue(policy.should_retry(3, error))
+        policy = RetryPolicy(max_retry=-1)
+        self.assertTrue(policy.should_retry(100, error))
+
+    def test_delay(self):
+        """ Tests exponential backoff with full jitter """
+        policy = RetryPolicy(max_retry=3, multiplier=0.5)
+        for retry_num, max_delay in ((1, 0.5), (2, 1), (3, 2), (4, 2)):
+            delays = [policy.delay(retry_num) for _ in range(50)]
+            self.assertTrue(all(0 <= d <= max_delay for d in delays))
+            # Jitter spreads the retries
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_retry_after(self):
+        """ Tests that Retry-After replaces the backoff delay """
+        policy = RetryPolicy()
+        error = TransportError(429, 'rejected')
+        error.retry_after = "12"
+        self.assertEqual(policy.delay(1, error), 12)
+        error.retry_after = "Wed, 21 Oct 2015 07:28:00 GMT"
+        self.assertLessEqual(policy.delay(1, error), 1)
+
+
+class TestRetryAfterConnection(TestCase):
+
+    """ Tests keeping the Retry-After header of failed requests """
+
+    @patch('urllib3.HTTPConnectionPool.urlopen')
+    def test_retry_after_header(self, urlopen):
+        response = MagicMock()
+        response.status = 429
+        response.headers = {'Retry-After': '7'}
+        response.data = b'{"error": "rejected"}'
+        urlopen.return_value = response
+        connection = RetryAfterConnection()
+        with self.assertRaises(TransportError) as context:
+            connection.perform_request("GET", "/")
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertEqual(context.exception.retry_after, '7')
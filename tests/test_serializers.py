@@ -0,0 +1,81 @@
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+from uuid import UUID
+import json
+
+from elasticsearch.exceptions import SerializationError
+
+from ..serializers import JSONSerializer, JSONLibrary, get_serializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class TestSerializers(TestCase):
+
+    """ Tests encoding request bodies with the configured JSON library """
+
+    document = {
+        "datetime": datetime(2020, 1, 2, 3, 4, 5, 6),
+        "aware": datetime(2020, 1, 2, tzinfo=timezone.utc),
+        "date": date(2020, 1, 2),
+        "decimal": Decimal("1.5"),
+        "bytes": b"\x00ab",
+        "uuid": UUID(int=1),
+        "text": "café",
+    }
+    encoded = {
+        "datetime": "2020-01-02T03:04:05.000006",
+        "aware": "2020-01-02T00:00:00+00:00",
+        "date": "2020-01-02",
+        "decimal": 1.5,
+        "bytes": "AGFi",
+        "uuid": "00000000-0000-0000-0000-000000000001",
+        "text": "café",
+    }
+
+    def test_stdlib(self):
+        serializer = JSONSerializer(JSONLibrary.STDLIB)
+        self.assertEqual(json.loads(serializer.dumps(self.document)),
+                         self.encoded)
+        self.assertEqual(serializer.loads('{"a": [1, 2]}'), {"a": [1, 2]})
+
+    @skipUnless(orjson, "orjson is not installed")
+    def test_orjson(self):
+        """ Tests orjson encodes signal values like the stdlib """
+        serializer = JSONSerializer(JSONLibrary.ORJSON)
+        self.assertEqual(json.loads(serializer.dumps(self.document)),
+                         self.encoded)
+        self.assertEqual(serializer.loads('{"a": [1, 2]}'), {"a": [1, 2]})
+        self.assertIs(get_serializer(JSONLibrary.AUTO),
+                      get_serializer(JSONLibrary.ORJSON))
+
+    def test_strings_untouched(self):
+        """ Tests already serialized bodies are sent as they are """
+        serializer = get_serializer()
+        self.assertEqual(serializer.dumps('{"index": {}}\n'),
+                         '{"index": {}}\n')
+
+    def test_errors(self):
+        serializer = get_serializer()
+        with self.assertRaises(SerializationError):
+            serializer.loads("not json")
+        with self.assertRaises(SerializationError):
+            serializer.dumps({"set": {1, 2}})
+
+    @patch(JSONSerializer.__module__ + '._serializers', {})
+    @patch(JSONSerializer.__module__ + '.import_module',
+           side_effect=ImportError)
+    def test_fallback(self, import_module):
+        """ Tests the stdlib is used when no faster library is installed """
+        self.assertEqual(get_serializer(JSONLibrary.AUTO).library,
+                         JSONLibrary.STDLIB)
+        self.assertEqual(get_serializer(JSONLibrary.ORJSON).library,
+                         JSONLibrary.STDLIB)
+        # Serializers are shared
+        self.assertIs(get_serializer(JSONLibrary.AUTO),
+                      get_serializer(JSONLibrary.STDLIB))
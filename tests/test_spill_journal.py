@@ -0,0 +1,88 @@
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import os
+
+from ..spill_journal import SpillJournal, SpillDirectoryError
+
+
+class TestSpillJournal(TestCase):
+
+    """ Tests the segmented journal of spilled documents """
+
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_segments(self):
+        """ Tests records are read back in segments, oldest first """
+        journal = SpillJournal(self.directory, segment_bytes=20)
+        journal.open()
+        self.assertIsNone(journal.oldest_segment())
+        # Each record is 14 bytes, segments hold two of them
+        self.assertEqual(journal.append([["i", "t", str(n)]
+                                         for n in range(3)]), 3)
+        self.assertEqual(journal.stats()['segments'], 2)
+        first = journal.oldest_segment()
+        self.assertEqual(journal.read(first), [["i", "t", "0"],
+                                               ["i", "t", "1"]])
+        journal.delete(first)
+        self.assertFalse(os.path.exists(first))
+        # The segment being appended to is closed before it's read
+        second = journal.oldest_segment()
+        self.assertEqual(journal.read(second), [["i", "t", "2"]])
+        journal.append([["i", "t", "3"]])
+        self.assertEqual(journal.read(second), [["i", "t", "2"]])
+        journal.delete(second)
+        self.assertEqual(journal.stats()['segments'], 1)
+        self.assertEqual(journal.stats()['bytes'], 14)
+        journal.close()
+
+    def test_max_bytes(self):
+        """ Tests records past max_bytes are dropped """
+        journal = SpillJournal(self.directory, max_bytes=30)
+        journal.open()
+        self.assertEqual(journal.append([["i", "t", str(n)]
+                                         for n in range(3)]), 2)
+        self.assertEqual(journal.stats()['dropped'], 1)
+        self.assertEqual(journal.stats()['spilled'], 2)
+        journal.close()
+
+    def test_reopen(self):
+        """ Tests segments of a previous run are picked up """
+        journal = SpillJournal(self.directory)
+        journal.open()
+        journal.append([["i", "t", "0"]])
+        journal.close()
+        # A partial line left by a crash is skipped
+        with open(journal.oldest_segment(), 'ab') as segment:
+            segment.write(b'["i", "t"')
+        journal = SpillJournal(self.directory)
+        journal.open()
+        self.assertEqual(journal.stats()['bytes'], 23)
+        journal.append([["i", "t", "1"]])
+        self.assertEqual(journal.stats()['segments'], 2)
+        self.assertEqual(journal.read(journal.oldest_segment()),
+                         [["i", "t", "0"]])
+        journal.close()
+
+    def test_directory_in_use(self):
+        """ Tests two open journals can't share a directory """
+        journal = SpillJournal(self.directory)
+        journal.open()
+        with self.assertRaises(SpillDirectoryError):
+            SpillJournal(os.path.join(self.directory, ".")).open()
+        journal.close()
+        other = SpillJournal(self.directory)
+        other.open()
+        other.close()
+
+    def test_directory_not_created(self):
+        """ Tests a journal failing to open leaves its directory free """
+        journal = SpillJournal(self.directory)
+        with patch("os.makedirs", side_effect=PermissionError):
+            with self.assertRaises(PermissionError):
+                journal.open()
+        journal.open()
+        journal.close()